@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+from benchmark import make_phantom, write_synthetic_cohort, compare_to_baseline, benchmark_pipeline, \
+    DEFAULT_BENCHMARK_YAML
+from utils import get_path_images_masks
+
+
+def test_make_phantom_labels():
+    """
+    GIVEN: A phantom with three lesions.
+    WHEN: make_phantom is called.
+    THEN: The mask should contain the labels 0 to 3 and the image should have the same shape.
+    """
+    image, mask = make_phantom(n_slices=16, size=32, n_labels=3, lesion_radius=3)
+
+    assert image.shape == mask.shape == (16, 32, 32)
+    assert set(np.unique(mask)) <= {0, 1, 2, 3} and mask.max() > 0
+
+
+def test_make_phantom_lesion_too_large():
+    """
+    GIVEN: A lesion radius that does not fit in the volume.
+    WHEN: make_phantom is called.
+    THEN: A ValueError should be raised.
+    """
+    with pytest.raises(ValueError, match="lesion_radius is too large"):
+        make_phantom(n_slices=8, size=32, lesion_radius=4)
+
+
+def test_write_synthetic_cohort_discovered(tmp_path):
+    """
+    GIVEN: A synthetic cohort of two patients.
+    WHEN: get_path_images_masks is called on its directory.
+    THEN: Both images and masks should be found.
+    """
+    write_synthetic_cohort(str(tmp_path), n_patients=2, n_slices=8, size=16, lesion_radius=2)
+
+    images_path, masks_path = get_path_images_masks(str(tmp_path))
+
+    assert (len(images_path), len(masks_path)) == (2, 2)
+
+
+def test_benchmark_pipeline_counts_lesion_slices(tmp_path):
+    """
+    GIVEN: A synthetic cohort of two patients with one lesion of radius 2 in 8 slices.
+    WHEN: benchmark_pipeline is run on it in 3D.
+    THEN: Only the 5 slices of each lesion should be counted in the slice throughput.
+    """
+    write_synthetic_cohort(str(tmp_path / "data"), n_patients=2, n_slices=8, size=16, n_labels=1, lesion_radius=2)
+    yaml_path = tmp_path / "benchmark.yaml"
+    yaml_path.write_text(DEFAULT_BENCHMARK_YAML)
+
+    result = benchmark_pipeline(str(tmp_path / "data"), "3D", str(yaml_path))
+
+    assert (result["patients"], result["lesion_slices"], result["rows"]) == (2, 10, 2)
+    assert result["lesion_slices_per_s"] == pytest.approx(10 / result["total_s"])
+
+
+def test_compare_to_baseline_regression():
+    """
+    GIVEN: Results whose 3D extraction is twice as slow as the baseline.
+    WHEN: compare_to_baseline is called.
+    THEN: Only the 3D extraction time should be reported.
+    """
+    baseline = {"cohort": {"patients": 1}, "largest_region": {"single_pass_s": 1.0},
+                "get_slices_2D": {"seconds": 1.0}, "pipeline_2D": {"load_s": 1.0, "extraction_s": 1.0},
+                "pipeline_3D": {"load_s": 1.0, "extraction_s": 1.0}}
+    results = {**baseline, "pipeline_3D": {"load_s": 1.1, "extraction_s": 2.0}}
+
+    assert compare_to_baseline(results, baseline) == [("pipeline_3D", "extraction_s", 1.0, 2.0)]
+
+
+def test_compare_to_baseline_other_cohort():
+    """
+    GIVEN: A baseline measured on another cohort.
+    WHEN: compare_to_baseline is called.
+    THEN: A ValueError should be raised.
+    """
+    with pytest.raises(ValueError, match="different cohort"):
+        compare_to_baseline({"cohort": {"patients": 1}}, {"cohort": {"patients": 2}})
+
+
+def test_compare_to_baseline_throughput_and_memory():
+    """
+    GIVEN: Results with fewer 2D rows per second and a larger 3D peak memory than the baseline, and a baseline
+           without workers peak memory.
+    WHEN: compare_to_baseline is called.
+    THEN: The rows per second and the peak memory should be reported, in the order of the benchmarks.
+    """
+    pipeline = {"load_s": 1.0, "extraction_s": 1.0, "rows_per_s": 10.0, "peak_memory_mb": 500.0,
+                "workers_peak_memory_mb": None}
+    baseline = {"cohort": {"patients": 1}, "pipeline_2D": pipeline, "pipeline_3D": pipeline}
+    results = {"cohort": {"patients": 1}, "pipeline_2D": {**pipeline, "rows_per_s": 7.0, "peak_memory_mb": 550.0},
+               "pipeline_3D": {**pipeline, "rows_per_s": 12.0, "peak_memory_mb": 900.0,
+                               "workers_peak_memory_mb": 300.0}}
+
+    assert compare_to_baseline(results, baseline) == [("pipeline_2D", "rows_per_s", 10.0, 7.0),
+                                                      ("pipeline_3D", "peak_memory_mb", 500.0, 900.0)]
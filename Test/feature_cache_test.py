@@ -0,0 +1,150 @@
+import pytest
+import numpy as np
+import SimpleITK as sitk
+from unittest.mock import Mock
+from feature_cache import FeatureCache, file_digest
+from radiomics_2d_3d_extractors import extract_radiomic_features
+
+
+@pytest.fixture
+def cohort_files(tmp_path):
+    """Image, mask and YAML files of a single patient."""
+    img_path, mask_path, yaml_path = tmp_path / "PR1.nii", tmp_path / "PR1_seg.nii", tmp_path / "config.yaml"
+    img_path.write_bytes(b"image")
+    mask_path.write_bytes(b"mask")
+    yaml_path.write_text("featureClass:\n  firstorder:\n")
+    return str(img_path), str(mask_path), str(yaml_path)
+
+
+def _job(img_path, mask_path, label=1, slice_index=None, mode="3D"):
+    return {"Label": label, "Source": {"ImagePath": img_path, "MaskPath": mask_path,
+                                       "Mode": mode, "SliceIndex": slice_index}}
+
+
+def test_file_digest_content(tmp_path):
+    """
+    GIVEN: Two files with the same content.
+    WHEN: file_digest is called on both.
+    THEN: The digests should be equal.
+    """
+    (tmp_path / "a.nii").write_bytes(b"content")
+    (tmp_path / "b.nii").write_bytes(b"content")
+
+    assert file_digest(str(tmp_path / "a.nii")) == file_digest(str(tmp_path / "b.nii"))
+
+
+def test_feature_cache_invalid_size(tmp_path, cohort_files):
+    """
+    GIVEN: A non-positive size cap.
+    WHEN: A FeatureCache is created.
+    THEN: A ValueError should be raised.
+    """
+    with pytest.raises(ValueError, match="max_size_mb must be positive"):
+        FeatureCache(str(tmp_path / "cache"), cohort_files[2], max_size_mb=0)
+
+
+def test_feature_cache_job_key_without_source(tmp_path, cohort_files):
+    """
+    GIVEN: A job that does not come from image and mask files.
+    WHEN: job_key is called.
+    THEN: It should return None, so the job is always extracted.
+    """
+    cache = FeatureCache(str(tmp_path / "cache"), cohort_files[2])
+
+    assert cache.job_key({"Label": 1}) is None
+
+
+def test_feature_cache_job_key_depends_on_slice_and_label(tmp_path, cohort_files):
+    """
+    GIVEN: Jobs on the same files with different labels or slices.
+    WHEN: job_key is called.
+    THEN: Every job should get a different key.
+    """
+    img_path, mask_path, yaml_path = cohort_files
+    cache = FeatureCache(str(tmp_path / "cache"), yaml_path)
+
+    keys = {cache.job_key(_job(img_path, mask_path, 1, 0, "2D")), cache.job_key(_job(img_path, mask_path, 2, 0, "2D")),
+            cache.job_key(_job(img_path, mask_path, 1, 1, "2D")), cache.job_key(_job(img_path, mask_path, 1))}
+
+    assert len(keys) == 4
+
+
+def test_feature_cache_job_key_changes_with_image(tmp_path, cohort_files):
+    """
+    GIVEN: A job whose image file content changes.
+    WHEN: job_key is called before and after the change.
+    THEN: The key should change.
+    """
+    img_path, mask_path, yaml_path = cohort_files
+    cache = FeatureCache(str(tmp_path / "cache"), yaml_path)
+    before = cache.job_key(_job(img_path, mask_path))
+
+    with open(img_path, "wb") as f:
+        f.write(b"another image")
+
+    assert cache.job_key(_job(img_path, mask_path)) != before
+
+
+def test_feature_cache_put_get_counters(tmp_path, cohort_files):
+    """
+    GIVEN: An empty cache.
+    WHEN: A key is looked up, stored, and looked up again.
+    THEN: The first lookup should be a miss and the second a hit returning the stored features.
+    """
+    cache = FeatureCache(str(tmp_path / "cache"), cohort_files[2])
+
+    assert cache.get("ab12") is None
+    cache.put("ab12", {"Feature1": np.array(0.5)})
+    features = cache.get("ab12")
+
+    assert (features["Feature1"], cache.hits, cache.misses) == (0.5, 1, 1)
+
+
+def test_feature_cache_persistent(tmp_path, cohort_files):
+    """
+    GIVEN: Features stored by a previous run.
+    WHEN: A new FeatureCache is created on the same directory.
+    THEN: The stored features should be found.
+    """
+    FeatureCache(str(tmp_path / "cache"), cohort_files[2]).put("ab12", {"Feature1": 0.5})
+
+    assert FeatureCache(str(tmp_path / "cache"), cohort_files[2]).get("ab12") == {"Feature1": 0.5}
+
+
+def test_feature_cache_lru_eviction(tmp_path, cohort_files):
+    """
+    GIVEN: A cache whose size cap fits only two entries.
+    WHEN: Three entries are stored, the first one being read before the third is stored.
+    THEN: The least recently used entry (the second one) should be evicted.
+    """
+    features = {"Feature1": np.zeros(1000)}
+    cache = FeatureCache(str(tmp_path / "cache"), cohort_files[2])
+    cache.put("aa", features)
+    entry_size = cache.size
+    cache.max_size = 2 * entry_size
+
+    cache.put("bb", features)
+    cache.get("aa")
+    cache.put("cc", features)
+
+    assert (cache.get("aa") is not None, cache.get("bb") is None, cache.get("cc") is not None) == (True, True, True)
+
+
+def test_extract_radiomic_features_cache_hit(tmp_path, cohort_files):
+    """
+    GIVEN: A 3D patient read from files and a cache.
+    WHEN: extract_radiomic_features is called twice.
+    THEN: The extractor should only be called by the first run and both runs should return the same features.
+    """
+    img_path, mask_path, yaml_path = cohort_files
+    patient_dict = {1: [{"ImageVolume": sitk.GetImageFromArray(np.random.rand(4, 4, 4)),
+                         "MaskVolume": sitk.GetImageFromArray(np.ones((4, 4, 4), dtype=np.uint8)),
+                         "ImagePath": img_path, "MaskPath": mask_path}]}
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+    cache = FeatureCache(str(tmp_path / "cache"), yaml_path)
+
+    first = extract_radiomic_features(patient_dict, extractor, "3D", cache=cache)
+    second = extract_radiomic_features(patient_dict, extractor, "3D", cache=cache)
+
+    assert (first == second, extractor.execute.call_count, cache.hits) == (True, 1, 1)
@@ -0,0 +1,160 @@
+import pytest
+import numpy as np
+import pandas as pd
+from feature_table import FeatureTable
+
+
+def _row(patient_id, label, value):
+    """Row of features as built by the extractors."""
+    return {"MaskLabel": label, "PatientID": patient_id, "diagnostics_Versions_PyRadiomics": "v3.1.0",
+            "diagnostics_Mask-original_BoundingBox": (1, 2, 3, 4, 5, 6), "original_firstorder_Mean": np.array(value),
+            "original_shape_Elongation": np.float64(value / 2)}
+
+
+def test_feature_table_mapping_of_rows():
+    """
+    GIVEN: Rows appended to a FeatureTable.
+    WHEN: The table is read as a mapping.
+    THEN: Each key should give back the values of its row, in the same column order.
+    """
+    table = FeatureTable()
+    table.append("PR1 - 1", _row(1, 1, 0.5))
+    table.append("PR1 - 2", _row(1, 2, 0.7))
+
+    assert list(table) == ["PR1 - 1", "PR1 - 2"]
+    assert len(table) == 2
+    assert list(table["PR1 - 2"]) == list(_row(1, 2, 0.7))
+    assert table["PR1 - 2"] == _row(1, 2, 0.7)
+    assert table.feature_names == ["original_firstorder_Mean", "original_shape_Elongation"]
+
+
+def test_feature_table_grows_past_capacity():
+    """
+    GIVEN: A FeatureTable with a capacity of 2 rows.
+    WHEN: 5 rows are appended.
+    THEN: Every row should be kept.
+    """
+    table = FeatureTable(capacity=2)
+    for label in range(1, 6):
+        table.append(f"PR1 - {label}", _row(1, label, label / 10))
+
+    np.testing.assert_array_equal(table.feature_matrix()[:, 0], [0.1, 0.2, 0.3, 0.4, 0.5])
+    assert table.feature_matrix().shape == (5, 2)
+
+
+def test_feature_table_frame_is_a_view():
+    """
+    GIVEN: A FeatureTable with rows.
+    WHEN: feature_frame is called.
+    THEN: The DataFrame should share the memory of the table and be indexed by row key.
+    """
+    table = FeatureTable()
+    table.append("PR1 - 1", _row(1, 1, 0.5))
+
+    frame = table.feature_frame()
+
+    assert np.shares_memory(frame.to_numpy(), table.feature_matrix())
+    assert frame.loc["PR1 - 1", "original_firstorder_Mean"] == 0.5
+
+
+def test_feature_table_missing_columns():
+    """
+    GIVEN: Rows that do not all have the same columns.
+    WHEN: The rows are read back.
+    THEN: Missing features should be NaN and missing diagnostics absent from the row.
+    """
+    table = FeatureTable()
+    table.append("PR1 - 1", {"PatientID": 1, "original_firstorder_Mean": np.array(0.5)})
+    table.append("PR1 - 2", {"PatientID": 1, "diagnostics_Note": "x", "original_glcm_Contrast": np.array(2.0)})
+
+    first, second = table["PR1 - 1"], table["PR1 - 2"]
+
+    assert "diagnostics_Note" not in first
+    assert np.isnan(first["original_glcm_Contrast"])
+    assert np.isnan(second["original_firstorder_Mean"])
+    assert table.columns == ["PatientID", "original_firstorder_Mean", "diagnostics_Note", "original_glcm_Contrast"]
+
+
+def test_feature_table_non_float_value_kept_exactly():
+    """
+    GIVEN: A feature column that gets a value which is not a float in a later row.
+    WHEN: The rows are read back.
+    THEN: The column should move to the diagnostics table and keep both values.
+    """
+    table = FeatureTable()
+    table.append("PR1 - 1", {"original_firstorder_Mean": np.array(0.5)})
+    table.append("PR1 - 2", {"original_firstorder_Mean": "n/a"})
+
+    assert table.feature_names == []
+    assert [row["original_firstorder_Mean"] for row in table.values()] == [0.5, "n/a"]
+
+
+def test_feature_table_extend():
+    """
+    GIVEN: A FeatureTable and a second table with an extra column.
+    WHEN: extend is called with the second table.
+    THEN: The rows of both tables should be in the first one, in order.
+    """
+    table, other = FeatureTable(), FeatureTable()
+    table.append("PR1 - 1", _row(1, 1, 0.5))
+    other.append("PR2 - 1", {**_row(2, 1, 0.9), "original_glcm_Contrast": np.array(3.0)})
+
+    table.extend(other)
+
+    assert list(table) == ["PR1 - 1", "PR2 - 1"]
+    assert table["PR2 - 1"]["original_glcm_Contrast"] == 3.0
+    assert table["PR2 - 1"]["diagnostics_Mask-original_BoundingBox"] == (1, 2, 3, 4, 5, 6)
+    assert np.isnan(table["PR1 - 1"]["original_glcm_Contrast"])
+
+
+def test_feature_table_duplicate_key():
+    """
+    GIVEN: A FeatureTable with a row.
+    WHEN: A row with the same key is appended.
+    THEN: It should raise a ValueError.
+    """
+    table = FeatureTable()
+    table.append("PR1 - 1", _row(1, 1, 0.5))
+
+    with pytest.raises(ValueError, match="Duplicate row key"):
+        table.append("PR1 - 1", _row(1, 1, 0.5))
+
+
+
+def test_feature_table_set_and_delete_rows():
+    """
+    GIVEN: A FeatureTable and a dictionary with the same three rows.
+    WHEN: A row is replaced by one with a new column and a text value, a row is deleted and a row is added by key.
+    THEN: The table should hold the same rows as the dictionary, in the same order.
+    """
+    rows = {f"PR1 - {label}": _row(1, label, label / 10) for label in (1, 2, 3)}
+    table = FeatureTable(capacity=2)
+    table.extend(rows)
+
+    for features in (rows, table):
+        features["PR1 - 2"] = {**_row(1, 2, 0.9), "original_glcm_Contrast": 2.0, "original_shape_Elongation": "n/a"}
+        del features["PR1 - 1"]
+        features["PR1 - 4"] = _row(1, 4, 0.4)
+
+    assert list(table) == list(rows) == ["PR1 - 2", "PR1 - 3", "PR1 - 4"]
+    assert table["PR1 - 2"] == rows["PR1 - 2"]
+    assert {name: value for name, value in table["PR1 - 3"].items() if name != "original_glcm_Contrast"} == rows["PR1 - 3"]
+    assert np.isnan(table["PR1 - 3"]["original_glcm_Contrast"])
+    assert table.pop("PR1 - 4")["MaskLabel"] == 4
+    assert table.to_frame("PatientID - Label")["PatientID - Label"].tolist() == ["PR1 - 2", "PR1 - 3"]
+
+def test_feature_table_to_frame_matches_dict():
+    """
+    GIVEN: The same rows in a FeatureTable and in a dictionary.
+    WHEN: to_frame is called.
+    THEN: It should have the columns and values of the transposed dictionary, with the key column first.
+    """
+    rows = {"PR1 - 1": _row(1, 1, 0.5), "PR2 - 1": _row(2, 1, 0.9)}
+    table = FeatureTable()
+    table.extend(rows)
+
+    frame = table.to_frame("PatientID - Label")
+    expected = pd.DataFrame(rows).T.rename_axis("PatientID - Label").reset_index()
+
+    assert list(frame.columns) == list(expected.columns)
+    assert frame.astype(str).equals(expected.astype(str))
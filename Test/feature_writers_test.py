@@ -0,0 +1,339 @@
+import pytest
+import numpy as np
+import pandas as pd
+from feature_writers import get_key_column, read_completed_keys, append_features_csv, features_to_frame, \
+    write_features_parquet, read_completed_keys_parquet, get_output_name, merge_shards, \
+    append_quarantine_csv, read_quarantined_keys
+
+
+@pytest.fixture
+def patient_features():
+    """Features of two 3D patients, as returned by the extractors."""
+    return [
+        {"PR1 - 1": {"MaskLabel": 1, "PatientID": 1, "Feature1": np.array(0.5)},
+         "PR1 - 2": {"MaskLabel": 2, "PatientID": 1, "Feature1": np.array(0.7)}},
+        {"PR2 - 1": {"MaskLabel": 1, "PatientID": 2, "Feature1": np.array(0.9)}},
+    ]
+
+
+def test_get_key_column_2D():
+    """
+    GIVEN: The 2D mode.
+    WHEN: get_key_column is called.
+    THEN: It should return the slice key column name.
+    """
+    assert get_key_column("2D") == "PatientID - Slice - Label"
+
+
+def test_get_key_column_invalid_mode():
+    """
+    GIVEN: An invalid mode.
+    WHEN: get_key_column is called.
+    THEN: It should raise a ValueError.
+    """
+    with pytest.raises(ValueError, match="Mode should be '2D' or '3D'"):
+        get_key_column("4D")
+
+
+def test_read_completed_keys_missing_file(tmp_path):
+    """
+    GIVEN: An output file that does not exist yet.
+    WHEN: read_completed_keys is called.
+    THEN: It should return an empty set.
+    """
+    assert read_completed_keys(str(tmp_path / "3D_Radiomic_Features.csv")) == set()
+
+
+def test_read_completed_keys_non_string_path():
+    """
+    GIVEN: A non-string output file path.
+    WHEN: read_completed_keys is called.
+    THEN: It should raise a TypeError.
+    """
+    with pytest.raises(TypeError, match="output_file must be a string"):
+        read_completed_keys(123)
+
+
+def test_append_features_csv_header_written_once(tmp_path, patient_features):
+    """
+    GIVEN: The features of two patients.
+    WHEN: append_features_csv is called once per patient.
+    THEN: The file should contain a single header followed by every row.
+    """
+    output_file = str(tmp_path / "3D_Radiomic_Features.csv")
+    for features in patient_features:
+        append_features_csv(features, output_file, "PatientID - Label")
+
+    lines = open(output_file).read().splitlines()
+
+    assert lines == ["PatientID - Label,MaskLabel,PatientID,Feature1",
+                     "PR1 - 1,1,1,0.5", "PR1 - 2,2,1,0.7", "PR2 - 1,1,2,0.9"]
+
+
+def test_append_features_csv_empty_features(tmp_path):
+    """
+    GIVEN: A patient whose extraction failed for every label.
+    WHEN: append_features_csv is called.
+    THEN: Nothing should be written.
+    """
+    output_file = str(tmp_path / "3D_Radiomic_Features.csv")
+
+    assert append_features_csv({}, output_file, "PatientID - Label") == 0
+    assert not (tmp_path / "3D_Radiomic_Features.csv").exists()
+
+
+def test_read_completed_keys_after_append(tmp_path, patient_features):
+    """
+    GIVEN: An output file written by append_features_csv.
+    WHEN: read_completed_keys is called.
+    THEN: It should return the key of every row.
+    """
+    output_file = str(tmp_path / "3D_Radiomic_Features.csv")
+    for features in patient_features:
+        append_features_csv(features, output_file, "PatientID - Label")
+
+    assert read_completed_keys(output_file) == {"PR1 - 1", "PR1 - 2", "PR2 - 1"}
+
+
+def test_read_completed_keys_drops_partial_row(tmp_path, patient_features):
+    """
+    GIVEN: An output file whose last row was cut by an interrupted run.
+    WHEN: read_completed_keys is called.
+    THEN: The partial row should be removed from the file and its key should not be returned.
+    """
+    output_file = str(tmp_path / "3D_Radiomic_Features.csv")
+    for features in patient_features:
+        append_features_csv(features, output_file, "PatientID - Label")
+    with open(output_file, "a") as f:
+        f.write("PR3 - 1,1,3")
+
+    keys = read_completed_keys(output_file)
+
+    assert keys == {"PR1 - 1", "PR1 - 2", "PR2 - 1"}
+    assert open(output_file).read().endswith("PR2 - 1,1,2,0.9\n")
+
+
+def test_features_to_frame_types(patient_features):
+    """
+    GIVEN: Features with metadata, numpy feature values and a diagnostics entry.
+    WHEN: features_to_frame is called with float32.
+    THEN: Metadata should be integers, features float32 and diagnostics strings.
+    """
+    features = {key: {**row, "diagnostics_Versions_PyRadiomics": "v3.1.0"} for key, row in patient_features[0].items()}
+
+    rows = features_to_frame(features, "PatientID - Label", "float32")
+
+    assert list(rows["PatientID - Label"]) == ["PR1 - 1", "PR1 - 2"]
+    assert str(rows["MaskLabel"].dtype) == "Int64"
+    assert rows["Feature1"].dtype == np.float32
+    assert str(rows["diagnostics_Versions_PyRadiomics"].dtype) == "string"
+
+
+def test_features_to_frame_invalid_dtype(patient_features):
+    """
+    GIVEN: An unsupported float type.
+    WHEN: features_to_frame is called.
+    THEN: It should raise a ValueError.
+    """
+    with pytest.raises(ValueError, match="float_dtype should be"):
+        features_to_frame(patient_features[0], "PatientID - Label", "int8")
+
+
+def test_write_features_parquet_per_patient(tmp_path, patient_features):
+    """
+    GIVEN: The features of two patients.
+    WHEN: write_features_parquet is called once per patient.
+    THEN: Each patient should get its own file and reading the directory should return every row.
+    """
+    pytest.importorskip("pyarrow")
+    output_dir = str(tmp_path / "3D_Radiomic_Features")
+    for pr_id, features in zip((1, 2), patient_features):
+        write_features_parquet(features, output_dir, "PatientID - Label", pr_id)
+
+    rows = pd.read_parquet(output_dir).sort_values("PatientID - Label")
+
+    assert sorted(p.name for p in (tmp_path / "3D_Radiomic_Features").iterdir()) == ["PR1-0.parquet", "PR2-0.parquet"]
+    assert list(rows["Feature1"]) == [0.5, 0.7, 0.9]
+
+
+def test_read_completed_keys_parquet_resumed_patient(tmp_path, patient_features):
+    """
+    GIVEN: A patient written by two runs.
+    WHEN: read_completed_keys_parquet is called.
+    THEN: The rows of both runs should be kept in separate parts and all their keys returned.
+    """
+    pytest.importorskip("pyarrow")
+    output_dir = str(tmp_path / "3D_Radiomic_Features")
+    write_features_parquet({"PR1 - 1": patient_features[0]["PR1 - 1"]}, output_dir, "PatientID - Label", 1)
+    write_features_parquet({"PR1 - 2": patient_features[0]["PR1 - 2"]}, output_dir, "PatientID - Label", 1)
+
+    assert read_completed_keys_parquet(output_dir, "PatientID - Label") == {"PR1 - 1", "PR1 - 2"}
+
+
+def test_get_output_name_shard():
+    """
+    GIVEN: The mode, output format and shard of a run.
+    WHEN: get_output_name is called.
+    THEN: It should return the name of the output of the shard, or of the whole cohort without a shard.
+    """
+    assert get_output_name("3D") == "3D_Radiomic_Features.csv"
+    assert get_output_name("2D", "csv", (1, 4)) == "2D_Radiomic_Features.shard-1-of-4.csv"
+    assert get_output_name("3D", "parquet", (2, 2)) == "3D_Radiomic_Features.shard-2-of-2"
+
+
+def test_merge_shards_csv_patient_order(tmp_path):
+    """
+    GIVEN: Two CSV shard outputs with interleaved patients, columns in a different order and an empty shard.
+    WHEN: merge_shards is called.
+    THEN: The rows should be merged in patient order with the columns of the first shard.
+    """
+    (tmp_path / "3D_Radiomic_Features.shard-1-of-3.csv").write_text(
+        "PatientID - Label,PatientID,Feature1\nPR1 - 1,1,0.5\nPR1 - 2,1,0.7\nPR10 - 1,10,0.1\n")
+    (tmp_path / "3D_Radiomic_Features.shard-2-of-3.csv").write_text(
+        "PatientID - Label,Feature1,PatientID\nPR2 - 1,0.9,2\n")
+    (tmp_path / "3D_Radiomic_Features.shard-3-of-3.csv").write_text("")
+
+    output, n_rows = merge_shards(str(tmp_path), "3D")
+
+    assert output == str(tmp_path / "3D_Radiomic_Features.csv")
+    assert n_rows == 4
+    assert open(output).read().splitlines() == ["PatientID - Label,PatientID,Feature1", "PR1 - 1,1,0.5",
+                                                "PR1 - 2,1,0.7", "PR2 - 1,2,0.9", "PR10 - 1,10,0.1"]
+
+
+def test_merge_shards_missing_shard(tmp_path):
+    """
+    GIVEN: The output of only one shard out of two.
+    WHEN: merge_shards is called.
+    THEN: It should raise a ValueError naming the missing shard.
+    """
+    (tmp_path / "3D_Radiomic_Features.shard-1-of-2.csv").write_text("PatientID - Label,PatientID\nPR1 - 1,1\n")
+
+    with pytest.raises(ValueError, match=r"Missing output of shards \[2\]"):
+        merge_shards(str(tmp_path), "3D")
+
+
+def test_merge_shards_different_columns(tmp_path):
+    """
+    GIVEN: Two CSV shard outputs extracted with different features.
+    WHEN: merge_shards is called.
+    THEN: It should raise a ValueError and not write the final output.
+    """
+    (tmp_path / "3D_Radiomic_Features.shard-1-of-2.csv").write_text("PatientID - Label,PatientID,Feature1\n")
+    (tmp_path / "3D_Radiomic_Features.shard-2-of-2.csv").write_text("PatientID - Label,PatientID,Feature2\n")
+
+    with pytest.raises(ValueError, match="differ from the other shards"):
+        merge_shards(str(tmp_path), "3D")
+    assert not (tmp_path / "3D_Radiomic_Features.csv").exists()
+
+
+
+def test_merge_shards_csv_existing_output(tmp_path):
+    """
+    GIVEN: Two CSV shard outputs and an existing final output.
+    WHEN: merge_shards is called.
+    THEN: It should raise a ValueError and leave the existing output unchanged.
+    """
+    (tmp_path / "3D_Radiomic_Features.shard-1-of-2.csv").write_text("PatientID - Label,PatientID\nPR1 - 1,1\n")
+    (tmp_path / "3D_Radiomic_Features.shard-2-of-2.csv").write_text("PatientID - Label,PatientID\nPR2 - 1,2\n")
+    (tmp_path / "3D_Radiomic_Features.csv").write_text("previous run\n")
+
+    with pytest.raises(ValueError, match="already exists"):
+        merge_shards(str(tmp_path), "3D")
+    assert (tmp_path / "3D_Radiomic_Features.csv").read_text() == "previous run\n"
+
+def test_merge_shards_parquet(tmp_path, patient_features):
+    """
+    GIVEN: Two Parquet shard outputs.
+    WHEN: merge_shards is called.
+    THEN: The patient files should be moved into the final directory and the shard directories removed.
+    """
+    pytest.importorskip("pyarrow")
+    for index, (pr_id, features) in enumerate(zip((1, 2), patient_features), start=1):
+        shard_dir = str(tmp_path / get_output_name("3D", "parquet", (index, 2)))
+        write_features_parquet(features, shard_dir, "PatientID - Label", pr_id)
+
+    output, n_rows = merge_shards(str(tmp_path), "3D", "parquet")
+
+    assert n_rows == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["3D_Radiomic_Features"]
+    assert list(pd.read_parquet(output).sort_values("PatientID - Label")["Feature1"]) == [0.5, 0.7, 0.9]
+
+
+
+def test_merge_shards_parquet_leftover_files(tmp_path, patient_features):
+    """
+    GIVEN: Two Parquet shard outputs, one with a partial .tmp file and then also an unexpected file.
+    WHEN: merge_shards is called.
+    THEN: The .tmp file should be deleted, and the unexpected file should stop the merge before any file is moved.
+    """
+    pytest.importorskip("pyarrow")
+    shard_dirs = [tmp_path / get_output_name("3D", "parquet", (index, 2)) for index in (1, 2)]
+    for shard_dir, pr_id, features in zip(shard_dirs, (1, 2), patient_features):
+        write_features_parquet(features, str(shard_dir), "PatientID - Label", pr_id)
+    (shard_dirs[1] / "PR3-0.parquet.tmp").write_bytes(b"partial")
+    (shard_dirs[1] / "notes.txt").write_text("")
+
+    with pytest.raises(ValueError, match="unexpected files in the shard outputs"):
+        merge_shards(str(tmp_path), "3D", "parquet")
+    assert sorted(p.name for p in shard_dirs[0].iterdir()) == ["PR1-0.parquet"]
+    assert not (tmp_path / "3D_Radiomic_Features").exists()
+
+    (shard_dirs[1] / "notes.txt").unlink()
+    output, n_rows = merge_shards(str(tmp_path), "3D", "parquet")
+
+    assert n_rows == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["3D_Radiomic_Features"]
+    assert sorted(p.name for p in (tmp_path / "3D_Radiomic_Features").iterdir()) == ["PR1-0.parquet", "PR2-0.parquet"]
+
+def test_append_features_csv_feature_table(tmp_path, patient_features):
+    """
+    GIVEN: The features of two patients, as dictionaries and as FeatureTables.
+    WHEN: append_features_csv is called once per patient with each of them.
+    THEN: Both files should be identical.
+    """
+    from feature_table import FeatureTable
+
+    dict_file, table_file = str(tmp_path / "dict.csv"), str(tmp_path / "table.csv")
+    for features in patient_features:
+        table = FeatureTable()
+        table.extend(features)
+        append_features_csv(features, dict_file, "PatientID - Label")
+        append_features_csv(table, table_file, "PatientID - Label")
+
+    assert open(table_file).read() == open(dict_file).read()
+
+
+def test_features_to_frame_feature_table(patient_features):
+    """
+    GIVEN: The features of a patient, as a dictionary and as a FeatureTable.
+    WHEN: features_to_frame is called with each of them.
+    THEN: Both DataFrames should have the same columns, types and values.
+    """
+    from feature_table import FeatureTable
+
+    table = FeatureTable()
+    table.extend(patient_features[0])
+
+    pd.testing.assert_frame_equal(features_to_frame(table, "PatientID - Label", "float32"),
+                                  features_to_frame(patient_features[0], "PatientID - Label", "float32"))
+
+
+def test_quarantine_csv_round_trip(tmp_path):
+    """
+    GIVEN: Two quarantined jobs, one stopped by the timeout and one by a worker crash.
+    WHEN: They are appended to the quarantine file and its keys are read back.
+    THEN: The file should have one header and one row per job, and both keys should be read.
+    """
+    quarantine_file = str(tmp_path / "3D_Quarantine.csv")
+    append_quarantine_csv({"Key": "PR1 - 2", "PatientID": 1, "Reason": "timeout", "Seconds": 600.5, "MemoryMB": None,
+                           "Description": "patient PR1, label 2"}, quarantine_file, "PatientID - Label")
+    append_quarantine_csv({"Key": "PR3 - 1", "PatientID": 3, "Reason": "crash", "Seconds": None, "MemoryMB": None,
+                           "Description": "patient PR3, label 1"}, quarantine_file, "PatientID - Label")
+
+    rows = pd.read_csv(quarantine_file)
+
+    assert list(rows.columns) == ["PatientID - Label", "PatientID", "Reason", "Seconds", "MemoryMB", "Description"]
+    assert list(rows["Reason"]) == ["timeout", "crash"]
+    assert read_quarantined_keys(quarantine_file) == {"PR1 - 2", "PR3 - 1"}
+    assert read_quarantined_keys(str(tmp_path / "missing.csv")) == set()
@@ -709,3 +709,548 @@ def test_read_image_and_mask_dimension_mismatch(mock_read_image_and_mask_differe
 
     with pytest.raises(ValueError, match="Image and mask dimensions do not match."):
         read_image_and_mask("image.nii", "mask.nii")
+
+
+def test_iter_patient_image_mask_is_lazy(monkeypatch, sample_data):
+    """
+    GIVEN: A valid list of images and masks with patient IDs.
+    WHEN: iter_patient_image_mask is called and only the first patient is consumed.
+    THEN: Only the first patient should have been read from disk.
+    """
+    read_paths = []
+
+    def _mock(img_path, mask_path):
+        read_paths.append(img_path)
+        return sitk.Image(3, 3, 3, sitk.sitkUInt8), sitk.Image(3, 3, 3, sitk.sitkUInt8)
+
+    monkeypatch.setattr("image_processing.read_image_and_mask", _mock)
+
+    patients = iter_patient_image_mask(**sample_data)
+    assert read_paths == [], "No patient should be read before the iteration starts."
+
+    pr_id, patient_data = next(patients)
+    assert read_paths == ["img1.nii"], f"Expected only the first patient to be read, but got {read_paths}"
+
+
+def test_iter_patient_image_mask_invalid_mode_before_reading(monkeypatch, sample_data):
+    """
+    GIVEN: An invalid mode.
+    WHEN: iter_patient_image_mask is called.
+    THEN: A ValueError should be raised before any file is read.
+    """
+    monkeypatch.setattr("image_processing.read_image_and_mask", lambda *args: pytest.fail("File read"))
+
+    with pytest.raises(ValueError, match="Mode should be '2D' or '3D'"):
+        iter_patient_image_mask(sample_data["imgs_path"], sample_data["masks_path"], sample_data["patient_ids"], "4D")
+
+
+def test_iter_patient_image_mask_matches_dict(monkeypatch, mock_read_image_and_mask, sample_data):
+    """
+    GIVEN: A valid list of images and masks with patient IDs.
+    WHEN: iter_patient_image_mask is consumed entirely.
+    THEN: It should yield the same patient IDs, in the same order, as get_patient_image_mask_dict.
+    """
+    monkeypatch.setattr("image_processing.read_image_and_mask", mock_read_image_and_mask)
+
+    streamed_ids = [pr_id for pr_id, _ in iter_patient_image_mask(**sample_data)]
+
+    assert streamed_ids == list(get_patient_image_mask_dict(**sample_data))
+
+
+def test_extract_largest_region_tie_keeps_first():
+    """
+    GIVEN: A mask with two regions of the same size for the label.
+    WHEN: The extract_largest_region function is called.
+    THEN: The first region in scan order should be returned.
+    """
+    mask = np.array([[1, 1, 0, 0],
+                     [0, 0, 0, 0],
+                     [0, 0, 1, 1]], dtype=np.uint16)
+
+    expected = np.array([[1, 1, 0, 0],
+                         [0, 0, 0, 0],
+                         [0, 0, 0, 0]], dtype=np.uint16)
+
+    assert np.array_equal(extract_largest_region(mask, 1), expected)
+
+
+def test_extract_largest_region_many_components():
+    """
+    GIVEN: A noisy mask with hundreds of components of label 2.
+    WHEN: The extract_largest_region function is called.
+    THEN: It should return the largest component only, with the label value and the mask dtype.
+    """
+    rng = np.random.default_rng(0)
+    mask = ((rng.random((128, 128)) < 0.05) * 2).astype(np.uint16)
+    mask[10:20, 10:20] = 2
+
+    largest_region = extract_largest_region(mask, 2)
+
+    assert largest_region.dtype == np.uint16 and set(np.unique(largest_region)) == {0, 2}
+    assert np.count_nonzero(largest_region) >= 100 and largest_region[15, 15] == 2
+
+
+def test_process_slice_labels_all_labels():
+    """
+    GIVEN: A mask slice with two labels.
+    WHEN: The process_slice_labels function is called.
+    THEN: It should return the largest region of each label, in increasing label order.
+    """
+    mask_slice = np.array([
+        [0, 1, 1, 0, 2, 2, 2],
+        [0, 1, 1, 0, 2, 2, 2],
+        [1, 0, 0, 0, 0, 0, 0]
+    ])
+
+    regions = process_slice_labels(mask_slice)
+
+    expected_region_mask_1 = np.array([
+        [0, 1, 1, 0, 0, 0, 0],
+        [0, 1, 1, 0, 0, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0]
+    ])
+    expected_region_mask_2 = np.array([
+        [0, 0, 0, 0, 2, 2, 2],
+        [0, 0, 0, 0, 2, 2, 2],
+        [0, 0, 0, 0, 0, 0, 0]
+    ])
+    assert [lbl for _, lbl in regions] == [1, 2]
+    assert np.array_equal(regions[0][0], expected_region_mask_1) and np.array_equal(regions[1][0], expected_region_mask_2)
+
+
+def test_process_slice_labels_empty_slice():
+    """
+    GIVEN: A mask slice with only background.
+    WHEN: The process_slice_labels function is called.
+    THEN: It should return an empty list.
+    """
+    assert process_slice_labels(np.zeros((10, 10), dtype=np.uint16)) == []
+
+
+def test_get_slices_2D_multiple_labels_per_slice():
+    """
+    GIVEN: A volume whose second slice holds two labels.
+    WHEN: The function get_slices_2D is called.
+    THEN: It should return one record per (slice, label).
+    """
+    image_array = np.random.rand(2, 4, 4)
+    mask_array = np.array([
+        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
+        [[1, 1, 0, 0], [0, 0, 0, 0], [0, 0, 2, 2], [0, 0, 2, 2]]
+    ], dtype=np.uint16)
+
+    slices = get_slices_2D(sitk.GetImageFromArray(image_array), sitk.GetImageFromArray(mask_array), 1234)
+
+    assert [(s['SliceIndex'], s['Label']) for s in slices] == [(0, 1), (1, 1), (1, 2)]
+
+
+def test_pad_bounding_box_clipped():
+    """
+    GIVEN: A bounding box touching the border of the array.
+    WHEN: The pad_bounding_box function is called.
+    THEN: The padded box should be clipped to the array.
+    """
+    box = (slice(0, 2), slice(3, 5))
+
+    assert pad_bounding_box(box, (6, 6), 2) == (slice(0, 4), slice(1, 6))
+
+
+def test_crop_to_roi_keeps_physical_position():
+    """
+    GIVEN: A 3D image with a non-default spacing and origin.
+    WHEN: The crop_to_roi function is called.
+    THEN: The cropped image should keep the spacing and its origin should be the physical position of the box start.
+    """
+    image = sitk.GetImageFromArray(np.random.rand(5, 6, 7))
+    image.SetSpacing((0.5, 0.8, 2.0))
+    image.SetOrigin((10.0, 20.0, 30.0))
+    box = (slice(1, 3), slice(2, 5), slice(3, 7))
+
+    cropped = crop_to_roi(image, box)
+
+    assert cropped.GetSize() == (4, 3, 2) and cropped.GetSpacing() == image.GetSpacing()
+    assert cropped.GetOrigin() == image.TransformIndexToPhysicalPoint((3, 2, 1))
+
+
+def test_get_volume_3D_crop_one_record_per_label():
+    """
+    GIVEN: A 3D mask with two labels and a crop padding.
+    WHEN: The get_volume_3D function is called.
+    THEN: It should return one record per label, cropped to the padded label bounding box.
+    """
+    mask_array = np.zeros((6, 10, 10), dtype=np.uint8)
+    mask_array[1:3, 1:4, 1:4] = 1
+    mask_array[4:6, 6:9, 5:9] = 2
+    image = sitk.GetImageFromArray(np.random.rand(6, 10, 10))
+    mask = sitk.GetImageFromArray(mask_array)
+
+    volumes = get_volume_3D(image, mask, 1234, crop_padding=1)
+
+    assert [v['Label'] for v in volumes] == [1, 2]
+    assert volumes[0]['ImageVolume'].GetSize() == (5, 5, 4) and volumes[1]['MaskVolume'].GetSize() == (6, 5, 3)
+
+
+def test_get_slices_2D_crop():
+    """
+    GIVEN: A volume with a small region and a crop padding.
+    WHEN: The get_slices_2D function is called.
+    THEN: The image and mask slices should be cropped to the region bounding box plus the padding.
+    """
+    image_array = np.random.rand(1, 10, 10)
+    mask_array = np.zeros((1, 10, 10), dtype=np.uint16)
+    mask_array[0, 4:6, 3:7] = 1
+
+    slices = get_slices_2D(sitk.GetImageFromArray(image_array), sitk.GetImageFromArray(mask_array), 1234,
+                           crop_padding=1)
+
+    image_crop = sitk.GetArrayFromImage(slices[0]['ImageSlice'])
+    mask_crop = sitk.GetArrayFromImage(slices[0]['MaskSlice'])
+    assert np.array_equal(image_crop, image_array[0, 3:7, 2:8]) and mask_crop.sum() == 8
+    assert slices[0]['ImageSlice'].GetOrigin() == (2.0, 3.0)
+
+
+def test_extract_slice_geometry():
+    """
+    GIVEN: A 3D image with a non-default spacing and origin.
+    WHEN: The extract_slice function is called on a box of a slice.
+    THEN: The 2D slice should have the box pixels, the in-plane spacing and the physical origin of the box.
+    """
+    image_array = np.random.rand(4, 6, 8)
+    image = sitk.GetImageFromArray(image_array)
+    image.SetSpacing((0.5, 0.7, 3.0))
+    image.SetOrigin((1.0, 2.0, 3.0))
+
+    image_slice = extract_slice(image, 2, (slice(1, 4), slice(2, 7)))
+
+    assert np.array_equal(sitk.GetArrayFromImage(image_slice), image_array[2, 1:4, 2:7])
+    assert image_slice.GetSpacing() == (0.5, 0.7)
+    assert image_slice.GetOrigin() == image.TransformIndexToPhysicalPoint((2, 1, 2))[:2]
+
+
+def test_get_slices_2D_spacing():
+    """
+    GIVEN: A volume with an anisotropic spacing.
+    WHEN: The function get_slices_2D is called.
+    THEN: The image and mask slices should carry the in-plane spacing of the volume.
+    """
+    image = sitk.GetImageFromArray(np.random.rand(3, 4, 4))
+    image.SetSpacing((0.8, 0.9, 2.5))
+    mask = sitk.GetImageFromArray(np.ones((3, 4, 4), dtype=np.uint16))
+    mask.CopyInformation(image)
+
+    slices = get_slices_2D(image, mask, 1234)
+
+    assert slices[1]['ImageSlice'].GetSpacing() == (0.8, 0.9) and slices[1]['MaskSlice'].GetSpacing() == (0.8, 0.9)
+    assert slices[1]['MaskSlice'].GetOrigin() == image.TransformIndexToPhysicalPoint((0, 0, 1))[:2]
+
+
+@pytest.fixture
+def image_mask_files(tmp_path):
+    """Image and mask files sharing the same geometry."""
+    img = sitk.GetImageFromArray(np.random.rand(4, 5, 6).astype(np.float32))
+    img.SetSpacing((0.5, 0.5, 2.0))
+    mask = sitk.GetImageFromArray(np.ones((4, 5, 6), dtype=np.uint8))
+    mask.CopyInformation(img)
+    img_path, mask_path = str(tmp_path / "PR1.nii"), str(tmp_path / "PR1_seg.nii")
+    sitk.WriteImage(img, img_path)
+    sitk.WriteImage(mask, mask_path)
+    return img_path, mask_path
+
+
+def test_read_image_header(image_mask_files):
+    """
+    GIVEN: An image file.
+    WHEN: read_image_header is called.
+    THEN: It should return the size, spacing and pixel type of the image.
+    """
+    header = read_image_header(image_mask_files[0])
+
+    assert (header["Size"], header["Spacing"], header["PixelType"]) == ((6, 5, 4), (0.5, 0.5, 2.0), "32-bit float")
+
+
+def test_check_image_mask_headers_valid(image_mask_files):
+    """
+    GIVEN: An image and a mask with the same geometry.
+    WHEN: check_image_mask_headers is called.
+    THEN: No problem should be returned.
+    """
+    assert check_image_mask_headers(*image_mask_files) == []
+
+
+def test_check_image_mask_headers_geometry_mismatch(tmp_path, image_mask_files):
+    """
+    GIVEN: A mask with another size and origin than the image.
+    WHEN: check_image_mask_headers is called.
+    THEN: Both problems should be reported.
+    """
+    mask = sitk.GetImageFromArray(np.ones((4, 5, 7), dtype=np.uint8))
+    mask.SetOrigin((10.0, 0.0, 0.0))
+    sitk.WriteImage(mask, str(tmp_path / "other_seg.nii"))
+
+    problems = check_image_mask_headers(image_mask_files[0], str(tmp_path / "other_seg.nii"))
+
+    assert len(problems) == 3
+    assert problems[0].startswith("image size (6, 5, 4) does not match")
+
+
+def test_validate_cohort_reports_every_bad_pair(tmp_path, image_mask_files):
+    """
+    GIVEN: A cohort with a valid pair, a missing mask and a corrupt image.
+    WHEN: validate_cohort is called.
+    THEN: Both invalid patients should be reported, without reading the voxel data.
+    """
+    (tmp_path / "corrupt.nii").write_bytes(b"not a nifti file")
+    img_path, mask_path = image_mask_files
+
+    invalid = validate_cohort([img_path, img_path, str(tmp_path / "corrupt.nii")],
+                              [mask_path, str(tmp_path / "missing_seg.nii"), mask_path], [1, 2, 3])
+
+    assert sorted(invalid) == [2, 3]
+    assert "cannot read the mask header" in invalid[2][0]
+
+
+def test_lesion_slice_runs():
+    """
+    GIVEN: A mask with lesions on slices 1-2 and 5.
+    WHEN: lesion_slice_runs is called.
+    THEN: It should return one run per group of consecutive slices.
+    """
+    mask_array = np.zeros((7, 4, 4), dtype=np.uint8)
+    mask_array[1:3, 1, 1] = 1
+    mask_array[5, 2, 2] = 2
+
+    assert lesion_slice_runs(sitk.GetImageFromArray(mask_array)) == [(1, 2), (5, 1)]
+
+
+def test_read_image_slab_geometry(tmp_path):
+    """
+    GIVEN: An image file with a non-zero origin.
+    WHEN: read_image_slab is called on slices 2 to 3.
+    THEN: The slab should hold the voxels of those slices and the physical position of its first slice.
+    """
+    array = np.random.rand(6, 4, 5).astype(np.float32)
+    img = sitk.GetImageFromArray(array)
+    img.SetSpacing((0.5, 0.5, 2.0))
+    img.SetOrigin((1.0, 2.0, 3.0))
+    sitk.WriteImage(img, str(tmp_path / "PR1.nii"))
+
+    slab = read_image_slab(str(tmp_path / "PR1.nii"), 2, 2)
+
+    assert np.array_equal(sitk.GetArrayFromImage(slab), array[2:4])
+    assert slab.GetOrigin() == img.TransformIndexToPhysicalPoint((0, 0, 2))
+
+
+def test_load_patient_2D_matches_full_read(tmp_path):
+    """
+    GIVEN: A patient whose lesions cover a few slices of the volume.
+    WHEN: load_patient is called in 2D mode, which reads only the lesion slabs.
+    THEN: The slice records should be the same as with the whole image.
+    """
+    array = np.random.rand(8, 6, 6).astype(np.float32)
+    mask_array = np.zeros((8, 6, 6), dtype=np.uint8)
+    mask_array[2:4, 1:3, 1:3] = 1
+    mask_array[6, 3:5, 3:5] = 2
+    img, mask = sitk.GetImageFromArray(array), sitk.GetImageFromArray(mask_array)
+    img.SetOrigin((0.0, 0.0, 10.0))
+    mask.CopyInformation(img)
+    sitk.WriteImage(img, str(tmp_path / "PR1.nii"))
+    sitk.WriteImage(mask, str(tmp_path / "PR1_seg.nii"))
+
+    records = load_patient(str(tmp_path / "PR1.nii"), str(tmp_path / "PR1_seg.nii"), 1, "2D")
+    expected = get_slices_2D(img, mask, 1)
+
+    assert [(r['SliceIndex'], r['Label']) for r in records] == [(r['SliceIndex'], r['Label']) for r in expected]
+    for record, reference in zip(records, expected):
+        assert np.array_equal(sitk.GetArrayViewFromImage(record['ImageSlice']),
+                              sitk.GetArrayViewFromImage(reference['ImageSlice']))
+        assert record['ImageSlice'].GetOrigin() == reference['ImageSlice'].GetOrigin()
+
+
+def test_slice_label_occupancy_counts_and_boxes():
+    """
+    GIVEN: A mask with two labels on slice 1 and one label on slice 3.
+    WHEN: slice_label_occupancy is called.
+    THEN: It should return one entry per (slice, label) pair with its voxel count and bounding box.
+    """
+    mask_array = np.zeros((5, 6, 6), dtype=np.uint16)
+    mask_array[1, 0:2, 1:4] = 1
+    mask_array[1, 4, 5] = 2
+    mask_array[3, 2:5, 2] = 1
+
+    occupancy = slice_label_occupancy(mask_array)
+
+    assert occupancy == [(1, 1, 6, (slice(0, 2), slice(1, 4))), (1, 2, 1, (slice(4, 5), slice(5, 6))),
+                         (3, 1, 3, (slice(2, 5), slice(2, 3)))]
+
+
+def test_slice_label_occupancy_matches_find_objects():
+    """
+    GIVEN: A random mask with several labels and background values below 1.
+    WHEN: slice_label_occupancy is called.
+    THEN: The boxes should be the ones found by find_objects on each slice.
+    """
+    rng = np.random.default_rng(0)
+    mask_array = rng.integers(-1, 4, size=(6, 8, 8)) * (rng.random((6, 8, 8)) < 0.2)
+    mask_array[2] = 0
+
+    expected = [(z, lbl, box) for z in range(mask_array.shape[0])
+                for lbl, box in enumerate(find_objects(mask_array[z]), start=1) if box is not None]
+
+    assert [(z, lbl, box) for z, lbl, _, box in slice_label_occupancy(mask_array)] == expected
+
+
+def test_slice_label_occupancy_empty_mask():
+    """
+    GIVEN: A mask without any label.
+    WHEN: slice_label_occupancy is called.
+    THEN: It should return an empty list.
+    """
+    assert slice_label_occupancy(np.zeros((3, 4, 4), dtype=np.uint8)) == []
+
+
+@pytest.mark.parametrize("crop_padding", [None, 1])
+def test_get_volume_2D_matches_get_slices_2D(crop_padding):
+    """
+    GIVEN: A mask with two labels on one slice and one label with two components on another.
+    WHEN: The slices of get_volume_2D are extracted with extract_region_slice.
+    THEN: They should be the same image and mask slices as the records of get_slices_2D.
+    """
+    mask_array = np.zeros((4, 6, 6), dtype=np.uint16)
+    mask_array[1, 0:2, 0:2] = 1
+    mask_array[1, 4:6, 4:6] = 2
+    mask_array[3, 0:3, 0] = 1
+    mask_array[3, 5, 5] = 1
+    img = sitk.GetImageFromArray(np.random.rand(4, 6, 6))
+    img.SetSpacing((0.5, 0.5, 2.0))
+    mask = sitk.GetImageFromArray(mask_array)
+    mask.CopyInformation(img)
+
+    record = get_volume_2D(img, mask, 1, crop_padding)[0]
+    expected = get_slices_2D(img, mask, 1, crop_padding)
+
+    assert [(idx, lbl) for _, idx, lbl, _ in record['SliceRegions']] == [(r['SliceIndex'], r['Label']) for r in expected]
+    for (region_label, idx, lbl, box), reference in zip(record['SliceRegions'], expected):
+        image_slice, mask_slice = extract_region_slice(img, record['RegionVolume'], region_label, lbl, idx, box,
+                                                       record['MaskDType'])
+        assert np.array_equal(sitk.GetArrayViewFromImage(image_slice), sitk.GetArrayViewFromImage(reference['ImageSlice']))
+        assert np.array_equal(sitk.GetArrayViewFromImage(mask_slice), sitk.GetArrayViewFromImage(reference['MaskSlice']))
+        assert mask_slice.GetPixelID() == reference['MaskSlice'].GetPixelID()
+        assert mask_slice.GetOrigin() == reference['MaskSlice'].GetOrigin()
+
+
+def test_get_volume_2D_empty_mask():
+    """
+    GIVEN: A mask without any label.
+    WHEN: get_volume_2D is called.
+    THEN: It should return an empty list.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(3, 4, 4))
+    mask = sitk.GetImageFromArray(np.zeros((3, 4, 4), dtype=np.uint8))
+
+    assert get_volume_2D(img, mask, 1) == []
+
+
+def test_iter_patient_image_mask_invalid_slice_engine(sample_data):
+    """
+    GIVEN: An unknown 2D slice engine.
+    WHEN: iter_patient_image_mask is called.
+    THEN: A ValueError should be raised before any file is read.
+    """
+    with pytest.raises(ValueError, match="slice_engine should be"):
+        iter_patient_image_mask(sample_data["imgs_path"], sample_data["masks_path"], sample_data["patient_ids"], "2D",
+                                slice_engine="stack")
+
+
+def test_prefetch_patients_keeps_order():
+    """
+    GIVEN: A stream of patients.
+    WHEN: prefetch_patients is consumed entirely.
+    THEN: It should yield the same patients in the same order.
+    """
+    patients = [(pr_id, [f"record {pr_id}"]) for pr_id in range(1, 6)]
+
+    assert list(prefetch_patients(iter(patients), depth=2)) == patients
+
+
+def test_prefetch_patients_bounded():
+    """
+    GIVEN: A stream of 10 patients and a prefetch depth of 1.
+    WHEN: Only the first patient is consumed.
+    THEN: At most the consumed patient, the queued one and the one waiting to be queued should have been loaded.
+    """
+    import time
+
+    loaded = []
+
+    def _patients():
+        for pr_id in range(1, 11):
+            loaded.append(pr_id)
+            yield pr_id, []
+
+    patients = prefetch_patients(_patients(), depth=1)
+    assert next(patients)[0] == 1
+    time.sleep(0.3)
+
+    assert loaded == [1, 2, 3]
+    patients.close()
+
+
+def test_prefetch_patients_error_after_previous_patients():
+    """
+    GIVEN: A stream of patients whose third patient cannot be loaded.
+    WHEN: prefetch_patients is consumed.
+    THEN: The first two patients should be yielded before the loading error is raised.
+    """
+    def _patients():
+        yield 1, []
+        yield 2, []
+        raise ValueError("Image and mask dimensions do not match.")
+
+    patients = prefetch_patients(_patients(), depth=4)
+
+    assert [next(patients)[0], next(patients)[0]] == [1, 2]
+    with pytest.raises(ValueError, match="dimensions do not match"):
+        next(patients)
+
+
+@pytest.mark.parametrize("depth", [-1, 1.5, True])
+def test_prefetch_patients_invalid_depth(depth):
+    """
+    GIVEN: An invalid prefetch depth.
+    WHEN: prefetch_patients is called.
+    THEN: It should raise a ValueError.
+    """
+    with pytest.raises(ValueError, match="prefetch depth"):
+        prefetch_patients([], depth)
+
+
+def test_check_image_mask_headers_geometry_tolerance(tmp_path, image_mask_files):
+    """
+    GIVEN: A mask whose origin is 1e-4 mm away from the image origin.
+    WHEN: check_image_mask_headers is called with the default tolerance, a geometryTolerance of 1e-3 and
+          without the geometry check.
+    THEN: Only the default tolerance should report the origin.
+    """
+    mask = sitk.ReadImage(image_mask_files[1])
+    mask.SetOrigin((1e-4, 0.0, 0.0))
+    sitk.WriteImage(mask, str(tmp_path / "shifted_seg.nii"))
+
+    assert len(check_image_mask_headers(image_mask_files[0], str(tmp_path / "shifted_seg.nii"))) == 1
+    assert check_image_mask_headers(image_mask_files[0], str(tmp_path / "shifted_seg.nii"), tolerance=1e-3) == []
+    assert check_image_mask_headers(image_mask_files[0], str(tmp_path / "shifted_seg.nii"), check_geometry=False) == []
+
+
+def test_check_image_mask_headers_float_mask(tmp_path, image_mask_files):
+    """
+    GIVEN: Masks with a floating point pixel type, one with whole number labels and one with a fractional value.
+    WHEN: check_image_mask_headers is called.
+    THEN: Only the mask with a fractional value should be reported.
+    """
+    mask = sitk.Cast(sitk.ReadImage(image_mask_files[1]), sitk.sitkFloat32)
+    sitk.WriteImage(mask, str(tmp_path / "float_seg.nii"))
+    mask[0, 0, 0] = 0.5
+    sitk.WriteImage(mask, str(tmp_path / "fraction_seg.nii"))
+
+    assert check_image_mask_headers(image_mask_files[0], str(tmp_path / "float_seg.nii")) == []
+    assert check_image_mask_headers(image_mask_files[0], str(tmp_path / "fraction_seg.nii")) == [
+        "mask values must be whole number labels, got other values in a 32-bit float mask"]
@@ -0,0 +1,140 @@
+import os
+import subprocess
+import sys
+from main import parse_args, load_config
+
+
+def test_load_config_command_line_overrides(tmp_path):
+    """
+    GIVEN: A configuration file and command line options for some of its keys.
+    WHEN: load_config is called.
+    THEN: The options should override the file, the other keys keep their value.
+    """
+    config_file = tmp_path / "config.ini"
+    config_file.write_text("[paths]\ndata_path = ./data/*\noutput_path = ./out/\n\n"
+                           "[settings]\nmode = 2D\nn_workers = 1\n")
+
+    config = load_config(parse_args(["--config", str(config_file), "--mode", "3D", "--n-workers", "4"]))
+
+    assert config["settings"]["mode"] == "3D"
+    assert config["settings"].getint("n_workers") == 4
+    assert config["paths"]["data_path"] == "./data/*"
+
+
+def test_load_config_without_file(tmp_path):
+    """
+    GIVEN: A configuration file that does not exist and every required key on the command line.
+    WHEN: load_config is called.
+    THEN: The sections should be created from the command line options.
+    """
+    args = parse_args(["--config", str(tmp_path / "missing.ini"), "--data-path", "./data", "--output-path", "./out",
+                       "--mode", "3D", "--extractor-config", "params.yaml", "--shard", "1/2"])
+
+    config = load_config(args)
+
+    assert config["paths"]["output_path"] == "./out"
+    assert config["settings"]["shard"] == "1/2"
+
+
+def test_main_module_imports_no_heavy_dependency():
+    """
+    GIVEN: A new interpreter.
+    WHEN: The main module is imported.
+    THEN: Neither pandas, SimpleITK nor pyradiomics should be imported.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main; print(sorted({'pandas', 'SimpleITK', 'radiomics'} & set(sys.modules)))"
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=package_dir, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
+
+
+def _write_cohort(data_path, fractional_masks=(), large_lesions=(), n_patients=2):
+    """Cohort of 3D patients, the masks of the given patients have a fractional value or a large lesion."""
+    import numpy as np
+    import SimpleITK as sitk
+
+    for pr_id in range(1, n_patients + 1):
+        folder = data_path / f"Patient_{pr_id}"
+        folder.mkdir(parents=True)
+        shape = (16, 32, 32) if pr_id in large_lesions else (4, 8, 8)
+        mask_array = np.zeros(shape, dtype=np.float32)
+        mask_array[1:-1, 2:-2, 2:-2] = 1
+        if pr_id in fractional_masks:
+            mask_array[0, 0, 0] = 0.5
+        img = sitk.GetImageFromArray(np.random.rand(*shape) * 100)
+        mask = sitk.GetImageFromArray(mask_array)
+        mask.CopyInformation(img)
+        sitk.WriteImage(img, str(folder / f"PR{pr_id}.nii"))
+        sitk.WriteImage(mask, str(folder / f"PR{pr_id}_seg.nii"))
+
+
+def _run_main(tmp_path, *args):
+    from main import main
+
+    (tmp_path / "params.yaml").write_text("imageType:\n  Original: {}\nfeatureClass:\n  firstorder:\n")
+    return main(["--config", str(tmp_path / "missing.ini"), "--data-path", str(tmp_path / "data" / "*"),
+                 "--output-path", str(tmp_path / "out"), "--mode", "3D", "--extractor-config",
+                 str(tmp_path / "params.yaml"), "--cache", "false", "--manifest", "false", *args])
+
+
+def test_main_skips_invalid_patients(tmp_path):
+    """
+    GIVEN: A cohort with float masks, one of whole number labels and one with a fractional value.
+    WHEN: main is run.
+    THEN: The valid patient should be extracted and the invalid one listed in the run report.
+    """
+    import json
+
+    _write_cohort(tmp_path / "data", fractional_masks={2})
+
+    status = _run_main(tmp_path)
+
+    with open(tmp_path / "out" / "3D_Run_Report.json") as f:
+        report = json.load(f)
+    assert status == 0
+    assert [line.split(",")[0] for line in open(tmp_path / "out" / "3D_Radiomic_Features.csv")][1:] == ["PR1 - 1"]
+    assert report["invalid_patients"] == {
+        "2": ["mask values must be whole number labels, got other values in a 32-bit float mask"]}
+
+
+def test_main_shard_of_invalid_patients(tmp_path):
+    """
+    GIVEN: A cohort whose patients are all invalid, extracted as a single shard.
+    WHEN: main is run, then run again to merge the shards.
+    THEN: The empty shard output and the run report with the invalid patients should be written, and merged.
+    """
+    import json
+
+    _write_cohort(tmp_path / "data", fractional_masks={1, 2})
+
+    status = _run_main(tmp_path, "--shard", "1/1")
+
+    with open(tmp_path / "out" / "3D_Run_Report.shard-1-of-1.json") as f:
+        report = json.load(f)
+    assert status == 0
+    assert (tmp_path / "out" / "3D_Radiomic_Features.shard-1-of-1.csv").read_text() == ""
+    assert sorted(report["invalid_patients"]) == ["1", "2"]
+    assert _run_main(tmp_path, "--merge") == 0
+    assert (tmp_path / "out" / "3D_Radiomic_Features.csv").read_text() == ""
+
+
+def test_main_prioritizes_late_large_lesion(tmp_path):
+    """
+    GIVEN: A cohort whose last patient has a much larger lesion than the others.
+    WHEN: main is run with two workers.
+    THEN: The masks should be estimated first, and the rows still be written in patient order.
+    """
+    import json
+
+    _write_cohort(tmp_path / "data", large_lesions={4}, n_patients=4)
+
+    status = _run_main(tmp_path, "--n-workers", "2", "--validate", "false")
+
+    with open(tmp_path / "out" / "3D_Run_Report.json") as f:
+        report = json.load(f)
+    assert status == 0
+    assert [line.split(",")[0] for line in open(tmp_path / "out" / "3D_Radiomic_Features.csv")][1:] == [
+        "PR1 - 1", "PR2 - 1", "PR3 - 1", "PR4 - 1"]
+    assert "cost_estimate" in report["stages"]
@@ -1,4 +1,6 @@
 import logging
+import os
+import time
 import pytest
 from radiomics import featureextractor
 from radiomics_2d_3d_extractors import *
@@ -350,3 +352,545 @@ def test_extract_radiomic_features_extractor_not_configured():
     extractor = UnconfiguredExtractor()
     with pytest.raises(ValueError, match="Extractor is not configured properly. Ensure it has the necessary methods."):
         extract_radiomic_features(patient_dict, extractor, mode="3D")
+
+
+def test_extract_radiomic_features_n_workers_not_int():
+    """
+    GIVEN a non-integer n_workers
+    WHEN extract_radiomic_features is called
+    THEN it should raise a TypeError.
+    """
+    extractor = Mock()
+    with pytest.raises(TypeError, match="n_workers must be an integer."):
+        extract_radiomic_features({}, extractor, mode="3D", n_workers="2")
+
+
+def test_extract_radiomic_features_n_workers_zero():
+    """
+    GIVEN n_workers equal to 0
+    WHEN extract_radiomic_features is called
+    THEN it should raise a ValueError.
+    """
+    extractor = Mock()
+    with pytest.raises(ValueError, match="n_workers must be at least 1."):
+        extract_radiomic_features({}, extractor, mode="3D", n_workers=0)
+
+
+def test_extract_radiomic_features_n_workers_without_yaml():
+    """
+    GIVEN n_workers greater than 1 and no yaml_path
+    WHEN extract_radiomic_features is called
+    THEN it should raise a ValueError, since every worker builds its own extractor from the YAML file.
+    """
+    extractor = Mock()
+    with pytest.raises(ValueError, match="yaml_path is required when n_workers is greater than 1."):
+        extract_radiomic_features({}, extractor, mode="3D", n_workers=2)
+
+
+@pytest.fixture
+def yaml_config(tmp_path):
+    """Small pyradiomics configuration file with first order and shape features."""
+    yaml_path = tmp_path / "pyradiomics_config.yaml"
+    yaml_path.write_text("imageType:\n  Original: {}\nfeatureClass:\n  firstorder:\n  shape:\n")
+    return str(yaml_path)
+
+
+@pytest.fixture
+def patient_dict_two_labels():
+    """3D patient dictionary with two patients, each with two labelled lesions."""
+    rng = np.random.default_rng(0)
+    patient_dict = {}
+    for pr_id in (1, 2):
+        mask_array = np.zeros((8, 16, 16), dtype=np.uint8)
+        mask_array[1:4, 2:8, 2:8] = 1
+        mask_array[4:7, 9:14, 9:14] = 2
+        img = sitk.GetImageFromArray(rng.random((8, 16, 16)) * 100)
+        img.SetSpacing((0.7, 0.7, 2.5))
+        img.SetOrigin((-10.0, 5.0, 2.0))
+        mask = sitk.GetImageFromArray(mask_array)
+        mask.CopyInformation(img)
+        patient_dict[pr_id] = [{"ImageVolume": img, "MaskVolume": mask}]
+    return patient_dict
+
+
+def test_extract_radiomic_features_parallel_matches_sequential(yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a patient dictionary with several patients and labels
+    WHEN extract_radiomic_features is called with one and with two workers
+    THEN the two runs should produce the same CSV output, byte for byte.
+    """
+    import pandas as pd
+
+    extractor = get_extractor(yaml_config)
+    sequential = extract_radiomic_features(patient_dict_two_labels, extractor, "3D")
+    parallel = extract_radiomic_features(patient_dict_two_labels, extractor, "3D", n_workers=2, yaml_path=yaml_config)
+
+    assert pd.DataFrame(parallel).T.to_csv() == pd.DataFrame(sequential).T.to_csv()
+
+
+def test_iter_radiomic_features_one_patient_at_a_time():
+    """
+    GIVEN a generator of 2D patients
+    WHEN iter_radiomic_features is consumed
+    THEN it should yield the features of each patient separately, in patient order.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(10, 10))
+    mask = sitk.GetImageFromArray(np.full((10, 10), fill_value=1, dtype=np.uint16))
+    patients = ((pr_id, [{"ImageSlice": img, "MaskSlice": mask, "Label": 1, "SliceIndex": 0}]) for pr_id in (1, 2))
+
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+
+    results = list(iter_radiomic_features(patients, extractor, mode="2D"))
+
+    assert [(pr_id, list(features)) for pr_id, features in results] == [(1, ["1-0-1"]), (2, ["2-0-1"])]
+
+
+def test_iter_radiomic_features_parallel_matches_sequential(yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a stream of 3D patients
+    WHEN iter_radiomic_features is consumed with one and with two workers
+    THEN both runs should yield the same patients with the same features.
+    """
+    import pandas as pd
+
+    extractor = get_extractor(yaml_config)
+    sequential = list(iter_radiomic_features(iter(patient_dict_two_labels.items()), extractor, "3D"))
+    parallel = list(iter_radiomic_features(iter(patient_dict_two_labels.items()), extractor, "3D",
+                                           n_workers=2, yaml_path=yaml_config))
+
+    assert [pr_id for pr_id, _ in parallel] == [pr_id for pr_id, _ in sequential]
+    assert all(pd.DataFrame(p).T.to_csv() == pd.DataFrame(s).T.to_csv() for (_, p), (_, s) in zip(parallel, sequential))
+
+
+def test_iter_radiomic_features_skip_keys():
+    """
+    GIVEN a 3D patient with two labels, one of which was already extracted by a previous run
+    WHEN iter_radiomic_features is called with the completed key in skip_keys
+    THEN only the missing label should be extracted.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(4, 10, 10))
+    mask_array = np.zeros((4, 10, 10), dtype=np.uint16)
+    mask_array[0:2] = 1
+    mask_array[2:4] = 2
+    patients = [(1, [{"ImageVolume": img, "MaskVolume": sitk.GetImageFromArray(mask_array)}])]
+
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+
+    results = list(iter_radiomic_features(patients, extractor, mode="3D", skip_keys={"PR1 - 1"}))
+
+    assert list(results[0][1]) == ["PR1 - 2"] and extractor.execute.call_count == 1
+
+
+def test_radiomic_extractor_3D_cropped_volumes():
+    """
+    GIVEN a patient with one cropped volume per label
+    WHEN radiomic_extractor_3D is called
+    THEN it should extract each volume once, with its own label.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(4, 4, 4))
+    mask = sitk.GetImageFromArray(np.full((4, 4, 4), fill_value=3, dtype=np.uint16))
+    patient_dict_3D = {1: [{"ImageVolume": img, "MaskVolume": mask, "Label": 3}]}
+
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+
+    result = radiomic_extractor_3D(patient_dict_3D, extractor)
+
+    assert list(result) == ["PR1 - 3"] and extractor.execute.call_args.kwargs["label"] == 3
+
+
+def test_radiomic_extractor_3D_parallel_labels_share_volume(yaml_config):
+    """
+    GIVEN a single patient with many labels in one volume
+    WHEN radiomic_extractor_3D is called with several workers
+    THEN every label should be extracted concurrently from the shared volume, with the same features
+        (including the spacing-dependent ones) as the sequential extraction.
+    """
+    import pandas as pd
+
+    mask_array = np.zeros((6, 24, 24), dtype=np.uint8)
+    for lbl in range(1, 10):
+        row, col = divmod(lbl - 1, 3)
+        mask_array[1:5, 1 + 8 * row:6 + 8 * row, 1 + 8 * col:6 + 8 * col] = lbl
+    img = sitk.GetImageFromArray(np.random.default_rng(1).random((6, 24, 24)) * 100)
+    img.SetSpacing((0.5, 0.5, 3.0))
+    mask = sitk.GetImageFromArray(mask_array)
+    mask.CopyInformation(img)
+    patient_dict_3D = {1: [{"ImageVolume": img, "MaskVolume": mask}]}
+
+    extractor = get_extractor(yaml_config)
+    sequential = radiomic_extractor_3D(patient_dict_3D, extractor)
+    parallel = radiomic_extractor_3D(patient_dict_3D, extractor, n_workers=3, yaml_path=yaml_config)
+
+    assert len(parallel) == 9
+    assert pd.DataFrame(parallel).T.to_csv() == pd.DataFrame(sequential).T.to_csv()
+
+
+def test_radiomic_extractor_3D_records_extraction_time():
+    """
+    GIVEN a valid patient_dict_3D and extractor
+    WHEN radiomic_extractor_3D is called
+    THEN the extraction of each label should be recorded in the run timings.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(4, 4, 4))
+    mask = sitk.GetImageFromArray(np.full((4, 4, 4), fill_value=1, dtype=np.uint16))
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5, "diagnostics_Mask-original_VoxelNum": 64}
+    utils.reset_stage_records()
+
+    radiomic_extractor_3D({7: [{"ImageVolume": img, "MaskVolume": mask}]}, extractor)
+
+    records = [r for r in utils.get_stage_records() if r["Stage"] == "extraction"]
+    utils.reset_stage_records()
+    assert [(r["PatientID"], r["Key"], r["Voxels"]) for r in records] == [(7, "PR7 - 1", 64)]
+
+
+@pytest.fixture
+def filtered_yaml_config(tmp_path):
+    """pyradiomics configuration file with Wavelet and LoG filtered images."""
+    yaml_path = tmp_path / "pyradiomics_filters.yaml"
+    yaml_path.write_text("setting:\n  sigma: [1.0]\nimageType:\n  Original: {}\n  Wavelet: {}\n  LoG: {}\n"
+                         "featureClass:\n  firstorder:\n")
+    return str(yaml_path)
+
+
+def test_shared_filter_extractor_matches_pyradiomics(filtered_yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a patient with two labels and a configuration with Wavelet and LoG images
+    WHEN its features are extracted with and without sharing the filtered images
+    THEN both extractions should give the same features.
+    """
+    shared = radiomic_extractor_3D(patient_dict_two_labels, get_extractor(filtered_yaml_config))
+    reference = radiomic_extractor_3D(patient_dict_two_labels, get_extractor(filtered_yaml_config, False))
+
+    assert shared.keys() == reference.keys()
+    assert all(str(shared[key][name]) == str(reference[key][name]) for key in reference for name in reference[key])
+
+
+def test_shared_filter_extractor_filters_once_per_image(filtered_yaml_config, patient_dict_two_labels, monkeypatch):
+    """
+    GIVEN two patients with two labels each
+    WHEN radiomic_extractor_3D is called with a SharedFilterExtractor
+    THEN the wavelet decomposition should be computed once per patient instead of once per label.
+    """
+    from radiomics import imageoperations
+
+    calls = []
+    get_wavelet_image = imageoperations.getWaveletImage
+    monkeypatch.setattr(imageoperations, "getWaveletImage",
+                        lambda *args, **kwargs: calls.append(1) or get_wavelet_image(*args, **kwargs))
+
+    radiomic_extractor_3D(patient_dict_two_labels, get_extractor(filtered_yaml_config))
+
+    assert len(calls) == 2
+
+
+def test_shared_filter_extractor_released_after_each_patient(filtered_yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a stream of patients with two labels each
+    WHEN iter_radiomic_features extracts them sequentially with a SharedFilterExtractor
+    THEN the filtered images of a patient should be released once its labels are extracted.
+    """
+    extractor = get_extractor(filtered_yaml_config)
+    held = [extractor._shared_images for _ in iter_radiomic_features(iter(patient_dict_two_labels.items()),
+                                                                     extractor, "3D")]
+
+    assert held == [None, None]
+
+
+def test_shared_filter_extractor_resampling_not_shared(tmp_path, patient_dict_two_labels):
+    """
+    GIVEN a configuration that resamples the images around each label
+    WHEN SharedFilterExtractor checks whether it can share the filtered images
+    THEN it should not, as pyradiomics filters a different image for each label.
+    """
+    yaml_path = tmp_path / "pyradiomics_resampled.yaml"
+    yaml_path.write_text("setting:\n  resampledPixelSpacing: [1, 1, 1]\nimageType:\n  Original: {}\n"
+                         "featureClass:\n  firstorder:\n")
+
+    assert not get_extractor(str(yaml_path))._can_share()
+
+
+def test_radiomic_extractor_2D_volume_engine_matches_slices(yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a patient prepared for 2D extraction by get_slices_2D and by get_volume_2D
+    WHEN radiomic_extractor_2D is called on both
+    THEN the features should be the same, under the same keys.
+    """
+    from image_processing import get_slices_2D, get_volume_2D
+
+    volume = patient_dict_two_labels[1][0]
+    extractor = get_extractor(yaml_config)
+    slices = radiomic_extractor_2D({1: get_slices_2D(volume["ImageVolume"], volume["MaskVolume"], 1)}, extractor)
+    shared = radiomic_extractor_2D({1: get_volume_2D(volume["ImageVolume"], volume["MaskVolume"], 1)}, extractor)
+
+    assert list(shared) == list(slices)
+    assert str(dict(shared.items())) == str(dict(slices.items()))
+
+
+def test_get_extractor_memoized(yaml_config, monkeypatch):
+    """
+    GIVEN a configuration file
+    WHEN get_extractor is called several times
+    THEN the file should be parsed once and each call should get its own copy.
+    """
+    import radiomics_2d_3d_extractors
+
+    monkeypatch.setattr(radiomics_2d_3d_extractors, "_extractors", {})
+    parsed = []
+    apply_params = featureextractor.RadiomicsFeatureExtractor._applyParams
+    monkeypatch.setattr(featureextractor.RadiomicsFeatureExtractor, "_applyParams",
+                        lambda self, *args, **kwargs: parsed.append(1) or apply_params(self, *args, **kwargs))
+
+    first, second = get_extractor(yaml_config), get_extractor(yaml_config)
+    first.settings["binWidth"] = 5
+
+    assert len(parsed) == 1
+    assert first is not second
+    assert "binWidth" not in second.settings
+    assert second.enabledFeatures == first.enabledFeatures
+
+
+def test_get_extractor_file_changed(yaml_config):
+    """
+    GIVEN a configuration file modified after an extractor was built from it
+    WHEN get_extractor is called again
+    THEN the new extractor should have the new configuration.
+    """
+    get_extractor(yaml_config)
+    with open(yaml_config, "a") as f:
+        f.write("setting:\n  binWidth: 10\n")
+
+    assert get_extractor(yaml_config).settings["binWidth"] == 10
+
+
+def test_get_extractor_settings_overrides(yaml_config):
+    """
+    GIVEN a configuration file
+    WHEN get_extractor is called with and without settings overrides
+    THEN each call should get the settings it asked for.
+    """
+    overridden = get_extractor(yaml_config, settings={"binWidth": 5})
+    default = get_extractor(yaml_config)
+
+    assert overridden.settings["binWidth"] == 5
+    assert "binWidth" not in default.settings
+
+
+def test_init_worker_warms_up_extractor(yaml_config):
+    """
+    GIVEN a configuration file
+    WHEN a pool worker is initialized
+    THEN its extractor should be built and run once, without keeping the filtered images of the phantom.
+    """
+    import radiomics_2d_3d_extractors
+
+    radiomics_2d_3d_extractors._init_worker(yaml_config)
+    extractor = radiomics_2d_3d_extractors._worker_extractor
+
+    assert isinstance(extractor, SharedFilterExtractor)
+    assert extractor._shared_images is None
+
+
+def test_iter_radiomic_features_job_timeout_quarantine(yaml_config, patient_dict_two_labels, monkeypatch):
+    """
+    GIVEN a stream of 3D patients whose second patient never finishes its extraction
+    WHEN iter_radiomic_features is consumed with a job timeout
+    THEN the jobs of the second patient should be quarantined and the first patient extracted.
+    """
+    import radiomics_2d_3d_extractors
+
+    execute_job = radiomics_2d_3d_extractors._execute_job
+
+    def _hanging_execute_job(extractor, job):
+        if job["Metadata"]["PatientID"] == 2:
+            time.sleep(60)
+        return execute_job(extractor, job)
+
+    # Pool workers are forked, so they run the patched function
+    monkeypatch.setattr(radiomics_2d_3d_extractors, "_execute_job", _hanging_execute_job)
+    quarantined = []
+    extractor = get_extractor(yaml_config)
+
+    results = dict(iter_radiomic_features(iter(patient_dict_two_labels.items()), extractor, "3D", n_workers=2,
+                                          yaml_path=yaml_config, job_timeout=2, quarantine=quarantined.append))
+
+    assert list(results[1]) == ["PR1 - 1", "PR1 - 2"]
+    assert list(results[2]) == []
+    assert sorted(record["Key"] for record in quarantined) == ["PR2 - 1", "PR2 - 2"]
+    assert all(record["Reason"] == "timeout" and record["Seconds"] > 2 for record in quarantined)
+
+
+def test_iter_radiomic_features_invalid_job_limit():
+    """
+    GIVEN a job timeout that is not positive
+    WHEN iter_radiomic_features is called
+    THEN it should raise a ValueError.
+    """
+    extractor = Mock()
+
+    with pytest.raises(ValueError, match="job_timeout must be positive."):
+        iter_radiomic_features(iter([]), extractor, "3D", yaml_path="params.yaml", job_timeout=0)
+
+
+def test_estimate_job_costs_from_roi_and_image_types():
+    """
+    GIVEN a 3D patient with a small and a large lesion
+    WHEN the cost of its jobs is estimated with one and with ten derived images
+    THEN each job should cost the image, its bounding box and its ROI voxels, once per derived image.
+    """
+    import radiomics_2d_3d_extractors as extractors
+
+    mask_array = np.zeros((8, 16, 16), dtype=np.uint8)
+    mask_array[1:3, 2:4, 2:4] = 1
+    mask_array[4:8, 8:12, 8:12] = 2
+    mask_array[4, 8, 8] = 0
+    img = sitk.GetImageFromArray(np.random.rand(8, 16, 16))
+    mask = sitk.GetImageFromArray(mask_array)
+    jobs = extractors._get_jobs_3D(1, [{"ImageVolume": img, "MaskVolume": mask}])
+    small = 2048 + extractors._BOX_VOXEL_WEIGHT * 8 + extractors._ROI_VOXEL_WEIGHT * 8
+    large = 2048 + extractors._BOX_VOXEL_WEIGHT * 64 + extractors._ROI_VOXEL_WEIGHT * 63
+
+    costs = extractors._estimate_job_costs(jobs, 1)
+
+    assert costs == [extractors._JOB_BASE_COST + small, extractors._JOB_BASE_COST + large]
+    assert extractors._estimate_job_costs(jobs, 10) == [extractors._JOB_BASE_COST + 10 * small,
+                                                         extractors._JOB_BASE_COST + 10 * large]
+
+
+def test_count_derived_images(filtered_yaml_config):
+    """
+    GIVEN an extractor with the Original, Wavelet and LoG (one sigma) image types
+    WHEN the derived images are counted
+    THEN it should count the original image, 8 wavelet decompositions and 1 LoG image.
+    """
+    import radiomics_2d_3d_extractors
+
+    assert radiomics_2d_3d_extractors._count_derived_images(get_extractor(filtered_yaml_config)) == 10
+
+
+def test_supervised_pool_runs_largest_jobs_first(yaml_config, monkeypatch):
+    """
+    GIVEN a pool with one worker and jobs of various estimated costs
+    WHEN the jobs are submitted faster than they run
+    THEN the jobs that could not be handed to the worker at once should run largest cost first.
+    """
+    import radiomics_2d_3d_extractors
+
+    # Pool workers are forked, so they run the patched function, which returns its start time
+    monkeypatch.setattr(radiomics_2d_3d_extractors, "_execute_job",
+                        lambda extractor, job: (time.sleep(0.05) or time.perf_counter(), None, None, None, None))
+    image = sitk.Image(2, 2, sitk.sitkUInt8)
+
+    with radiomics_2d_3d_extractors._SupervisedPool(1, yaml_config) as pool:
+        pool_jobs = [pool.submit({"Key": f"PR1 - {i}", "Image": image, "Mask": image}, cost)
+                     for i, cost in enumerate([1, 2, 10, 30, 20])]
+        starts = [pool.result(pool_job)[0] for pool_job in pool_jobs]
+
+    # The worker and the executor queue get the first two jobs as soon as they are submitted
+    assert sorted(range(5), key=starts.__getitem__) == [0, 1, 3, 4, 2]
+
+
+def test_iter_radiomic_features_job_memory_limit_large_parent(yaml_config, patient_dict_two_labels):
+    """
+    GIVEN a parent process holding much more memory than the job memory limit
+    WHEN iter_radiomic_features is consumed with that limit
+    THEN the small jobs should not be quarantined, the memory the workers share with the parent is not theirs.
+    """
+    ballast = np.ones(300 * 1024 * 1024 // 8)
+    quarantined = []
+    extractor = get_extractor(yaml_config)
+
+    results = dict(iter_radiomic_features(iter(patient_dict_two_labels.items()), extractor, "3D", n_workers=2,
+                                          yaml_path=yaml_config, job_memory_mb=100, quarantine=quarantined.append))
+
+    assert quarantined == []
+    assert list(results[2]) == ["PR2 - 1", "PR2 - 2"]
+    del ballast
+
+
+def test_supervised_pool_job_memory_limit_shared_volume(yaml_config, monkeypatch):
+    """
+    GIVEN two jobs sharing a 100 MB volume, passed to the workers in shared memory, and which allocate nothing
+    WHEN they run in a pool with a job memory limit of 40 MB
+    THEN no job should be quarantined, rebuilding the shared volume in a worker is not the memory of its job.
+    """
+    import radiomics_2d_3d_extractors
+
+    # Pool workers are forked, so they run the patched function, which lasts several watchdog intervals
+    monkeypatch.setattr(radiomics_2d_3d_extractors, "_execute_job",
+                        lambda extractor, job: (time.sleep(0.5), 0.5, None, None, os.getpid()))
+    image = sitk.GetImageFromArray(np.ones((200, 256, 256)))
+    jobs = [{"Key": f"PR1 - {lbl}", "Description": f"patient PR1, label {lbl}", "Metadata": {"PatientID": 1},
+             "Image": image, "Mask": image} for lbl in (1, 2)]
+    shared_blocks = radiomics_2d_3d_extractors._share_job_volumes(jobs)
+    quarantined = []
+
+    try:
+        with radiomics_2d_3d_extractors._SupervisedPool(1, yaml_config, job_memory_mb=40,
+                                                        on_quarantine=quarantined.append) as pool:
+            outcomes = [pool.result(pool.submit(job)) for job in jobs]
+    finally:
+        radiomics_2d_3d_extractors._release_shared(shared_blocks)
+
+    assert quarantined == []
+    assert [outcome[1] for outcome in outcomes] == [0.5, 0.5]
+
+
+def test_estimate_patient_costs_from_masks(tmp_path, yaml_config, patient_dict_two_labels):
+    """
+    GIVEN the masks of 3D patients, saved to files
+    WHEN the patient costs are estimated from the masks alone
+    THEN each patient should cost the sum and the largest of the estimates of its jobs, in 3D and in 2D.
+    """
+    import radiomics_2d_3d_extractors as extractors
+
+    extractor = get_extractor(yaml_config)
+    masks_path = []
+    for pr_id, patient_data in patient_dict_two_labels.items():
+        masks_path.append(str(tmp_path / f"PR{pr_id}_seg.nii"))
+        sitk.WriteImage(patient_data[0]["MaskVolume"], masks_path[-1])
+    jobs = extractors._get_jobs_3D(1, patient_dict_two_labels[1])
+    job_costs = extractors._estimate_job_costs(jobs, 1)
+
+    costs_3D = estimate_patient_costs(masks_path, [1, 2], extractor, "3D")
+    costs_2D = estimate_patient_costs(masks_path, [1, 2], extractor, "2D")
+
+    assert costs_3D == {1: (sum(job_costs), max(job_costs)), 2: (sum(job_costs), max(job_costs))}
+    # Three slices of 36 voxels, then three of 25 voxels
+    assert costs_2D[1] == (3 * extractors._job_cost(1, 36, 36, 36) + 3 * extractors._job_cost(1, 25, 25, 25),
+                           extractors._job_cost(1, 36, 36, 36))
+
+
+def test_prioritize_patients_moves_late_large_lesion():
+    """
+    GIVEN a cohort whose last patient has a job larger than the rest of the cohort
+    WHEN the patients are prioritized for one and for two workers
+    THEN only with two workers should the last patient be extracted first.
+    """
+    costs = {1: (10, 5), 2: (10, 5), 3: (10, 5), 4: (100, 100)}
+
+    assert prioritize_patients([1, 2, 3, 4], costs, 2) == [4]
+    assert prioritize_patients([1, 2, 3, 4], costs, 1) == []
+    assert prioritize_patients([4, 1, 2, 3], costs, 2) == []
+
+
+def test_iter_radiomic_features_patient_order():
+    """
+    GIVEN 2D patients read with the last one first
+    WHEN iter_radiomic_features is consumed with the patient order of the output
+    THEN it should yield the features in that order.
+    """
+    img = sitk.GetImageFromArray(np.random.rand(10, 10))
+    mask = sitk.GetImageFromArray(np.full((10, 10), fill_value=1, dtype=np.uint16))
+    patients = ((pr_id, [{"ImageSlice": img, "MaskSlice": mask, "Label": 1, "SliceIndex": 0}]) for pr_id in (3, 1, 2))
+
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+
+    results = list(iter_radiomic_features(patients, extractor, mode="2D", patient_order=[1, 2, 3]))
+
+    assert [(pr_id, list(features)) for pr_id, features in results] == [(1, ["1-0-1"]), (2, ["2-0-1"]),
+                                                                         (3, ["3-0-1"])]
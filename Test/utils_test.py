@@ -1,6 +1,9 @@
+import os
 import pytest
 import SimpleITK as sitk
 from utils import get_path_images_masks, extract_id, new_patient_id, assign_patient_ids
+from utils import timed_stage, record_stage, get_stage_records, reset_stage_records, summarize_stage_records, \
+    write_run_report, discover_cohort, parse_shard, shard_of, select_shard
 
 
 @pytest.fixture
@@ -453,3 +456,283 @@ def test_assign_patient_ids_invalid_id_format():
 
     # Assert new patient IDs are assigned correctly
     assert patient_ids == {1, 2}, f" Expected new patient IDs {1, 2}, but got {patient_ids} "
+
+
+@pytest.fixture
+def clean_stage_records():
+    """Start and end each test with no timing record."""
+    reset_stage_records()
+    yield
+    reset_stage_records()
+
+
+def test_timed_stage_records_stage(clean_stage_records):
+    """
+    GIVEN: A stage run inside timed_stage, which sets its voxel count.
+    WHEN: The stage ends.
+    THEN: One record with the stage name, the patient ID and the voxel count should be stored.
+    """
+    with timed_stage("read", patient_id=3) as stage:
+        stage["Voxels"] = 27
+
+    records = get_stage_records()
+
+    assert len(records) == 1
+    assert (records[0]["Stage"], records[0]["PatientID"], records[0]["Voxels"]) == ("read", 3, 27)
+    assert records[0]["Seconds"] >= 0
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="The peak memory is tracked from /proc")
+def test_timed_stage_records_peak_memory_of_the_stage(clean_stage_records):
+    """
+    GIVEN: A process that already reached a high peak memory, and a stage that allocates and frees 100 MB.
+    WHEN: The stage ends.
+    THEN: The record should have the 100 MB peak of the stage, and the peak of the process should be kept.
+    """
+    import numpy as np
+    from utils import peak_memory_mb
+
+    np.ones(50 * 2 ** 20).sum()
+    with timed_stage("preprocess", patient_id=1):
+        np.ones(100 * 2 ** 17).sum()
+
+    record = get_stage_records()[0]
+
+    assert 90 < record["MemoryMB"] < 150
+    assert record["PeakMemoryMB"] < peak_memory_mb() - 200
+
+
+def test_stop_peak_tracking_equal_trackers():
+    """
+    GIVEN: Two running peak trackers holding the same values, as trackers of two threads can.
+    WHEN: The second one is stopped, then the first one.
+    THEN: Each stop should remove its own tracker.
+    """
+    import utils
+
+    first = utils.start_peak_tracking()
+    second = utils.start_peak_tracking()
+    if first is None:
+        pytest.skip("The memory cannot be measured on this platform")
+    second.update(first)
+
+    utils.stop_peak_tracking(second)
+
+    assert any(tracker is first for tracker in utils._peak_trackers)
+    utils.stop_peak_tracking(first)
+    assert not any(tracker is first for tracker in utils._peak_trackers)
+
+
+def test_timed_stage_records_failed_stage(clean_stage_records):
+    """
+    GIVEN: A stage that raises an exception.
+    WHEN: The stage is run inside timed_stage.
+    THEN: The exception should propagate and the stage should still be recorded.
+    """
+    with pytest.raises(ValueError):
+        with timed_stage("read", patient_id=1):
+            raise ValueError("corrupt file")
+
+    assert [r["Stage"] for r in get_stage_records()] == ["read"]
+
+
+def test_summarize_stage_records(clean_stage_records):
+    """
+    GIVEN: Records of several stages and patients.
+    WHEN: summarize_stage_records is called.
+    THEN: It should aggregate the time per stage and per patient.
+    """
+    record_stage("extraction", 2.0, patient_id=1, voxels=10, memory=100.0, peak_memory=900.0)
+    record_stage("extraction", 4.0, patient_id=2, voxels=30, memory=150.0, peak_memory=700.0)
+    record_stage("read", 1.0, patient_id=1)
+
+    summary = summarize_stage_records(get_stage_records())
+
+    assert summary["stages"]["extraction"]["total_seconds"] == 6.0
+    assert summary["stages"]["extraction"]["mean_seconds"] == 3.0
+    assert summary["stages"]["extraction"]["voxels"] == 40
+    assert summary["stages"]["extraction"]["max_memory_mb"] == 150.0
+    assert summary["stages"]["read"]["max_memory_mb"] is None
+    assert summary["peak_memory_mb"] == 900.0
+    assert summary["patients"]["1"] == {"extraction": 2.0, "read": 1.0}
+
+
+def test_summarize_cost_estimates(clean_stage_records):
+    """
+    GIVEN: Extraction records whose time is proportional to their estimated cost, and a record without estimate.
+    WHEN: summarize_stage_records is called.
+    THEN: The cost model should fit the seconds per cost unit with a correlation of 1.
+    """
+    record_stage("extraction", 2.0, patient_id=1, key="PR1 - 1", estimated_cost=1000)
+    record_stage("extraction", 6.0, patient_id=1, key="PR1 - 2", estimated_cost=3000)
+    record_stage("read", 1.0, patient_id=1)
+
+    cost_model = summarize_stage_records(get_stage_records())["cost_model"]
+
+    assert cost_model["jobs"] == 2
+    assert cost_model["seconds_per_unit"] == pytest.approx(0.002)
+    assert cost_model["correlation"] == pytest.approx(1.0)
+
+
+def test_write_run_report(tmp_path, clean_stage_records):
+    """
+    GIVEN: Timing records of a run.
+    WHEN: write_run_report is called.
+    THEN: It should write a JSON summary and a CSV with one row per record next to the features file.
+    """
+    import json
+
+    record_stage("read", 1.0, patient_id=1)
+    record_stage("extraction", 2.0, patient_id=1, key="PR1 - 1")
+
+    json_path, csv_path = write_run_report(str(tmp_path), "3D", 3.5)
+
+    with open(json_path) as f:
+        report = json.load(f)
+    assert json_path.endswith("3D_Run_Report.json") and report["total_seconds"] == 3.5
+    assert len(open(csv_path).read().splitlines()) == 3
+
+
+def _write_patient(folder, *names):
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (folder / name).write_bytes(b"nii")
+
+
+def test_discover_cohort_pairs_by_stem(tmp_path):
+    """
+    GIVEN: Patient folders with images and masks, listed in no particular order.
+    WHEN: discover_cohort is called on the data directory.
+    THEN: Each image should be paired with its own mask and the patients should be sorted by ID.
+    """
+    _write_patient(tmp_path / "Patient_10", "PR10.nii", "PR10_seg.nii")
+    _write_patient(tmp_path / "Patient_2", "PR2_seg.nii", "PR2.nii", "PR3.nii", "PR3_seg.nii")
+
+    images_path, masks_path, patient_ids = discover_cohort(str(tmp_path))
+
+    assert patient_ids == [2, 3, 10]
+    assert [os.path.basename(p) for p in masks_path] == ["PR2_seg.nii", "PR3_seg.nii", "PR10_seg.nii"]
+    assert [os.path.basename(p) for p in images_path] == ["PR2.nii", "PR3.nii", "PR10.nii"]
+
+
+def test_discover_cohort_single_pair_per_folder(tmp_path):
+    """
+    GIVEN: A patient folder whose image and mask names do not share a stem.
+    WHEN: discover_cohort is called.
+    THEN: The only image and mask of the folder should be paired.
+    """
+    _write_patient(tmp_path / "Patient_4", "PR4_T2W_TSE_AX.nii", "mask_seg.nii")
+
+    images_path, masks_path, patient_ids = discover_cohort(str(tmp_path))
+
+    assert (patient_ids, os.path.basename(masks_path[0])) == ([4], "mask_seg.nii")
+
+
+def test_discover_cohort_duplicate_and_missing_ids(tmp_path):
+    """
+    GIVEN: Two images with the same ID and one image without ID.
+    WHEN: discover_cohort is called.
+    THEN: The IDs found in the names should be kept once and new IDs should not collide with them.
+    """
+    _write_patient(tmp_path / "a", "PR1.nii", "PR1_seg.nii")
+    _write_patient(tmp_path / "b", "PR1.nii", "PR1_seg.nii")
+    _write_patient(tmp_path / "c", "image.nii", "image_seg.nii")
+
+    _, _, patient_ids = discover_cohort(str(tmp_path))
+
+    assert patient_ids == [1, 2, 3]
+
+
+def test_discover_cohort_no_pairs(tmp_path):
+    """
+    GIVEN: A directory with an image but no mask.
+    WHEN: discover_cohort is called.
+    THEN: A ValueError should be raised.
+    """
+    _write_patient(tmp_path / "Patient_1", "PR1.nii")
+
+    with pytest.raises(ValueError, match="no .nii image and mask pairs"):
+        discover_cohort(str(tmp_path))
+
+
+def test_discover_cohort_manifest_refresh(tmp_path):
+    """
+    GIVEN: A cohort discovered with a manifest, then a patient folder added.
+    WHEN: discover_cohort is called again with the same manifest.
+    THEN: The new patient should be found and recorded in the manifest.
+    """
+    import json
+
+    data_path, manifest_path = tmp_path / "data", str(tmp_path / "manifest.json")
+    _write_patient(data_path / "Patient_1", "PR1.nii", "PR1_seg.nii")
+    assert discover_cohort(str(data_path), manifest_path)[2] == [1]
+
+    _write_patient(data_path / "Patient_2", "PR2.nii", "PR2_seg.nii")
+    _, _, patient_ids = discover_cohort(str(data_path), manifest_path)
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    assert patient_ids == [1, 2]
+    assert [p["PatientID"] for p in manifest["patients"]] == [1, 2]
+    assert manifest["directories"][str(data_path / "Patient_2")]["files"]["PR2.nii"][0] == 3
+
+
+def test_discover_cohort_manifest_reused(tmp_path, monkeypatch):
+    """
+    GIVEN: A cohort discovered with a manifest and left unchanged.
+    WHEN: discover_cohort is called again.
+    THEN: No directory should be listed again.
+    """
+    import utils
+
+    data_path, manifest_path = tmp_path / "data", str(tmp_path / "manifest.json")
+    _write_patient(data_path / "Patient_1", "PR1.nii", "PR1_seg.nii")
+    discover_cohort(str(data_path), manifest_path)
+
+    scanned = []
+    scan_directory = utils._scan_directory
+    monkeypatch.setattr(utils, "_scan_directory", lambda path: scanned.append(path) or scan_directory(path))
+
+    assert discover_cohort(str(data_path), manifest_path)[2] == [1]
+    assert scanned == []
+
+
+def test_parse_shard_valid():
+    """
+    GIVEN: A shard specification 'i/N'.
+    WHEN: parse_shard is called.
+    THEN: It should return the shard index and the number of shards.
+    """
+    assert parse_shard("2/4") == (2, 4)
+    assert parse_shard(" 1 / 1 ") == (1, 1)
+
+
+@pytest.mark.parametrize("spec", ["0/4", "5/4", "2", "a/b", "1/4/2"])
+def test_parse_shard_invalid(spec):
+    """
+    GIVEN: An invalid shard specification.
+    WHEN: parse_shard is called.
+    THEN: It should raise a ValueError.
+    """
+    with pytest.raises(ValueError, match="Invalid shard"):
+        parse_shard(spec)
+
+
+def test_select_shard_partition():
+    """
+    GIVEN: The patients of a cohort split into 3 shards.
+    WHEN: select_shard is called for every shard.
+    THEN: Each patient should be in exactly one shard, the one given by shard_of, with its own paths.
+    """
+    patient_ids = list(range(1, 31))
+    images_path = [f"PR{pr_id}.nii" for pr_id in patient_ids]
+    masks_path = [f"PR{pr_id}_seg.nii" for pr_id in patient_ids]
+
+    shards = [select_shard(images_path, masks_path, patient_ids, index, 3) for index in (1, 2, 3)]
+
+    assert sorted(pr_id for _, _, ids in shards for pr_id in ids) == patient_ids
+    for index, (images, masks, ids) in enumerate(shards, start=1):
+        assert ids == sorted(ids)
+        assert all(shard_of(pr_id, 3) == index for pr_id in ids)
+        assert images == [f"PR{pr_id}.nii" for pr_id in ids]
+        assert masks == [f"PR{pr_id}_seg.nii" for pr_id in ids]
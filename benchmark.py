@@ -0,0 +1,336 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import label
+import utils
+from image_processing import extract_largest_region, get_slices_2D, get_patient_image_mask_dict
+from radiomics_2d_3d_extractors import get_extractor, extract_radiomic_features
+
+# Small feature set, so that the suite measures the pipeline rather than the heaviest feature classes
+DEFAULT_BENCHMARK_YAML = """\
+setting:
+  binWidth: 25
+featureClass:
+  firstorder:
+  shape:
+"""
+
+
+def _extract_largest_region_per_component(mask_slice, label_value):
+    """
+    Previous implementation of extract_largest_region, which scans the whole slice once per component.
+    Kept as the reference of benchmark_largest_region.
+    """
+    labeled_region, num_labels = label(mask_slice == label_value)
+
+    largest_region = None
+    largest_area = 0
+    for region_id in range(1, num_labels + 1):
+        region = (labeled_region == region_id).astype(mask_slice.dtype) * label_value
+        region_area = np.sum(region > 0)
+        if region_area > largest_area:
+            largest_area = region_area
+            largest_region = region
+
+    return largest_region
+
+
+def make_noisy_mask(size=512, density=0.05, seed=0):
+    """
+    Create a 2D mask made of many small isolated components of label 1.
+
+    :param size: Number of rows and columns of the mask.
+    :param density: Fraction of the pixels set to 1.
+    :param seed: Seed of the random generator.
+    :return: 2D numpy array of dtype uint16.
+    """
+    rng = np.random.default_rng(seed)
+    return (rng.random((size, size)) < density).astype(np.uint16)
+
+
+def _best_time(function, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_largest_region(size=512, density=0.05, repeat=5):
+    """
+    Compare extract_largest_region with the per-component implementation on a noisy mask.
+
+    :param size: Number of rows and columns of the mask.
+    :param density: Fraction of the pixels set to 1, which drives the number of components.
+    :param repeat: Number of timed runs, the best one is kept.
+    :return: Dictionary with the number of components, the timings in seconds and the speedup.
+    """
+    mask_slice = make_noisy_mask(size, density)
+    _, num_components = label(mask_slice == 1)
+
+    if not np.array_equal(extract_largest_region(mask_slice, 1), _extract_largest_region_per_component(mask_slice, 1)):
+        raise AssertionError("extract_largest_region differs from the reference implementation")
+
+    reference = _best_time(_extract_largest_region_per_component, mask_slice, 1, repeat=repeat)
+    vectorized = _best_time(extract_largest_region, mask_slice, 1, repeat=repeat)
+
+    return {"components": int(num_components), "per_component_s": reference,
+            "single_pass_s": vectorized, "speedup": reference / vectorized}
+
+
+def make_phantom(n_slices=32, size=128, n_labels=2, lesion_radius=8, seed=0):
+    """
+    Create a synthetic image and mask with spherical lesions.
+
+    The lesions are brighter than the noisy background and each one gets its own label, from 1 to n_labels.
+
+    :param n_slices: Number of axial slices.
+    :param size: Number of rows and columns of each slice.
+    :param n_labels: Number of lesions, one label per lesion.
+    :param lesion_radius: Radius of the lesions, in voxels.
+    :param seed: Seed of the random generator.
+    :return: Tuple with the image (float32) and mask (uint16) numpy arrays, of shape (n_slices, size, size).
+    :raises ValueError: If a lesion does not fit in the volume.
+    """
+    if 2 * lesion_radius + 1 > min(n_slices, size):
+        raise ValueError("lesion_radius is too large for the volume")
+
+    rng = np.random.default_rng(seed)
+    image = rng.normal(100, 20, (n_slices, size, size)).astype(np.float32)
+    mask = np.zeros((n_slices, size, size), dtype=np.uint16)
+
+    z, y, x = np.ogrid[:n_slices, :size, :size]
+    for lbl in range(1, n_labels + 1):
+        center = [rng.integers(lesion_radius, dim - lesion_radius) for dim in (n_slices, size, size)]
+        sphere = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 <= lesion_radius ** 2
+        mask[sphere] = lbl
+        image[sphere] += rng.normal(150, 30)
+
+    return image, mask
+
+
+def write_synthetic_cohort(data_path, n_patients=4, n_slices=32, size=128, n_labels=2, lesion_radius=8, seed=0):
+    """
+    Write a cohort of synthetic patients as 'PR<id>.nii' images and 'PR<id>_seg.nii' masks.
+
+    :param data_path: Directory the files are written to, created if needed.
+    :param n_patients: Number of patients.
+    :param n_slices: Number of axial slices of each volume.
+    :param size: Number of rows and columns of each slice.
+    :param n_labels: Number of lesions per patient.
+    :param lesion_radius: Radius of the lesions, in voxels.
+    :param seed: Seed of the random generator, patient i uses seed + i.
+    :return: Tuple with the lists of image and mask paths.
+    """
+    os.makedirs(data_path, exist_ok=True)
+    images_path, masks_path = [], []
+    for pr_id in range(1, n_patients + 1):
+        image, mask = make_phantom(n_slices, size, n_labels, lesion_radius, seed + pr_id)
+        for array, path, paths in ((image, f"PR{pr_id}.nii", images_path), (mask, f"PR{pr_id}_seg.nii", masks_path)):
+            volume = sitk.GetImageFromArray(array)
+            volume.SetSpacing((0.8, 0.8, 2.0))
+            sitk.WriteImage(volume, os.path.join(data_path, path))
+            paths.append(os.path.join(data_path, path))
+
+    return images_path, masks_path
+
+
+def benchmark_get_slices_2D(n_slices=32, size=128, n_labels=2, lesion_radius=8, repeat=5):
+    """
+    Time get_slices_2D on a synthetic volume.
+
+    :param n_slices: Number of axial slices.
+    :param size: Number of rows and columns of each slice.
+    :param n_labels: Number of lesions.
+    :param lesion_radius: Radius of the lesions, in voxels.
+    :param repeat: Number of timed runs, the best one is kept.
+    :return: Dictionary with the number of slice records, the best time in seconds and the slices per second.
+    """
+    image, mask = make_phantom(n_slices, size, n_labels, lesion_radius)
+    image, mask = sitk.GetImageFromArray(image), sitk.GetImageFromArray(mask)
+
+    n_records = len(get_slices_2D(image, mask, 1))
+    seconds = _best_time(get_slices_2D, image, mask, 1, repeat=repeat)
+
+    return {"records": n_records, "seconds": seconds, "slices_per_s": n_slices / seconds}
+
+
+def benchmark_pipeline(data_path, mode, yaml_path, n_workers=1):
+    """
+    Run the get_patient_image_mask_dict -> extract_radiomic_features pipeline on a cohort and measure its throughput.
+
+    Only the axial slices holding a lesion are counted, as the other slices are skipped in 2D and cost little in 3D.
+    The peak memory is the one of the current process since it started, and the workers peak memory the largest
+    peak recorded by the extraction jobs of the workers: run it in a fresh process (see run_suite) to measure a
+    single pipeline.
+
+    :param data_path: Directory with the images and masks of the cohort.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param yaml_path: Path to the pyradiomics YAML configuration.
+    :param n_workers: Number of extraction processes.
+    :return: Dictionary with the loading and extraction times, the patients, lesion slices and rows per second, the
+             number of rows, and the peak memory of the process and of its largest worker in megabytes.
+    """
+    utils.reset_stage_records()
+    images_path, masks_path, patient_ids = utils.discover_cohort(data_path)
+    n_lesion_slices = 0
+    for path in masks_path:
+        mask = sitk.GetArrayFromImage(sitk.ReadImage(path))
+        n_lesion_slices += int(np.count_nonzero(mask.reshape(len(mask), -1).any(axis=1)))
+    extractor = get_extractor(yaml_path)
+
+    start = time.perf_counter()
+    patient_dict = get_patient_image_mask_dict(images_path, masks_path, patient_ids, mode)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features = extract_radiomic_features(patient_dict, extractor, mode, n_workers, yaml_path)
+    extraction_seconds = time.perf_counter() - start
+
+    total = load_seconds + extraction_seconds
+    workers_peaks = [record["PeakMemoryMB"] for record in utils.get_stage_records()
+                     if record["Worker"] != os.getpid() and record["PeakMemoryMB"] is not None]
+    return {"patients": len(images_path), "lesion_slices": n_lesion_slices, "rows": len(features),
+            "load_s": load_seconds, "extraction_s": extraction_seconds, "total_s": total,
+            "patients_per_s": len(images_path) / total, "lesion_slices_per_s": n_lesion_slices / total,
+            "rows_per_s": len(features) / total, "peak_memory_mb": utils.peak_memory_mb(),
+            "workers_peak_memory_mb": max(workers_peaks) if workers_peaks else None}
+
+
+def _run_in_fresh_process(function, *args):
+    """
+    Call a function in a new spawned process, so that its peak memory is not the one of an earlier benchmark.
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def run_suite(n_patients=4, n_slices=32, size=128, n_labels=2, lesion_radius=8, n_workers=1, yaml_path=None):
+    """
+    Run every benchmark on a synthetic cohort generated in a temporary directory.
+
+    Each pipeline runs in its own fresh process, so that its peak memory is measured alone.
+
+    :param n_patients: Number of patients of the cohort.
+    :param n_slices: Number of axial slices of each volume.
+    :param size: Number of rows and columns of each slice.
+    :param n_labels: Number of lesions per patient.
+    :param lesion_radius: Radius of the lesions, in voxels.
+    :param n_workers: Number of extraction processes.
+    :param yaml_path: Path to the pyradiomics YAML configuration. Defaults to first order and shape features.
+    :return: Dictionary with the cohort parameters and the results of each benchmark.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if yaml_path is None:
+            yaml_path = os.path.join(tmp_dir, "benchmark.yaml")
+            with open(yaml_path, "w") as f:
+                f.write(DEFAULT_BENCHMARK_YAML)
+
+        data_path = os.path.join(tmp_dir, "data")
+        write_synthetic_cohort(data_path, n_patients, n_slices, size, n_labels, lesion_radius)
+
+        results = {
+            "cohort": {"patients": n_patients, "slices": n_slices, "size": size, "labels": n_labels,
+                       "lesion_radius": lesion_radius, "n_workers": n_workers},
+            "largest_region": benchmark_largest_region(size),
+            "get_slices_2D": benchmark_get_slices_2D(n_slices, size, n_labels, lesion_radius),
+        }
+        for mode in ("2D", "3D"):
+            results[f"pipeline_{mode}"] = _run_in_fresh_process(benchmark_pipeline, data_path, mode, yaml_path,
+                                                                n_workers)
+
+    return results
+
+
+# Metrics compared against the baseline, as (benchmark, metric, whether higher is better) tuples
+_COMPARED_METRICS = [("largest_region", "single_pass_s", False), ("get_slices_2D", "seconds", False)] + [
+    (f"pipeline_{mode}", metric, higher_is_better) for mode in ("2D", "3D")
+    for metric, higher_is_better in (("load_s", False), ("extraction_s", False), ("rows_per_s", True),
+                                     ("peak_memory_mb", False), ("workers_peak_memory_mb", False))]
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Find the timings, throughputs and peak memories that got worse than the baseline.
+
+    Metrics missing from the baseline or the results (e.g. the workers peak memory of a run with one worker) are
+    not compared.
+
+    :param results: Results of run_suite.
+    :param baseline: Results of a previous run_suite, on the same cohort parameters.
+    :param tolerance: Relative change allowed before a metric is reported, e.g. 0.2 for 20% slower, 20% fewer rows
+                      per second or 20% more memory.
+    :return: List of (benchmark, metric, baseline value, current value) tuples for the regressions.
+    :raises ValueError: If the baseline was measured on different cohort parameters.
+    """
+    if baseline.get("cohort") != results["cohort"]:
+        raise ValueError("The baseline was measured on a different cohort, run with the same parameters")
+
+    regressions = []
+    for benchmark, metric, higher_is_better in _COMPARED_METRICS:
+        before = baseline.get(benchmark, {}).get(metric)
+        after = results.get(benchmark, {}).get(metric)
+        if not before or after is None:
+            continue
+        if (after * (1 + tolerance) < before) if higher_is_better else (after > before * (1 + tolerance)):
+            regressions.append((benchmark, metric, before, after))
+    return regressions
+
+
+def _format_metric(metric, value):
+    if metric.endswith("_per_s"):
+        return f"{value:.1f}/s"
+    if metric.endswith("_mb"):
+        return f"{value:.0f} MB"
+    return f"{value * 1e3:.2f} ms"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the radiomics pipeline on a synthetic cohort")
+    parser.add_argument("--patients", type=int, default=4)
+    parser.add_argument("--slices", type=int, default=32)
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--labels", type=int, default=2)
+    parser.add_argument("--lesion-radius", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--config", help="pyradiomics YAML configuration (default: first order and shape)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="JSON baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    for density in (0.001, 0.01, 0.05):
+        result = benchmark_largest_region(density=density)
+        print(f"extract_largest_region, 512x512 slice, {result['components']} components: "
+              f"{result['per_component_s'] * 1e3:.2f} ms -> {result['single_pass_s'] * 1e3:.2f} ms "
+              f"({result['speedup']:.0f}x)")
+
+    results = run_suite(args.patients, args.slices, args.size, args.labels, args.lesion_radius, args.workers,
+                        args.config)
+    print(f"get_slices_2D: {results['get_slices_2D']['slices_per_s']:.0f} slices/s")
+    for mode in ("2D", "3D"):
+        result = results[f"pipeline_{mode}"]
+        print(f"Pipeline {mode}: {result['patients_per_s']:.2f} patients/s, "
+              f"{result['lesion_slices_per_s']:.1f} lesion slices/s, "
+              f"{result['rows']} rows, peak memory {result['peak_memory_mb']} MB"
+              + (f", {result['workers_peak_memory_mb']} MB per worker" if result["workers_peak_memory_mb"] else ""))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved in {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for benchmark, metric, before, after in regressions:
+            print(f"Regression in {benchmark} {metric}: {_format_metric(metric, before)} -> "
+                  f"{_format_metric(metric, after)}")
+        if not regressions:
+            print(f"No regression against {args.baseline}")
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import pickle
+from collections import OrderedDict
+import radiomics
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 digest of a file content.
+
+    :param path: Path to the file.
+    :param chunk_size: Number of bytes read at a time.
+    :return: Hexadecimal digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk, content-addressed cache of the features extracted by pyradiomics.
+
+    An entry is keyed on the content of the image file, the mask file and the YAML configuration,
+    on the label, the slice index and the extraction mode, so it stays valid as long as none of
+    them changes, whatever the patient folder or patient ID. The total size of the entries is
+    capped; the least recently used ones are evicted first.
+
+    Only the features of successful jobs are stored. A job whose extraction fails, or that is quarantined
+    by job_timeout or job_memory_mb, gets no entry and is extracted again by every later run, since its
+    failure may not happen again (e.g. a worker short of memory). A resumed run still skips the quarantined
+    jobs listed in the quarantine file.
+    """
+
+    _DIGESTS_FILE = "file_digests.json"
+
+    def __init__(self, cache_dir, yaml_path, max_size_mb=1024):
+        """
+        :param cache_dir: Directory holding the cache entries, created if needed.
+        :param yaml_path: Path to the YAML file used for the extraction.
+        :param max_size_mb: Maximum total size of the entries, in megabytes.
+        :raises TypeError: If cache_dir or yaml_path is not a string.
+        :raises ValueError: If max_size_mb is not positive.
+        """
+        if not isinstance(cache_dir, str) or not isinstance(yaml_path, str):
+            raise TypeError("cache_dir and yaml_path must be strings")
+        if max_size_mb <= 0:
+            raise ValueError("max_size_mb must be positive")
+
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Features depend on the pyradiomics version as much as on the configuration
+        self._config_digest = f"{file_digest(yaml_path)}-{radiomics.__version__}"
+        self._file_digests = self._load_file_digests()
+
+        # Entries from the least to the most recently used, with their size
+        self._entries = OrderedDict()
+        self.size = 0
+        entries = []
+        for subdir in os.scandir(cache_dir):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith(".pkl"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def _load_file_digests(self):
+        """
+        Load the digests of the files hashed by previous runs.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, self._DIGESTS_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _digest(self, path):
+        """
+        Get the digest of a file, reusing the one of a previous run if the file did not change.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._file_digests.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        digest = file_digest(path)
+        self._file_digests[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pkl")
+
+    def job_key(self, job):
+        """
+        Compute the cache key of an extraction job.
+
+        :param job: Extraction job, whose 'Source' holds the image and mask paths, the mode, the slice index
+                    and the crop padding.
+        :return: Hexadecimal key, or None if the job does not come from image and mask files.
+        """
+        source = job.get("Source") or {}
+        if not source.get("ImagePath") or not source.get("MaskPath"):
+            return None
+
+        parts = [self._digest(source["ImagePath"]), self._digest(source["MaskPath"]), str(int(job["Label"])),
+                 str(source.get("SliceIndex")), source.get("Mode", ""), self._config_digest]
+        # Cropped images may give different features (e.g. with filters), uncropped keys are left unchanged
+        if source.get("CropPadding") is not None:
+            parts.append(f"crop{source['CropPadding']}")
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Get the features stored under a key.
+
+        :param key: Cache key from job_key.
+        :return: Features dictionary, or None on a cache miss.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                features = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # Entry removed or corrupted outside of the cache: extract again
+            self.size -= self._entries.pop(key)
+            self.misses += 1
+            return None
+
+        os.utime(path)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return features
+
+    def put(self, key, features):
+        """
+        Store the features extracted for a key, evicting the least recently used entries above the size cap.
+
+        :param key: Cache key from job_key.
+        :param features: Features dictionary returned by pyradiomics.
+        """
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        self.size -= self._entries.pop(key, 0)
+        self._entries[key] = os.path.getsize(path)
+        self.size += self._entries[key]
+
+        while self.size > self.max_size and self._entries:
+            old_key, old_size = self._entries.popitem(last=False)
+            self.size -= old_size
+            try:
+                os.remove(self._entry_path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        """
+        Save the file digests, so that unchanged files are not hashed again by the next run.
+        """
+        tmp_path = os.path.join(self.cache_dir, f"{self._DIGESTS_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._file_digests, f)
+        os.replace(tmp_path, os.path.join(self.cache_dir, self._DIGESTS_FILE))
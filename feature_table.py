@@ -0,0 +1,295 @@
+from collections.abc import MutableMapping
+from operator import attrgetter, itemgetter
+import numpy as np
+
+# Value of the diagnostics and metadata cells a row does not have
+_MISSING = object()
+
+# Types of the feature values, pyradiomics returns float64 scalars and 0-d arrays
+_FLOAT_TYPES = {float, np.float64}
+_NUMPY_FLOAT_TYPES = {np.float64, np.ndarray}
+_FLOAT64 = {np.dtype(np.float64)}
+_get_dtype = attrgetter("dtype")
+
+
+def _is_feature_value(name, value):
+    """
+    Check whether a value is stored in the float matrix: float64 features, not the pyradiomics diagnostics.
+    """
+    if name.startswith("diagnostics_"):
+        return False
+    if isinstance(value, float):
+        return True
+    return isinstance(value, np.ndarray) and value.dtype == np.float64 and value.size == 1
+
+
+class FeatureTable(MutableMapping):
+    """
+    Compact store of the rows of extracted features.
+
+    Feature values are appended to a growable float64 matrix, with one column per feature name; the
+    column of a name is fixed when it is first seen. The diagnostics, metadata and any non-float value
+    are kept in a separate table of per-column lists. Compared to one dictionary of numpy scalars per
+    row, a row of 1500 features takes 12 kB instead of about 200 kB and the matrix is handed to
+    pandas without a copy.
+
+    The table is a mapping from each row key to the dictionary of its values, so it can be used wherever
+    the dictionary of rows was: setting a key appends or replaces its row, deleting it removes the row.
+    Features a row does not have are NaN.
+    """
+
+    def __init__(self, capacity=64):
+        """
+        :param capacity: Number of rows allocated up front, the matrix doubles when it is full.
+        :raises ValueError: If capacity is not positive.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+
+        self._keys = []
+        self._rows = {}
+        # Every column name in the order it was first seen, and the matrix column of each feature
+        self._columns = []
+        self._feature_columns = {}
+        self._values = np.empty((capacity, 0))
+        self._info = {}
+        # Column names of the last row and getter of its features: rows with the same columns skip the checks
+        self._layout = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __getitem__(self, key):
+        row = self._rows[key]
+        values = {}
+        for name in self._columns:
+            column = self._feature_columns.get(name)
+            if column is not None:
+                values[name] = self._values[row, column]
+            elif self._info[name][row] is not _MISSING:
+                values[name] = self._info[name][row]
+        return values
+
+    def __setitem__(self, key, row):
+        if key not in self._rows:
+            self.append(key, row)
+        else:
+            self._write_row(self._rows[key], row)
+
+    def __delitem__(self, key):
+        row = self._rows.pop(key)
+        n_rows = len(self._keys)
+        # The following rows move up by one, the columns are kept even if no row has a value for them anymore
+        del self._keys[row]
+        for i, moved in enumerate(self._keys[row:], start=row):
+            self._rows[moved] = i
+        self._values[row:n_rows - 1] = self._values[row + 1:n_rows]
+        for cells in self._info.values():
+            del cells[row]
+
+    @property
+    def feature_names(self):
+        """
+        Names of the feature columns, in matrix column order.
+        """
+        return list(self._feature_columns)
+
+    @property
+    def columns(self):
+        """
+        Names of every column, features and diagnostics, in the order they were first seen.
+        """
+        return list(self._columns)
+
+    def _reserve(self, n_rows, n_features):
+        """
+        Grow the matrix to hold at least n_rows rows and n_features columns, new cells are NaN.
+        """
+        capacity, width = self._values.shape
+        if n_rows <= capacity and n_features <= width:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        values = np.full((capacity, max(width, n_features)), np.nan)
+        values[:len(self._keys), :width] = self._values[:len(self._keys)]
+        self._values = values
+
+    def _add_columns(self, names, features):
+        """
+        Register the new columns of a row or a table.
+        """
+        for name, is_feature in zip(names, features):
+            if name in self._feature_columns or name in self._info:
+                continue
+            self._columns.append(name)
+            if is_feature:
+                self._feature_columns[name] = len(self._feature_columns)
+            else:
+                self._info[name] = [_MISSING] * len(self._keys)
+
+    def _demote(self, name):
+        """
+        Move a feature column to the diagnostics table, when a row has a value that is not a float for it.
+        """
+        column = self._feature_columns.pop(name)
+        n_rows = len(self._keys)
+        self._info[name] = list(self._values[:n_rows, column])
+        self._values = np.delete(self._values, column, axis=1)
+        self._feature_columns = {feature: i for i, feature in enumerate(self._feature_columns)}
+        self._layout = None
+
+    def _write_row(self, position, row):
+        """
+        Store the values of a row at a position of the matrix, the end of the table for a new row.
+        """
+        new = [name for name in row if name not in self._feature_columns and name not in self._info]
+        if new:
+            self._add_columns(new, [_is_feature_value(name, row[name]) for name in new])
+        for name in [name for name in row if name in self._feature_columns]:
+            if not _is_feature_value(name, row[name]):
+                self._demote(name)
+
+        self._reserve(position + 1, len(self._feature_columns))
+        values = self._values[position]
+        values.fill(np.nan)
+        for name, value in row.items():
+            column = self._feature_columns.get(name)
+            if column is not None:
+                values[column] = value
+        for name, cells in self._info.items():
+            if position == len(cells):
+                cells.append(row.get(name, _MISSING))
+            else:
+                cells[position] = row.get(name, _MISSING)
+
+    def append(self, key, row):
+        """
+        Append a row.
+
+        :param key: Row key, e.g. 'PR1 - 1'.
+        :param row: Dictionary mapping each column name to its value.
+        :raises ValueError: If the table already has a row with this key.
+        """
+        if key in self._rows:
+            raise ValueError(f"Duplicate row key '{key}'")
+
+        n_rows = len(self._keys)
+        if self._layout is not None and row.keys() == self._layout[0]:
+            _, get_features, columns = self._layout
+            features = get_features(row)
+            types = set(map(type, features))
+            if types <= _FLOAT_TYPES or (types <= _NUMPY_FLOAT_TYPES and set(map(_get_dtype, features)) == _FLOAT64):
+                try:
+                    row_values = np.fromiter(features, float, len(features))
+                except TypeError:
+                    # Arrays of more than one value, checked and moved to the diagnostics below
+                    row_values = None
+                if row_values is not None:
+                    self._reserve(n_rows + 1, len(self._feature_columns))
+                    values = self._values[n_rows]
+                    values.fill(np.nan)
+                    values[columns] = row_values
+                    for name, cells in self._info.items():
+                        cells.append(row.get(name, _MISSING))
+                    self._rows[key] = n_rows
+                    self._keys.append(key)
+                    return
+
+        self._write_row(n_rows, row)
+        self._rows[key] = n_rows
+        self._keys.append(key)
+
+        names = [name for name in row if name in self._feature_columns]
+        self._layout = None
+        if len(names) > 1:
+            self._layout = (set(row), itemgetter(*names), np.array([self._feature_columns[n] for n in names]))
+
+    def extend(self, rows):
+        """
+        Append every row of another table, or of a dictionary of rows.
+
+        The rows of a FeatureTable are copied column by column, without building their dictionaries.
+
+        :param rows: FeatureTable, or dictionary mapping each row key to its values.
+        :raises ValueError: If a row key is already in the table.
+        """
+        if not isinstance(rows, FeatureTable):
+            for key, row in rows.items():
+                self.append(key, row)
+            return
+
+        duplicates = [key for key in rows._keys if key in self._rows]
+        if duplicates:
+            raise ValueError(f"Duplicate row key '{duplicates[0]}'")
+
+        for name in [name for name in rows._info if name in self._feature_columns]:
+            self._demote(name)
+        self._add_columns(rows._columns, [name in rows._feature_columns and name not in self._info
+                                          for name in rows._columns])
+
+        n_rows, n_new = len(self._keys), len(rows)
+        self._reserve(n_rows + n_new, len(self._feature_columns))
+        block = self._values[n_rows:n_rows + n_new]
+        block.fill(np.nan)
+        for name, column in rows._feature_columns.items():
+            target = self._feature_columns.get(name)
+            if target is not None:
+                block[:, target] = rows._values[:n_new, column]
+        for name, cells in self._info.items():
+            if name in rows._info:
+                cells.extend(rows._info[name])
+            elif name in rows._feature_columns:
+                cells.extend(rows._values[:n_new, rows._feature_columns[name]])
+            else:
+                cells.extend([_MISSING] * n_new)
+
+        for i, key in enumerate(rows._keys):
+            self._rows[key] = n_rows + i
+        self._keys.extend(rows._keys)
+
+    def feature_matrix(self):
+        """
+        Get the feature values.
+
+        :return: View of the (rows, features) float64 matrix, without a copy. Columns follow feature_names.
+        """
+        return self._values[:len(self._keys), :len(self._feature_columns)]
+
+    def feature_frame(self):
+        """
+        Get the feature values as a DataFrame indexed by row key, sharing the memory of the table.
+        """
+        import pandas as pd
+
+        return pd.DataFrame(self.feature_matrix(), index=pd.Index(self._keys), columns=self.feature_names,
+                            copy=False)
+
+    def info_frame(self):
+        """
+        Get the diagnostics and metadata columns as a DataFrame indexed by row key, missing cells are None.
+        """
+        import pandas as pd
+
+        index = pd.Index(self._keys)
+        return pd.DataFrame({name: pd.Series([None if v is _MISSING else v for v in cells], index=index, dtype=object)
+                             for name, cells in self._info.items()}, index=index)
+
+    def to_frame(self, key_column):
+        """
+        Get every column as a DataFrame, with the row keys as first column and the columns in the order
+        they were first seen.
+
+        :param key_column: Name of the key column (see feature_writers.get_key_column).
+        :return: DataFrame with one row per key.
+        """
+        import pandas as pd
+
+        frame = pd.concat([self.info_frame(), self.feature_frame()], axis=1)[self._columns]
+        frame.index.name = key_column
+        return frame.reset_index()
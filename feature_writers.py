@@ -0,0 +1,457 @@
+import csv
+import glob
+import heapq
+import os
+import re
+import logging
+import numpy as np
+from collections.abc import Mapping
+from feature_table import FeatureTable
+
+# Columns added by the extractors to the pyradiomics features
+METADATA_COLUMNS = ("MaskLabel", "SliceIndex", "PatientID")
+
+# Columns of the quarantine file, after the key column
+QUARANTINE_COLUMNS = ("PatientID", "Reason", "Seconds", "MemoryMB", "Description")
+
+
+def get_key_column(mode):
+    """
+    Get the name of the column holding the row keys of the output file.
+
+    :param mode: Extraction mode, '2D' or '3D'.
+    :return: 'PatientID - Slice - Label' in 2D mode, 'PatientID - Label' in 3D mode.
+    :raises ValueError: If mode is not '2D' or '3D'.
+    """
+    if mode == "2D":
+        return "PatientID - Slice - Label"
+    elif mode == "3D":
+        return "PatientID - Label"
+    else:
+        raise ValueError("Mode should be '2D' or '3D'")
+
+
+def get_output_name(mode, output_format="csv", shard=None):
+    """
+    Get the name of the features output: a CSV file, or a directory of Parquet files.
+
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param output_format: 'csv' or 'parquet'.
+    :param shard: (i, N) tuple of a sharded run, whose output is merged afterwards by merge_shards.
+                  Defaults to None (whole cohort).
+    :return: Name of the output, e.g. '3D_Radiomic_Features.csv' or '3D_Radiomic_Features.shard-1-of-4.csv'.
+    :raises ValueError: If output_format is not 'csv' or 'parquet'.
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("output_format should be 'csv' or 'parquet'")
+
+    name = f"{mode}_Radiomic_Features"
+    if shard is not None:
+        name += f".shard-{shard[0]}-of-{shard[1]}"
+    return f"{name}.csv" if output_format == "csv" else name
+
+
+def _read_header(output_file):
+    """
+    Read the header of an existing CSV output file.
+
+    :param output_file: Path to the CSV file.
+    :return: List of column names, empty if the file does not exist or is empty.
+    """
+    if not os.path.isfile(output_file):
+        return []
+
+    with open(output_file, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def _drop_partial_row(output_file):
+    """
+    Remove a trailing row left incomplete by an interrupted run.
+
+    :param output_file: Path to the CSV file.
+    """
+    with open(output_file, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+
+        # Walk back to the last complete line
+        position = size
+        while position > 0:
+            step = min(position, 1 << 16)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+
+def read_completed_keys(output_file):
+    """
+    Read the keys of the rows already written by a previous run.
+
+    An incomplete last row, left by an interrupted run, is removed from the file so that
+    it is extracted again.
+
+    :param output_file: Path to the CSV file.
+    :return: Set of the keys ('PatientID - Label' or 'PatientID - Slice - Label') already in the file.
+    :raises TypeError: If output_file is not a string.
+    """
+    if not isinstance(output_file, str):
+        raise TypeError("output_file must be a string")
+
+    if not os.path.isfile(output_file):
+        return set()
+
+    _drop_partial_row(output_file)
+
+    with open(output_file, newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip the header
+        return {row[0] for row in reader if row}
+
+
+def append_features_csv(features, output_file, key_column):
+    """
+    Append the features of a patient to the CSV output file.
+
+    The header is written with the first rows; later rows are aligned on it, so the file has
+    the same layout as if the whole cohort had been written at once.
+
+    :param features: Dictionary or FeatureTable mapping each row key to its features.
+    :param output_file: Path to the CSV file.
+    :param key_column: Name of the key column (see get_key_column).
+    :return: Number of rows written.
+    :raises TypeError: If features is not a dictionary.
+    """
+    import pandas as pd
+
+    if not isinstance(features, Mapping):
+        raise TypeError("features must be a dictionary")
+
+    if not features:
+        return 0
+
+    if isinstance(features, FeatureTable):
+        rows = features.to_frame(key_column)
+    else:
+        rows = pd.DataFrame(features).T.reset_index()
+        rows.rename(columns={'index': key_column}, inplace=True)
+
+    header = _read_header(output_file)
+    if header:
+        missing = [c for c in rows.columns if c not in header]
+        if missing:
+            logging.warning(f"Dropping {len(missing)} columns not present in the header of {output_file}: {missing}")
+        rows = rows.reindex(columns=header)
+
+    with open(output_file, "a", newline="") as f:
+        rows.to_csv(f, sep=",", header=not header, index=False)
+        # Make the rows durable before moving on to the next patient
+        f.flush()
+        os.fsync(f.fileno())
+
+    return len(rows)
+
+
+def append_quarantine_csv(record, quarantine_file, key_column):
+    """
+    Append a quarantined job to the quarantine CSV file, so that it can be retried later with other settings.
+
+    :param record: Dictionary with the Key, PatientID, Reason, Seconds, MemoryMB and Description of the job,
+                   as given by radiomics_2d_3d_extractors.iter_radiomic_features.
+    :param quarantine_file: Path to the CSV file.
+    :param key_column: Name of the key column (see get_key_column).
+    """
+    columns = [key_column] + list(QUARANTINE_COLUMNS)
+    write_header = not os.path.isfile(quarantine_file) or os.path.getsize(quarantine_file) == 0
+    with open(quarantine_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(columns)
+        writer.writerow([record["Key"]] + ["" if record[c] is None else record[c] for c in QUARANTINE_COLUMNS])
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_quarantined_keys(quarantine_file):
+    """
+    Read the keys of the jobs quarantined by a previous run.
+
+    :param quarantine_file: Path to the CSV file.
+    :return: Set of the keys in the file, empty if there is no file.
+    """
+    if not os.path.isfile(quarantine_file):
+        return set()
+
+    with open(quarantine_file, newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip the header
+        return {row[0] for row in reader if row}
+
+
+def features_to_frame(features, key_column, float_dtype="float64"):
+    """
+    Convert the features of a patient to a typed DataFrame.
+
+    The key and the metadata columns keep their type, the feature columns are cast to float_dtype and the
+    pyradiomics 'diagnostics_' columns, which hold versions, settings and tuples, are stored as strings.
+
+    :param features: Dictionary or FeatureTable mapping each row key to its features.
+    :param key_column: Name of the key column (see get_key_column).
+    :param float_dtype: Type of the feature columns, 'float32' or 'float64'.
+    :return: DataFrame with one row per key.
+    :raises ValueError: If float_dtype is not 'float32' or 'float64'.
+    """
+    import pandas as pd
+
+    if float_dtype not in ("float32", "float64"):
+        raise ValueError("float_dtype should be 'float32' or 'float64'")
+
+    if isinstance(features, FeatureTable):
+        rows = features.to_frame(key_column)
+        for name in rows.columns[1:]:
+            if name.startswith("diagnostics_"):
+                rows[name] = pd.array([None if v is None else str(v) for v in rows[name]], dtype="string")
+            elif name in METADATA_COLUMNS:
+                rows[name] = pd.array(rows[name], dtype="Int64")
+            else:
+                rows[name] = rows[name].astype(float_dtype)
+        return rows
+
+    keys = list(features)
+    columns = {key_column: keys}
+    for name in dict.fromkeys(c for row in features.values() for c in row):
+        values = [features[key].get(name) for key in keys]
+        if name.startswith("diagnostics_"):
+            columns[name] = pd.array([None if v is None else str(v) for v in values], dtype="string")
+        elif name in METADATA_COLUMNS:
+            columns[name] = pd.array(values, dtype="Int64")
+        else:
+            columns[name] = np.array([np.nan if v is None else float(v) for v in values], dtype=float_dtype)
+
+    return pd.DataFrame(columns)
+
+
+def write_features_parquet(features, output_dir, key_column, patient_id, float_dtype="float64"):
+    """
+    Write the features of a patient to its own Parquet file in the output directory.
+
+    Each patient is written to separate files, so patients can be written independently and readers can
+    load the directory (e.g. with pandas.read_parquet) or a single patient. A patient resumed by a later run
+    gets an additional part file rather than overwriting the rows already written.
+
+    :param features: Dictionary or FeatureTable mapping each row key to its features.
+    :param output_dir: Directory of the Parquet files, created if needed.
+    :param key_column: Name of the key column (see get_key_column).
+    :param patient_id: ID of the patient, used to name the file.
+    :param float_dtype: Type of the feature columns, 'float32' or 'float64'.
+    :return: Number of rows written.
+    :raises TypeError: If features is not a dictionary.
+    :raises ImportError: If pyarrow is not installed.
+    """
+    if not isinstance(features, Mapping):
+        raise TypeError("features must be a dictionary")
+
+    if not features:
+        return 0
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("The parquet output format requires pyarrow, install it with 'pip install pyarrow'")
+
+    rows = features_to_frame(features, key_column, float_dtype)
+
+    os.makedirs(output_dir, exist_ok=True)
+    part = 0
+    while os.path.exists(os.path.join(output_dir, f"PR{patient_id}-{part}.parquet")):
+        part += 1
+    output_file = os.path.join(output_dir, f"PR{patient_id}-{part}.parquet")
+
+    # Written under a temporary name, so an interrupted run never leaves a partial file behind
+    tmp_file = f"{output_file}.tmp"
+    rows.to_parquet(tmp_file, engine="pyarrow", index=False)
+    os.replace(tmp_file, output_file)
+
+    return len(rows)
+
+
+def read_completed_keys_parquet(output_dir, key_column):
+    """
+    Read the keys of the rows already written to the Parquet output directory by a previous run.
+
+    Only the key column of each file is read.
+
+    :param output_dir: Directory of the Parquet files.
+    :param key_column: Name of the key column (see get_key_column).
+    :return: Set of the keys already written.
+    :raises TypeError: If output_dir is not a string.
+    """
+    import pandas as pd
+
+    if not isinstance(output_dir, str):
+        raise TypeError("output_dir must be a string")
+
+    keys = set()
+    for path in glob.glob(os.path.join(output_dir, "*.parquet")):
+        keys.update(pd.read_parquet(path, columns=[key_column], engine="pyarrow")[key_column])
+    return keys
+
+
+def _find_shards(output_path, mode, output_format):
+    """
+    Find the outputs of every shard of a sharded run.
+
+    :return: List of the shard output paths, in shard order.
+    :raises ValueError: If there is no shard output, the shards come from runs with different numbers of
+                        shards, or a shard output is missing.
+    """
+    pattern = re.compile(re.escape(f"{mode}_Radiomic_Features.shard-") + r"(\d+)-of-(\d+)"
+                         + (r"\.csv" if output_format == "csv" else "") + "$")
+    shards = {}
+    for path in glob.glob(os.path.join(output_path, f"{mode}_Radiomic_Features.shard-*")):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            shards[int(match.group(1)), int(match.group(2))] = path
+
+    if not shards:
+        raise ValueError(f"No {mode} {output_format} shard output found in {output_path}")
+
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        raise ValueError(f"Shard outputs of runs with different numbers of shards found: {sorted(counts)}")
+
+    count = counts.pop()
+    missing = [index for index in range(1, count + 1) if (index, count) not in shards]
+    if missing:
+        raise ValueError(f"Missing output of shards {missing} out of {count}")
+
+    return [shards[index, count] for index in range(1, count + 1)]
+
+
+def _merge_csv_shards(shard_files, output_file):
+    """
+    Merge CSV shard outputs into a single file, rows ordered by patient ID as in a single run.
+    """
+    headers = [_read_header(path) for path in shard_files]
+    header = next((h for h in headers if h), [])
+    for path, shard_header in zip(shard_files, headers):
+        if shard_header and set(shard_header) != set(header):
+            missing, extra = sorted(set(header) - set(shard_header)), sorted(set(shard_header) - set(header))
+            raise ValueError(f"Columns of {path} differ from the other shards: missing {missing}, extra {extra}")
+        if shard_header and shard_header[0] != header[0]:
+            raise ValueError(f"Key column of {path} is '{shard_header[0]}' instead of '{header[0]}'")
+    # As for Parquet, an existing output is never overwritten
+    if os.path.exists(output_file):
+        raise ValueError(f"{output_file} already exists, remove it to merge the shards again")
+
+    files = [open(path, newline="") for path in shard_files]
+    try:
+        def _rows(shard_no, f, shard_header):
+            reader = csv.reader(f)
+            next(reader, None)
+            # Columns are written in the order of the first shard
+            order = [shard_header.index(column) for column in header]
+            patient_column = shard_header.index("PatientID")
+            for row in reader:
+                if row:
+                    yield int(row[patient_column]), shard_no, [row[i] for i in order]
+
+        streams = [_rows(shard_no, f, h) for shard_no, (f, h) in enumerate(zip(files, headers)) if h]
+        n_rows = 0
+        tmp_file = f"{output_file}.tmp"
+        with open(tmp_file, "w", newline="") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            if header:
+                writer.writerow(header)
+            # Each shard is in patient order and patients are split between shards: a k-way merge keeps the order
+            for _, _, row in heapq.merge(*streams, key=lambda item: item[:2]):
+                writer.writerow(row)
+                n_rows += 1
+        os.replace(tmp_file, output_file)
+    finally:
+        for f in files:
+            f.close()
+
+    return n_rows
+
+
+def _merge_parquet_shards(shard_dirs, output_dir):
+    """
+    Merge Parquet shard outputs by moving their per-patient files into a single directory.
+
+    Nothing is moved if a shard directory holds a file other than the patient files and the .tmp files
+    left by an interrupted write, which are deleted.
+    """
+    import pyarrow.parquet as pq
+
+    shard_files = [sorted(glob.glob(os.path.join(shard_dir, "*.parquet"))) for shard_dir in shard_dirs]
+    schema = None
+    for path in (path for paths in shard_files for path in paths):
+        file_schema = pq.read_schema(path).remove_metadata()
+        if schema is None:
+            schema = file_schema
+        elif set(file_schema.names) != set(schema.names):
+            missing = sorted(set(schema.names) - set(file_schema.names))
+            extra = sorted(set(file_schema.names) - set(schema.names))
+            raise ValueError(f"Columns of {path} differ from the other shards: missing {missing}, extra {extra}")
+        else:
+            changed = [name for name in schema.names if file_schema.field(name).type != schema.field(name).type]
+            if changed:
+                raise ValueError(f"Column types of {path} differ from the other shards: {changed}")
+
+    # The shard directories are removed once their files are moved, so anything else in them is checked first;
+    # .tmp files are partial writes of an interrupted run, whose patient was written again on resume
+    leftovers = []
+    for shard_dir, paths in zip(shard_dirs, shard_files):
+        for name in sorted(set(os.listdir(shard_dir)) - {os.path.basename(path) for path in paths}):
+            leftovers.append((os.path.join(shard_dir, name), name.endswith(".parquet.tmp")))
+    unknown = [path for path, partial in leftovers if not partial]
+    if unknown:
+        raise ValueError(f"{len(unknown)} unexpected files in the shard outputs, e.g. {unknown[0]}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    targets = [(path, os.path.join(output_dir, os.path.basename(path))) for paths in shard_files for path in paths]
+    existing = [target for _, target in targets if os.path.exists(target)]
+    if existing:
+        raise ValueError(f"{len(existing)} files already exist in {output_dir}, e.g. {existing[0]}")
+
+    for path, _ in leftovers:
+        os.remove(path)
+    n_rows = 0
+    for path, target in targets:
+        n_rows += pq.read_metadata(path).num_rows
+        os.replace(path, target)
+    for shard_dir in shard_dirs:
+        os.rmdir(shard_dir)
+    return n_rows
+
+
+def merge_shards(output_path, mode, output_format="csv"):
+    """
+    Combine the outputs of the shards of a sharded run into the final features output.
+
+    Every shard must have completed. The columns of the shards are checked before anything is written;
+    CSV rows are merged in patient ID order, Parquet files are moved into the final directory.
+
+    :param output_path: Directory of the shard outputs, where the final output is written.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param output_format: 'csv' or 'parquet'.
+    :return: Tuple with the path of the final output and its number of rows.
+    :raises ValueError: If a shard output is missing, the shards do not have the same columns, the final CSV
+        output already exists or a Parquet shard directory holds unexpected files.
+    """
+    shard_outputs = _find_shards(output_path, mode, output_format)
+    output = os.path.join(output_path, get_output_name(mode, output_format))
+
+    if output_format == "csv":
+        return output, _merge_csv_shards(shard_outputs, output)
+    return output, _merge_parquet_shards(shard_outputs, output)
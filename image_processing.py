@@ -1,7 +1,18 @@
 import os
+import queue
+import threading
 import numpy as np
 import SimpleITK as sitk
-from scipy.ndimage import label
+from scipy.ndimage import label, find_objects
+from utils import timed_stage
+
+# End of the patient stream in the prefetch queue
+_PREFETCH_END = object()
+
+# Scalar integer pixel types, the only ones a mask can have
+_INTEGER_PIXEL_IDS = {sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16, sitk.sitkUInt32, sitk.sitkInt32,
+                      sitk.sitkUInt64, sitk.sitkInt64}
+
 
 def extract_largest_region(mask_slice, label_value):
     """
@@ -28,44 +39,189 @@ def extract_largest_region(mask_slice, label_value):
     # Label the connected components in the binary mask
     labeled_region, num_labels = label(region_mask)
 
-    largest_region = None
-    largest_area = 0
+    if num_labels == 0:
+        return None
 
-    # Iterate through all connected components, ignoring the background (0)
-    for region_id in range(1, num_labels + 1):
-        region = (labeled_region == region_id).astype(mask_slice.dtype) * label_value
-        region_area = np.sum(region > 0)
+    # Size of every connected component in a single pass, ignoring the background (0)
+    region_areas = np.bincount(labeled_region.ravel(), minlength=num_labels + 1)
+    region_areas[0] = 0
 
-        # Update the largest region if the current one is bigger
-        if region_area > largest_area:
-            largest_area = region_area
-            largest_region = region
+    # argmax keeps the first of equally large regions
+    largest_id = np.argmax(region_areas)
 
-    return largest_region
+    return (labeled_region == largest_id).astype(mask_slice.dtype) * label_value
 
 
-def process_slice(mask_slice):
+def pad_bounding_box(box, shape, padding):
+    """
+    Enlarge a bounding box by a padding, without going out of the array.
+
+    :param box: Tuple of slices in array order, as returned by scipy.ndimage.find_objects
+    :param shape: Shape of the array the box belongs to
+    :param padding: Number of voxels added on each side of the box
+    :return: Tuple of slices of the padded box
+    """
+    return tuple(slice(max(s.start - padding, 0), min(s.stop + padding, n)) for s, n in zip(box, shape))
+
+
+def crop_to_roi(image, box):
+    """
+    Crop a SimpleITK image to a bounding box, keeping its physical origin, spacing and direction.
+
+    :param image: SimpleITK image
+    :param box: Tuple of slices in array order ((z,) y, x)
+    :return: Cropped SimpleITK image, whose origin is the physical position of the first voxel of the box
     """
-    Process a mask slice to extract the largest connected region for each label.
+    # SimpleITK indexes are in (x, y(, z)) order, the reverse of the array order
+    index = [int(s.start) for s in reversed(box)]
+    size = [int(s.stop - s.start) for s in reversed(box)]
+    return sitk.RegionOfInterest(image, size, index)
+
+
+def _slice_label_regions(mask_slice):
+    """
+    Find the largest connected region of every label of a mask slice, inside the label bounding box.
 
     :param mask_slice: 2D numpy array representing the mask slice
-    :return: Tuple (largest_region_mask, label) of the largest region found
-    :raises ValueError: If the mask has no labeled regions
+    :return: List of (label, bounding box, largest region inside the bounding box) tuples, in increasing label order
+    """
+    # find_objects treats the slice as a label image: one bounding box per label value, None if absent
+    label_boxes = find_objects(mask_slice.astype(np.intp, copy=False))
+
+    return [(lbl, box, extract_largest_region(mask_slice[box], lbl))
+            for lbl, box in enumerate(label_boxes, start=1) if box is not None]
+
+
+def process_slice_labels(mask_slice):
     """
+    Extract the largest connected region of every label of a mask slice.
+
+    The bounding boxes of all the labels are found in a single pass over the slice, then the
+    connected components of each label are only searched inside its bounding box.
 
-    labels = np.unique(mask_slice)
-    labels = labels[labels != 0]  # Exclude background
+    :param mask_slice: 2D numpy array representing the mask slice
+    :return: List of (largest_region_mask, label) tuples, in increasing label order, empty if the slice has no label
+    """
+    regions = []
+    for lbl, box, region in _slice_label_regions(mask_slice):
+        largest_region_mask = np.zeros_like(mask_slice)
+        largest_region_mask[box] = region
+        regions.append((largest_region_mask, lbl))
 
-    for lbl in labels:
-        lbl = int(lbl)  # Convert numpy.int16 to native Python int
-        largest_region_mask = extract_largest_region(mask_slice, lbl)
-        if largest_region_mask is not None:
-            return largest_region_mask, lbl
-    # If no region found
-    return None, None
+    return regions
 
 
-def get_slices_2D(image, mask, patient_id):
+def slice_label_occupancy(mask_array):
+    """
+    Index the labels present on every axial slice of a mask, with their voxel count and bounding box.
+
+    Empty slices are skipped with a single reduction over the volume, then the voxels of the other slices
+    are grouped by (slice, label) at once, so no per-slice scan of the mask is needed afterwards.
+
+    :param mask_array: 3D numpy array of the mask, in (z, y, x) order.
+    :return: List of (slice index, label, number of voxels, (row slice, column slice) bounding box) tuples,
+             sorted by slice then label. Labels are integers, values lower than 1 are background.
+    """
+    n_slices, n_rows, n_cols = mask_array.shape
+    flat = mask_array.reshape(n_slices, -1)
+    occupied = np.flatnonzero(flat.max(axis=1) >= 1)
+    if occupied.size == 0:
+        return []
+
+    # Only the slices holding a label are scanned for their voxels
+    occupied_flat = flat[occupied]
+    slice_pos, voxel_pos = np.nonzero(occupied_flat >= 1)
+    labels = occupied_flat[slice_pos, voxel_pos].astype(np.intp)
+    rows, cols = np.divmod(voxel_pos, n_cols)
+
+    # Sort the voxels by (slice, label) and reduce each group to its count and bounding box
+    keys = slice_pos * (int(labels.max()) + 1) + labels
+    order = np.argsort(keys, kind="stable")
+    keys, rows, cols = keys[order], rows[order], cols[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, keys.size])
+    row_min, row_max = np.minimum.reduceat(rows, starts), np.maximum.reduceat(rows, starts)
+    col_min, col_max = np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts)
+
+    return [(int(occupied[slice_pos[order[i]]]), int(labels[order[i]]), int(n),
+             (slice(int(r0), int(r1) + 1), slice(int(c0), int(c1) + 1)))
+            for i, n, r0, r1, c0, c1 in zip(starts, counts, row_min, row_max, col_min, col_max)]
+
+
+def _crop_slice_region(slice_shape, box, region, padding):
+    """
+    Crop a region mask to the bounding box of the region enlarged by a padding.
+
+    :param slice_shape: Shape of the mask slice
+    :param box: Bounding box of the label the region belongs to
+    :param region: Largest region of the label, inside box
+    :param padding: Number of pixels added on each side of the region bounding box
+    :return: Tuple (crop box, cropped mask array)
+    """
+    # Tighten the label box to the region itself, which may leave out other components of the label
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    region_box = (slice(box[0].start + rows[0], box[0].start + rows[-1] + 1),
+                  slice(box[1].start + cols[0], box[1].start + cols[-1] + 1))
+    crop_box = pad_bounding_box(region_box, slice_shape, padding)
+
+    mask_crop = np.zeros((crop_box[0].stop - crop_box[0].start, crop_box[1].stop - crop_box[1].start),
+                         dtype=region.dtype)
+    mask_crop[region_box[0].start - crop_box[0].start:region_box[0].stop - crop_box[0].start,
+              region_box[1].start - crop_box[1].start:region_box[1].stop - crop_box[1].start] = \
+        region[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+    return crop_box, mask_crop
+
+
+def extract_slice(image, slice_idx, box=None):
+    """
+    Extract a 2D slice, or a box of it, from a 3D SimpleITK image.
+
+    The pixel data is copied once and the slice keeps the in-plane spacing, the physical origin of its
+    first pixel and the in-plane direction of the volume.
+
+    :param image: 3D SimpleITK image
+    :param slice_idx: Index of the slice along z
+    :param box: Optional tuple of (row, column) slices to extract. Defaults to None (whole slice).
+    :return: 2D SimpleITK image
+    """
+    if box is None:
+        box = (slice(0, image.GetSize()[1]), slice(0, image.GetSize()[0]))
+
+    # A size of 0 along z collapses the output to 2D
+    size = [int(box[1].stop - box[1].start), int(box[0].stop - box[0].start), 0]
+    index = [int(box[1].start), int(box[0].start), int(slice_idx)]
+    return sitk.Extract(image, size, index)
+
+
+def process_slice(mask_slice):
+    """
+    Process a mask slice to extract the largest connected region of its first label.
+
+    :param mask_slice: 2D numpy array representing the mask slice
+    :return: Tuple (largest_region_mask, label) of the first label found, (None, None) if the slice has no label
+    """
+    regions = process_slice_labels(mask_slice)
+    if not regions:
+        return None, None
+    return regions[0]
+
+
+def get_slices_2D(image, mask, patient_id, crop_padding=None):
+    """
+    Split a patient volume into 2D slices, with one record per slice and label.
+
+    :param image: SimpleITK image of the patient.
+    :param mask: SimpleITK mask of the patient.
+    :param patient_id: Patient ID.
+    :param crop_padding: If not None, each image and mask slice is cropped to the bounding box of the
+                         region enlarged by this number of pixels. Defaults to None (full slices).
+    :return: List of dictionaries with the patient ID, the label, the slice index, the image slice and
+             the mask slice holding the largest region of the label.
+    :raises TypeError: If image or mask is not a SimpleITK image.
+    :raises ValueError: If patient_id is not an integer.
+    """
 
     if not isinstance(image, sitk.Image):
         raise TypeError(f"Expected 'image' to be a SimpleITK Image, but got {type(image)}.")
@@ -77,32 +233,73 @@ def get_slices_2D(image, mask, patient_id):
     if not isinstance(patient_id, int):
         raise ValueError(f"Expected 'patient_id' to be a int, but got {type(patient_id)}.")
 
-    image_array = sitk.GetArrayFromImage(image)
-    mask_array = sitk.GetArrayFromImage(mask)
+    # Read-only view on the mask buffer: no copy of the volume
+    mask_array = sitk.GetArrayViewFromImage(mask)
     patient_slices = []
 
-    for slice_idx in range(mask_array.shape[0]):
-        mask_slice = mask_array[slice_idx, :, :]
-        image_slice = image_array[slice_idx, :, :]
+    # Only the (slice, label) pairs present in the mask are visited, the slice records are grouped by slice
+    slice_labels = {}
+    for slice_idx, lbl, _, box in slice_label_occupancy(mask_array):
+        slice_labels.setdefault(slice_idx, []).append((lbl, box))
 
-        region_mask, region_label = process_slice(mask_slice)
-        if region_mask is None:
+    for slice_idx, labels in slice_labels.items():
+        mask_slice = mask_array[slice_idx, :, :]
+        slice_regions = [(lbl, box, extract_largest_region(mask_slice[box], lbl)) for lbl, box in labels]
+
+        if crop_padding is not None:
+            for region_label, box, region in slice_regions:
+                crop_box, mask_crop = _crop_slice_region(mask_slice.shape, box, region, crop_padding)
+                image_slice_image = extract_slice(image, slice_idx, crop_box)
+                mask_slice_image = sitk.GetImageFromArray(mask_crop)
+                mask_slice_image.CopyInformation(image_slice_image)
+                patient_slices.append({
+                    'PatientID': f"PR{patient_id}",
+                    'Label': region_label,
+                    'SliceIndex': slice_idx,
+                    'ImageSlice': image_slice_image,
+                    'MaskSlice': mask_slice_image,
+                    'CropPadding': crop_padding
+                })
             continue
-        largest_region_mask_image  = sitk.GetImageFromArray(region_mask)
-        image_slice_image = sitk.GetImageFromArray(image_slice)
-        patient_slices.append({
-            'PatientID': f"PR{patient_id}",
-            'Label': region_label,
-            'SliceIndex': slice_idx,
-            'ImageSlice':  image_slice_image,
-            'MaskSlice': largest_region_mask_image
-        })
 
-    return patient_slices
+        # One record per label of the slice, all of them sharing the same image slice
+        image_slice_image = extract_slice(image, slice_idx)
+
+        for region_label, box, region in slice_regions:
+            region_mask = np.zeros_like(mask_slice)
+            region_mask[box] = region
+            mask_slice_image = sitk.GetImageFromArray(region_mask)
+            mask_slice_image.CopyInformation(image_slice_image)
+            patient_slices.append({
+                'PatientID': f"PR{patient_id}",
+                'Label': region_label,
+                'SliceIndex': slice_idx,
+                'ImageSlice':  image_slice_image,
+                'MaskSlice': mask_slice_image
+            })
 
+    return patient_slices
 
-def get_volume_3D(image, mask, patient_id):
 
+def get_volume_2D(image, mask, patient_id, crop_padding=None):
+    """
+    Prepare a patient volume for the 2D extraction without building one image per slice.
+
+    The largest region of every (slice, label) pair is written, with its own region label, into a single
+    region volume. The slice images and masks are only extracted from the shared volumes when each pair is
+    extracted (see extract_region_slice), so they give the same records as get_slices_2D.
+
+    :param image: SimpleITK image of the patient.
+    :param mask: SimpleITK mask of the patient.
+    :param patient_id: Patient ID.
+    :param crop_padding: If not None, each slice is extracted around the bounding box of the region enlarged
+                         by this number of pixels. Defaults to None (full slices).
+    :return: List with a dictionary holding the patient ID, the image volume, the region volume, the mask
+             pixel type and the 'SliceRegions' list of (region label, slice index, label, (row, column) box)
+             tuples; empty if the mask has no label.
+    :raises TypeError: If image or mask is not a SimpleITK image.
+    :raises ValueError: If patient_id is not an integer.
+    """
     if not isinstance(image, sitk.Image):
         raise TypeError(f"Expected 'image' to be a SimpleITK Image, but got {type(image)}.")
 
@@ -112,12 +309,108 @@ def get_volume_3D(image, mask, patient_id):
     if not isinstance(patient_id, int):
         raise ValueError(f"Expected 'patient_id' to be a int, but got {type(patient_id)}.")
 
-    return [{
+    mask_array = sitk.GetArrayViewFromImage(mask)
+    occupancy = slice_label_occupancy(mask_array)
+    if not occupancy:
+        return []
+
+    regions = np.zeros(mask_array.shape, dtype=np.min_scalar_type(len(occupancy)))
+    full_slice = (slice(0, mask_array.shape[1]), slice(0, mask_array.shape[2]))
+    slice_regions = []
+
+    for region_label, (slice_idx, lbl, _, box) in enumerate(occupancy, start=1):
+        region = extract_largest_region(mask_array[slice_idx][box], lbl)
+        regions[slice_idx][box][region > 0] = region_label
+        if crop_padding is not None:
+            extract_box, _ = _crop_slice_region(mask_array.shape[1:], box, region, crop_padding)
+        else:
+            extract_box = full_slice
+        slice_regions.append((region_label, slice_idx, lbl, extract_box))
+
+    regions_image = sitk.GetImageFromArray(regions)
+    regions_image.CopyInformation(image)
+    record = {
         'PatientID': f"PR{patient_id}",
         'ImageVolume': image,
-        'MaskVolume': mask
-    }]
+        'RegionVolume': regions_image,
+        'MaskDType': mask_array.dtype.str,
+        'SliceRegions': slice_regions
+    }
+    if crop_padding is not None:
+        record['CropPadding'] = crop_padding
+    return [record]
+
+
+def extract_region_slice(image, regions, region_label, label, slice_idx, box, mask_dtype):
+    """
+    Extract the image and mask slices of a region prepared by get_volume_2D.
+
+    :param image: 3D SimpleITK image.
+    :param regions: 3D SimpleITK region volume from get_volume_2D.
+    :param region_label: Label of the region in the region volume.
+    :param label: Label of the region in the original mask.
+    :param slice_idx: Index of the slice along z.
+    :param box: Tuple of (row, column) slices to extract.
+    :param mask_dtype: Pixel type of the original mask, as a numpy dtype string.
+    :return: Tuple with the 2D image slice and the 2D mask slice, holding label over the region.
+    """
+    image_slice = extract_slice(image, slice_idx, box)
+    region_slice = sitk.GetArrayViewFromImage(regions)[slice_idx][box]
+    mask_slice = sitk.GetImageFromArray((region_slice == region_label).astype(mask_dtype) * np.array(label, mask_dtype))
+    mask_slice.CopyInformation(image_slice)
+    return image_slice, mask_slice
+
+
+def get_volume_3D(image, mask, patient_id, crop_padding=None):
+    """
+    Prepare a patient volume for 3D extraction.
+
+    :param image: SimpleITK image of the patient.
+    :param mask: SimpleITK mask of the patient.
+    :param patient_id: Patient ID.
+    :param crop_padding: If not None, one record is returned per label, with the image and the mask cropped
+                         to the bounding box of the label enlarged by this number of voxels.
+                         Defaults to None (a single record with the whole volume).
+    :return: List of dictionaries with the patient ID, the image volume and the mask volume, plus the
+             label when the volume is cropped.
+    :raises TypeError: If image or mask is not a SimpleITK image.
+    :raises ValueError: If patient_id is not an integer.
+    """
+
+    if not isinstance(image, sitk.Image):
+        raise TypeError(f"Expected 'image' to be a SimpleITK Image, but got {type(image)}.")
+
+    if not isinstance(mask, sitk.Image):
+        raise TypeError(f"Expected 'mask' to be a SimpleITK Image, but got {type(mask)}.")
+
+    if not isinstance(patient_id, int):
+        raise ValueError(f"Expected 'patient_id' to be a int, but got {type(patient_id)}.")
+
+    if crop_padding is None:
+        return [{
+            'PatientID': f"PR{patient_id}",
+            'ImageVolume': image,
+            'MaskVolume': mask
+        }]
+
+    # Bounding boxes of all the labels in a single pass over the mask
+    mask_array = sitk.GetArrayViewFromImage(mask)
+    label_boxes = find_objects(mask_array.astype(np.intp, copy=False))
+
+    patient_volumes = []
+    for lbl, box in enumerate(label_boxes, start=1):
+        if box is None:
+            continue
+        crop_box = pad_bounding_box(box, mask_array.shape, crop_padding)
+        patient_volumes.append({
+            'PatientID': f"PR{patient_id}",
+            'Label': lbl,
+            'ImageVolume': crop_to_roi(image, crop_box),
+            'MaskVolume': crop_to_roi(mask, crop_box),
+            'CropPadding': crop_padding
+        })
 
+    return patient_volumes
 
 
 def read_image_and_mask(image_path, mask_path):
@@ -152,25 +445,361 @@ def read_image_and_mask(image_path, mask_path):
 
 
 
-def get_patient_image_mask_dict(imgs_path, masks_path, patient_ids, mode):
+def lesion_slice_runs(mask):
+    """
+    Find the runs of consecutive axial slices holding a label.
+
+    :param mask: 3D SimpleITK mask.
+    :return: List of (first slice, number of slices) tuples, in increasing slice order.
+    """
+    lesion_slices = np.flatnonzero(sitk.GetArrayViewFromImage(mask).any(axis=(1, 2)))
+    if lesion_slices.size == 0:
+        return []
+
+    # A gap between two lesion slices starts a new run
+    breaks = np.flatnonzero(np.diff(lesion_slices) > 1)
+    starts = np.concatenate(([lesion_slices[0]], lesion_slices[breaks + 1]))
+    stops = np.concatenate((lesion_slices[breaks], [lesion_slices[-1]])) + 1
+    return [(int(start), int(stop - start)) for start, stop in zip(starts, stops)]
+
+
+def read_image_slab(image_path, first_slice, n_slices):
+    """
+    Read a slab of consecutive axial slices of an image, without reading the rest of the volume.
+
+    ITK streams the requested region from uncompressed .nii files, compressed files are decompressed
+    up to the end of the slab. The slab keeps the spacing and direction of the volume and the physical
+    position of its first slice.
+
+    :param image_path: Path to the image file.
+    :param first_slice: Index of the first slice along z.
+    :param n_slices: Number of slices of the slab.
+    :return: 3D SimpleITK image of n_slices slices.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    reader.SetExtractIndex([0, 0, int(first_slice)])
+    reader.SetExtractSize([size[0], size[1], int(n_slices)])
+    return reader.Execute()
+
+
+def read_mask_and_image_slabs(image_path, mask_path):
+    """
+    Read a mask and only the slabs of its image that hold a label, for the 2D extraction.
+
+    :param image_path: Path to the image file.
+    :param mask_path: Path to the mask file.
+    :return: Tuple with the mask as a SimpleITK image and the list of (first slice, image slab) tuples.
+    :raises ValueError: If any of the input paths is empty.
+    :raises TypeError: If the input paths are not strings.
+    :raises ValueError: If the parent directories of the image and mask do not match.
+    :raises ValueError: If the image and mask dimensions do not match.
+    """
+    if not image_path or not mask_path:
+        raise ValueError("Image and mask paths cannot be empty.")
+
+    if not isinstance(image_path, str) or not isinstance(mask_path, str):
+        raise TypeError("Image and mask paths must be strings.")
+
+    if os.path.dirname(image_path) != os.path.dirname(mask_path):
+        raise ValueError("Image and mask must be in the same directory.")
+
+    mask = sitk.ReadImage(mask_path)
+
+    if read_image_header(image_path)["Size"] != mask.GetSize():
+        raise ValueError("Image and mask dimensions do not match.")
+
+    slabs = [(first_slice, read_image_slab(image_path, first_slice, n_slices))
+             for first_slice, n_slices in lesion_slice_runs(mask)]
+    return mask, slabs
+
+
+def read_image_header(path):
+    """
+    Read the header of an image file, without reading its voxel data.
+
+    :param path: Path to the image file.
+    :return: Dictionary with the 'Size', 'Spacing', 'Origin', 'Direction', 'PixelType' and 'Components'
+             of the image, and 'Integer', whether its pixels are scalar integers.
+    :raises RuntimeError: If the file cannot be read.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+
+    return {
+        "Size": reader.GetSize(),
+        "Spacing": reader.GetSpacing(),
+        "Origin": reader.GetOrigin(),
+        "Direction": reader.GetDirection(),
+        "PixelType": sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+        "Components": reader.GetNumberOfComponents(),
+        "Integer": reader.GetPixelID() in _INTEGER_PIXEL_IDS
+    }
+
+
+def check_image_mask_headers(image_path, mask_path, tolerance=None, check_geometry=True):
+    """
+    Check that an image and its mask can be read and extracted together, from their headers only.
+
+    The sizes must match, the image must have a single component and the mask a single component of whole
+    number labels. Only a mask with a floating point pixel type has its voxels read, to check its values. With
+    check_geometry, the spacing, origin and direction must also match within the tolerance, as pyradiomics
+    requires when it does not correct the mask (correctMask).
+
+    :param image_path: Path to the image file.
+    :param mask_path: Path to the mask file.
+    :param tolerance: Geometry tolerance, as the pyradiomics geometryTolerance setting: relative to the image
+                      spacing for the spacing and origin, absolute for the direction. Defaults to None (the
+                      SimpleITK default tolerances, which pyradiomics uses then).
+    :param check_geometry: Whether the spacing, origin and direction are compared. Defaults to True.
+    :return: List of the problems found, empty if the pair is valid.
+    """
+    headers = []
+    problems = []
+    for kind, path in (("image", image_path), ("mask", mask_path)):
+        try:
+            headers.append(read_image_header(path))
+        except RuntimeError as e:
+            problems.append(f"cannot read the {kind} header of {path}: {str(e).strip().splitlines()[-1]}")
+    if problems:
+        return problems
+
+    img, mask = headers
+    if len(img["Size"]) != 3 or len(mask["Size"]) != 3:
+        problems.append(f"image and mask must be 3D, got sizes {img['Size']} and {mask['Size']}")
+    if img["Size"] != mask["Size"]:
+        problems.append(f"image size {img['Size']} does not match mask size {mask['Size']}")
+    if check_geometry:
+        if tolerance is None:
+            coordinate_tolerance = sitk.ProcessObject.GetGlobalDefaultCoordinateTolerance()
+            direction_tolerance = sitk.ProcessObject.GetGlobalDefaultDirectionTolerance()
+        else:
+            coordinate_tolerance = direction_tolerance = tolerance
+        # Same comparison as ITK: the coordinate tolerance is a fraction of the image spacing
+        atol = {"Spacing": coordinate_tolerance * img["Spacing"][0], "Origin": coordinate_tolerance * img["Spacing"][0],
+                "Direction": direction_tolerance}
+        for field in ("Spacing", "Origin", "Direction"):
+            if len(img[field]) != len(mask[field]) or not np.allclose(img[field], mask[field], rtol=0,
+                                                                     atol=atol[field]):
+                problems.append(f"image {field.lower()} {img[field]} does not match mask {field.lower()} "
+                                f"{mask[field]}")
+    if img["Components"] != 1:
+        problems.append(f"image must have a single component, got {img['Components']} ({img['PixelType']})")
+    if mask["Components"] != 1:
+        problems.append(f"mask must have a single component, got {mask['Components']} ({mask['PixelType']})")
+    elif not mask["Integer"]:
+        # A float mask of whole numbers is extracted like an integer one
+        try:
+            mask_image = sitk.ReadImage(mask_path)
+        except RuntimeError as e:
+            problems.append(f"cannot read the mask {mask_path}: {str(e).strip().splitlines()[-1]}")
+        else:
+            if not np.all(np.mod(sitk.GetArrayViewFromImage(mask_image), 1) == 0):
+                problems.append(f"mask values must be whole number labels, got other values in a "
+                                f"{mask['PixelType']} mask")
+
+    return problems
+
+
+def validate_cohort(imgs_path, masks_path, patient_ids, tolerance=None, check_geometry=True):
+    """
+    Check the headers of every image and mask pair of the cohort before any voxel data is read.
+
+    :param imgs_path: List of image file paths.
+    :param masks_path: List of mask file paths.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param tolerance: Geometry tolerance (see check_image_mask_headers).
+    :param check_geometry: Whether the spacing, origin and direction are compared (see check_image_mask_headers).
+    :return: Dictionary mapping the ID of each invalid patient to the list of its problems, empty if all the
+             pairs are valid.
+    :raises ValueError: If the inputs have different lengths.
+    """
+    if len(imgs_path) != len(masks_path) or len(imgs_path) != len(patient_ids):
+        raise ValueError("The number of images, masks, and patient_ids must be the same.")
+
+    invalid = {}
+    with timed_stage("validation"):
+        for pr_id, img_path, mask_path in zip(patient_ids, imgs_path, masks_path):
+            problems = check_image_mask_headers(img_path, mask_path, tolerance, check_geometry)
+            if problems:
+                invalid[pr_id] = problems
+
+    return invalid
+
+
+def load_patient(img_path, mask_path, pr_id, mode, crop_padding=None, slice_engine="slices"):
+    """
+    Read one patient and prepare its data for the requested extraction mode.
+
+    :param img_path: Path to the image file.
+    :param mask_path: Path to the mask file.
+    :param pr_id: Patient ID.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param crop_padding: Padding, in voxels, around each lesion bounding box the images are cropped to.
+                         Defaults to None (no cropping).
+    :param slice_engine: 2D extraction engine: 'slices' builds the image and mask of every slice (get_slices_2D),
+                         'volume' keeps the volume and a region volume, the slices being extracted only when
+                         they are processed (get_volume_2D). Defaults to 'slices'.
+    :return: List of slice dictionaries (2D) or a list with the volume dictionary (3D), each one
+             also holding the source 'ImagePath' and 'MaskPath'.
+    :raises ValueError: If mode is not '2D' or '3D'.
+    """
+    if mode == "2D":
+        # Only the slices holding a label are needed: the image is read slab by slab, around the lesions
+        with timed_stage("read", pr_id) as stage:
+            mask, slabs = read_mask_and_image_slabs(img_path, mask_path)
+            stage["Voxels"] = sum(slab.GetNumberOfPixels() for _, slab in slabs)
+
+        with timed_stage("preprocess", pr_id) as stage:
+            stage["Voxels"] = mask.GetNumberOfPixels()
+            patient_data = []
+            for first_slice, slab in slabs:
+                mask_slab = sitk.RegionOfInterest(mask, slab.GetSize(), [0, 0, first_slice])
+                if slice_engine == "volume":
+                    for record in get_volume_2D(slab, mask_slab, pr_id, crop_padding):
+                        record['FirstSlice'] = first_slice
+                        patient_data.append(record)
+                    continue
+                for record in get_slices_2D(slab, mask_slab, pr_id, crop_padding):
+                    record['SliceIndex'] += first_slice
+                    patient_data.append(record)
+    elif mode == "3D":
+        with timed_stage("read", pr_id) as stage:
+            img, mask = read_image_and_mask(img_path, mask_path)
+            stage["Voxels"] = img.GetNumberOfPixels()
+
+        with timed_stage("preprocess", pr_id) as stage:
+            stage["Voxels"] = img.GetNumberOfPixels()
+            patient_data = get_volume_3D(img, mask, pr_id, crop_padding)
+    else:
+        raise ValueError("Mode should be '2D' or '3D'")
+
+    # Keep track of the source files, which identify the patient data in the feature cache
+    for record in patient_data:
+        record['ImagePath'] = img_path
+        record['MaskPath'] = mask_path
+
+    return patient_data
+
+
+def prefetch_patients(patients, depth=1):
+    """
+    Load the next patients on a background thread while the current one is being consumed.
+
+    The reading and preprocessing of the next patients (file I/O, decompression, slicing) overlap with
+    the extraction of the current one. At most depth loaded patients wait in the queue, so memory stays
+    bounded by depth + 2 patients (queued, being loaded and being consumed). An error raised while loading
+    a patient is raised again when that patient is reached, after the previous ones.
+
+    :param patients: Iterable of (patient ID, patient data) tuples, e.g. from iter_patient_image_mask.
+    :param depth: Number of patients loaded ahead. 0 loads each patient when it is consumed.
+    :return: Generator of the same (patient ID, patient data) tuples, in the same order.
+    :raises ValueError: If depth is not a non-negative integer.
+    """
+    if not isinstance(depth, int) or isinstance(depth, bool) or depth < 0:
+        raise ValueError("The prefetch depth should be a non-negative integer")
+
+    if depth == 0:
+        return iter(patients)
+    return _prefetch(patients, depth)
+
+
+def _prefetch(patients, depth):
+    """
+    Generator of prefetch_patients, the loading thread only starts with the iteration.
+    """
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item):
+        # Give up when the consumer stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _load():
+        try:
+            for patient in patients:
+                if stop.is_set():
+                    return
+                _put((patient, None))
+        except Exception as e:
+            _put((None, e))
+        _put(_PREFETCH_END)
+
+    loader = threading.Thread(target=_load, name="patient-prefetch", daemon=True)
+    loader.start()
+    try:
+        while True:
+            with timed_stage("wait"):
+                item = loaded.get()
+            if item is _PREFETCH_END:
+                return
+            patient, error = item
+            if error is not None:
+                raise error
+            yield patient
+    finally:
+        stop.set()
+        loader.join()
+
+
+def iter_patient_image_mask(imgs_path, masks_path, patient_ids, mode, crop_padding=None, slice_engine="slices",
+                            prefetch=0):
+    """
+    Lazily read and prepare patients one at a time.
+
+    Only the patient being consumed is kept in memory, so peak memory is bounded by a single
+    patient regardless of the cohort size. With prefetch, the next patients are loaded in the
+    background (see prefetch_patients) and memory is bounded by prefetch + 2 patients.
+
+    :param imgs_path: List of image file paths.
+    :param masks_path: List of mask file paths.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param crop_padding: Padding, in voxels, around each lesion bounding box the images are cropped to.
+                         Defaults to None (no cropping).
+    :param slice_engine: 2D extraction engine, 'slices' or 'volume' (see load_patient). Defaults to 'slices'.
+    :param prefetch: Number of patients loaded ahead on a background thread. Defaults to 0 (no prefetch).
+    :return: Generator of (patient ID, patient data) tuples.
+    :raises ValueError: If the inputs are empty, have different lengths, or the mode, the slice engine or the
+                        prefetch depth is invalid.
+    """
     if len(patient_ids) == 0:
         raise ValueError("The patient_ids list cannot be empty.")
 
     if len(imgs_path) != len(masks_path) or len(imgs_path) != len(patient_ids):
         raise ValueError("The number of images, masks, and patient_ids must be the same.")
 
-    patient_dict = {}
+    if mode not in ("2D", "3D"):
+        raise ValueError("Mode should be '2D' or '3D'")
 
-    for pr_id, img_path, mask_path in zip(patient_ids, imgs_path, masks_path):
-        img, mask = read_image_and_mask(img_path, mask_path)
+    if slice_engine not in ("slices", "volume"):
+        raise ValueError("slice_engine should be 'slices' or 'volume'")
+
+    # Inputs are validated eagerly, the reading is deferred to the iteration
+    patients = ((pr_id, load_patient(img_path, mask_path, pr_id, mode, crop_padding, slice_engine))
+                for pr_id, img_path, mask_path in zip(patient_ids, imgs_path, masks_path))
+    return prefetch_patients(patients, prefetch)
 
-        if mode == "2D":
-            patient_slices = get_slices_2D(img, mask, pr_id)
-            patient_dict[pr_id] = patient_slices
-        elif mode == "3D":
-            patient_volume = get_volume_3D(img, mask, pr_id)
-            patient_dict[pr_id] = patient_volume
-        else:
-            raise ValueError("Mode should be '2D' or '3D'")
 
-    return patient_dict
\ No newline at end of file
+def get_patient_image_mask_dict(imgs_path, masks_path, patient_ids, mode, crop_padding=None, slice_engine="slices"):
+    """
+    Read and prepare every patient of the cohort.
+
+    :param imgs_path: List of image file paths.
+    :param masks_path: List of mask file paths.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param crop_padding: Padding, in voxels, around each lesion bounding box the images are cropped to.
+                         Defaults to None (no cropping).
+    :param slice_engine: 2D extraction engine, 'slices' or 'volume' (see load_patient). Defaults to 'slices'.
+    :return: Dictionary mapping each patient ID to its data.
+    """
+    return dict(iter_patient_image_mask(imgs_path, masks_path, patient_ids, mode, crop_padding, slice_engine))
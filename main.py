@@ -1,45 +1,284 @@
+import argparse
+import glob
 import os
-import pandas as pd
+import sys
+import time
 import configparser
-import utils
-from image_processing import get_patient_image_mask_dict
-from radiomics_2d_3d_extractors import get_extractor, extract_radiomic_features
 
-# Read the configuration .ini file
-config = configparser.ConfigParser()
-config.read("config.ini")
+# Only the standard library is imported here: the heavy modules (SimpleITK, pandas, pyradiomics) are imported
+# by main() when the stage that needs them runs, so '--help', '--merge' and spawned workers start quickly
 
-data_path = config["paths"]["data_path"]
-output_path = config["paths"]["output_path"]
-mode = config["settings"]["mode"]
-extractor_config = config["settings"]["extractor_config"]
+# Keys of config.ini that can be overridden on the command line, as '--data-path', '--n-workers', ...
+CONFIG_OPTIONS = [
+    ("paths", "data_path", "Path to the data directory, or a glob pattern of directories"),
+    ("paths", "output_path", "Directory of the extracted features"),
+    ("settings", "mode", "Extraction mode, '2D' or '3D'"),
+    ("settings", "extractor_config", "pyradiomics YAML configuration"),
+    ("settings", "n_workers", "Number of worker processes"),
+    ("settings", "resume", "Skip the rows already in the output, 'true' or 'false'"),
+    ("settings", "cache", "Reuse the features extracted from unchanged files, 'true' or 'false'"),
+    ("settings", "cache_size_mb", "Size cap of the feature cache"),
+    ("settings", "crop_padding", "Crop the images around each lesion with this padding, in voxels"),
+    ("settings", "slice_engine", "2D engine, 'slices' or 'volume'"),
+    ("settings", "prefetch", "Number of patients read in the background"),
+    ("settings", "validate", "Check the image and mask headers first, 'true' or 'false'"),
+    ("settings", "validate_strict", "Stop before the extraction if a pair is invalid, 'true' or 'false'"),
+    ("settings", "manifest", "Reuse the file listing of unchanged directories, 'true' or 'false'"),
+    ("settings", "output_format", "'csv' or 'parquet'"),
+    ("settings", "feature_dtype", "Type of the parquet feature columns, 'float32' or 'float64'"),
+    ("settings", "shard", "Only extract the patients of shard i out of N, e.g. '1/4'"),
+    ("settings", "job_timeout", "Stop and quarantine the jobs running longer than this, in seconds"),
+    ("settings", "job_memory_mb", "Stop and quarantine the jobs that add more memory than this to their worker, in MB"),
+    ("settings", "share_filtered_images", "Compute the filtered images of a volume once for all its lesions, "
+                                          "'true' or 'false'"),
+    ("settings", "prioritize", "Estimate the patient costs from the masks first and extract the largest lesions "
+                               "ahead of their turn, 'true' or 'false'"),
+]
 
-# Ensure the output directory exists
-os.makedirs(output_path, exist_ok=True)
 
-# Get image and mask paths
-images_path, masks_path = utils.get_path_images_masks(data_path)
-patient_ids = utils.assign_patient_ids(images_path)
+def parse_args(argv=None):
+    """
+    Parse the command line.
 
-# Create patient dictionary
-patient_dict = get_patient_image_mask_dict(images_path, masks_path, patient_ids, mode)
+    :param argv: Arguments, defaults to sys.argv[1:].
+    :return: argparse namespace with the configuration file, the merge flag and the config.ini overrides.
+    """
+    parser = argparse.ArgumentParser(description="Extract radiomic features as configured in config.ini")
+    parser.add_argument("--config", default="config.ini", help="Configuration file (default: config.ini)")
+    parser.add_argument("--merge", action="store_true", help="Merge the outputs of the shards into the final output")
+    for _, key, help_text in CONFIG_OPTIONS:
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key, help=f"{help_text} (overrides config.ini)")
+    return parser.parse_args(argv)
 
-# Create extractor
-extractor = get_extractor(extractor_config)
 
-# Extract radiomic features
-radiomic_dictionary = extract_radiomic_features(patient_dict, extractor, mode)
+def load_config(args):
+    """
+    Read the configuration file and apply the command line overrides.
 
-# Convert to DataFrame and save
-radiomic_dataframe = pd.DataFrame(radiomic_dictionary).T.reset_index()
+    :param args: Namespace returned by parse_args.
+    :return: ConfigParser with the 'paths' and 'settings' sections.
+    """
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    for section, key, _ in CONFIG_OPTIONS:
+        value = getattr(args, key)
+        if value is not None:
+            if not config.has_section(section):
+                config.add_section(section)
+            config[section][key] = value
+    return config
 
-# Rename columns based on mode
-if mode == "2D":
-    radiomic_dataframe.rename(columns={'index': 'PatientID - Slice - Label'}, inplace=True)
-else:
-    radiomic_dataframe.rename(columns={'index': 'PatientID - Label'}, inplace=True)
 
-output_file = os.path.join(output_path, f"{mode}_Radiomic_Features.csv")
-radiomic_dataframe.to_csv(output_file, sep=",", header=True, index=False)
+def _touch_output(output_file, output_format):
+    """
+    Create an output without rows, e.g. of an empty shard: the merge expects the output of every shard.
+    """
+    if output_format == "parquet":
+        os.makedirs(output_file, exist_ok=True)
+    else:
+        open(output_file, "a").close()
 
-print(f"Feature extraction completed successfully! Results saved in {output_file}")
+
+def main(argv=None):
+    """
+    Run the feature extraction configured in config.ini and the command line.
+
+    :param argv: Arguments, defaults to sys.argv[1:].
+    :return: Exit status.
+    """
+    run_start = time.perf_counter()
+    args = parse_args(argv)
+    config = load_config(args)
+
+    data_path = config["paths"]["data_path"]
+    output_path = config["paths"]["output_path"]
+    mode = config["settings"]["mode"]
+    extractor_config = config["settings"]["extractor_config"]
+    n_workers = config["settings"].getint("n_workers", fallback=1)
+    resume = config["settings"].getboolean("resume", fallback=True)
+    use_cache = config["settings"].getboolean("cache", fallback=True)
+    cache_size_mb = config["settings"].getfloat("cache_size_mb", fallback=1024)
+    # Empty or missing crop_padding: the whole images are given to pyradiomics
+    crop_padding = config["settings"].get("crop_padding", fallback="").strip()
+    crop_padding = int(crop_padding) if crop_padding else None
+    slice_engine = config["settings"].get("slice_engine", fallback="slices").strip()
+    prefetch = config["settings"].getint("prefetch", fallback=1)
+    validate = config["settings"].getboolean("validate", fallback=True)
+    validate_strict = config["settings"].getboolean("validate_strict", fallback=False)
+    use_manifest = config["settings"].getboolean("manifest", fallback=True)
+    output_format = config["settings"].get("output_format", fallback="csv").strip().lower()
+    feature_dtype = config["settings"].get("feature_dtype", fallback="float64").strip()
+    # Empty or missing limits: jobs are never stopped
+    job_timeout = config["settings"].get("job_timeout", fallback="").strip()
+    job_timeout = float(job_timeout) if job_timeout else None
+    job_memory_mb = config["settings"].get("job_memory_mb", fallback="").strip()
+    job_memory_mb = float(job_memory_mb) if job_memory_mb else None
+    prioritize = config["settings"].getboolean("prioritize", fallback=True)
+    share_filtered_images = config["settings"].getboolean("share_filtered_images", fallback=True)
+
+    import utils
+    from feature_writers import get_key_column, get_output_name, read_quarantined_keys
+
+    shard_spec = config["settings"].get("shard", fallback="").strip()
+    shard = utils.parse_shard(shard_spec) if shard_spec else None
+    shard_suffix = f".shard-{shard[0]}-of-{shard[1]}" if shard else ""
+
+    if args.merge:
+        from feature_writers import merge_shards
+
+        merged_output, n_rows = merge_shards(output_path, mode, output_format)
+        print(f"Shards merged successfully! {n_rows} rows written to {merged_output}")
+        return 0
+
+    # Ensure the output directory exists
+    os.makedirs(output_path, exist_ok=True)
+
+    key_column = get_key_column(mode)
+    # With parquet, the output is a directory with one file per patient
+    output_file = os.path.join(output_path, get_output_name(mode, output_format, shard))
+    # Jobs stopped by job_timeout or job_memory_mb, listed so that they can be retried with other settings
+    quarantine_file = os.path.join(output_path, f"{mode}_Quarantine{shard_suffix}.csv")
+
+    # Rows already written by an interrupted run are not extracted again
+    if not resume:
+        if output_format == "parquet":
+            for part_file in glob.glob(os.path.join(output_file, "*.parquet")):
+                os.remove(part_file)
+        elif os.path.isfile(output_file):
+            os.remove(output_file)
+        if os.path.isfile(quarantine_file):
+            os.remove(quarantine_file)
+    if output_format == "parquet":
+        from feature_writers import read_completed_keys_parquet
+
+        completed_keys = read_completed_keys_parquet(output_file, key_column)
+    else:
+        from feature_writers import read_completed_keys
+
+        completed_keys = read_completed_keys(output_file)
+    if completed_keys:
+        print(f"Resuming from {output_file}: {len(completed_keys)} rows already extracted will be skipped")
+    # Quarantined jobs are not retried by a resumed run, unless their file is removed
+    quarantined_keys = read_quarantined_keys(quarantine_file)
+    if quarantined_keys:
+        print(f"Skipping {len(quarantined_keys)} quarantined jobs listed in {quarantine_file}, "
+              f"remove the file to retry them")
+        completed_keys |= quarantined_keys
+
+    # Get the image and mask paths paired by patient, only the directories changed since the last run are listed
+    manifest_path = os.path.join(output_path, f"cohort_manifest{shard_suffix}.json") if use_manifest else None
+    images_path, masks_path, patient_ids = utils.discover_cohort(data_path, manifest_path)
+
+    # Each shard extracts the patients whose ID hashes to it, the machines of a sharded run share no state
+    if shard is not None:
+        images_path, masks_path, patient_ids = utils.select_shard(images_path, masks_path, patient_ids, *shard)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(patient_ids)} patients to extract")
+        if not patient_ids:
+            # A shard of a small cohort can be empty, its empty output is still needed by the merge
+            _touch_output(output_file, output_format)
+            return 0
+
+    from image_processing import iter_patient_image_mask, validate_cohort
+    from radiomics_2d_3d_extractors import (get_extractor, iter_radiomic_features, estimate_patient_costs,
+                                            prioritize_patients)
+    from feature_writers import append_features_csv, write_features_parquet, append_quarantine_csv
+
+    # Create extractor
+    extractor = get_extractor(extractor_config, share_filtered_images)
+
+    # Check every pair from the file headers, so that bad pairs are all reported before any voxel is read.
+    # The geometry only has to match where pyradiomics checks it: in 3D, unless it corrects the mask
+    invalid = {}
+    if validate:
+        check_geometry = mode == "3D" and not extractor.settings.get("correctMask", False)
+        invalid = validate_cohort(images_path, masks_path, patient_ids,
+                                  extractor.settings.get("geometryTolerance"), check_geometry)
+        for pr_id, problems in invalid.items():
+            for problem in problems:
+                print(f"Invalid patient {pr_id}: {problem}")
+        if invalid and validate_strict:
+            raise ValueError(f"{len(invalid)} invalid image and mask pairs, fix or remove them before the extraction")
+        if invalid:
+            print(f"Skipping {len(invalid)} invalid patients, they are listed in the run report")
+            valid = [i for i, pr_id in enumerate(patient_ids) if pr_id not in invalid]
+            images_path = [images_path[i] for i in valid]
+            masks_path = [masks_path[i] for i in valid]
+            patient_ids = [patient_ids[i] for i in valid]
+        if not patient_ids:
+            # Same as an empty shard: the output exists for the merge, and the report lists the invalid patients
+            _touch_output(output_file, output_format)
+            report_json, _ = utils.write_run_report(output_path, mode, time.perf_counter() - run_start, shard_suffix,
+                                                    invalid)
+            print(f"No valid patient to extract, the invalid patients are listed in {report_json}")
+            return 0
+
+    # Only a few patients are in flight, so a large lesion of a late patient would start last and run alone at
+    # the end: the masks are read first to estimate every patient, and such patients are extracted first.
+    # The output stays in patient order, their features are held until their turn
+    patient_order = None
+    if prioritize and n_workers > 1:
+        promoted = prioritize_patients(patient_ids, estimate_patient_costs(masks_path, patient_ids, extractor, mode),
+                                       n_workers)
+        if promoted:
+            print(f"Extracting {len(promoted)} patients with large lesions ahead of their turn")
+            patient_order = patient_ids
+            positions = {pr_id: i for i, pr_id in enumerate(patient_ids)}
+            promoted_set = set(promoted)
+            order = [positions[pr_id] for pr_id in promoted] + [i for i, pr_id in enumerate(patient_ids)
+                                                                  if pr_id not in promoted_set]
+            images_path = [images_path[i] for i in order]
+            masks_path = [masks_path[i] for i in order]
+            patient_ids = [patient_ids[i] for i in order]
+
+    # Stream the patients: each one is read, processed and released before the next ones,
+    # the next patients are read in the background while the current one is extracted
+    patients = iter_patient_image_mask(images_path, masks_path, patient_ids, mode, crop_padding, slice_engine,
+                                       prefetch)
+
+    # Features already extracted from the same files and configuration are read from the cache
+    cache = None
+    if use_cache:
+        from feature_cache import FeatureCache
+
+        cache = FeatureCache(os.path.join(output_path, "feature_cache"), extractor_config, cache_size_mb)
+
+    quarantined = []
+
+    def _quarantine(record):
+        quarantined.append(record)
+        append_quarantine_csv(record, quarantine_file, key_column)
+
+    # Extract radiomic features and append the rows of each patient as soon as it is done
+    n_rows = 0
+    for pr_id, patient_features in iter_radiomic_features(patients, extractor, mode, n_workers, extractor_config,
+                                                           skip_keys=completed_keys, cache=cache,
+                                                           job_timeout=job_timeout, job_memory_mb=job_memory_mb,
+                                                           quarantine=_quarantine, patient_order=patient_order):
+        if output_format == "parquet":
+            n_rows += write_features_parquet(patient_features, output_file, key_column, pr_id, feature_dtype)
+        else:
+            n_rows += append_features_csv(patient_features, output_file, key_column)
+
+    # The output of a completed shard exists even if the shard had no rows, so that the merge finds it
+    if shard is not None:
+        _touch_output(output_file, output_format)
+
+    print(f"Feature extraction completed successfully! {n_rows} rows added to {output_file}")
+    if quarantined:
+        print(f"{len(quarantined)} jobs exceeded job_timeout or job_memory_mb or crashed their worker, "
+              f"they are listed in {quarantine_file}")
+
+    if cache is not None:
+        cache.save()
+        print(f"Feature cache: {cache.hits} hits, {cache.misses} misses")
+
+    # Per-stage and per-patient timings, to spot slow stages and outlier patients
+    report_json, report_csv = utils.write_run_report(output_path, mode, time.perf_counter() - run_start,
+                                                       shard_suffix, invalid)
+    print(f"Run report saved in {report_json} and {report_csv}")
+    return 0
+
+
+# The pipeline runs under the main guard so that spawned worker processes can import this module safely
+if __name__ == "__main__":
+    sys.exit(main())
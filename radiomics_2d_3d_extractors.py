@@ -1,16 +1,168 @@
+import copy
 import os
 import numpy as np
 import SimpleITK as sitk
+import heapq
 import logging
-from radiomics import featureextractor
+import multiprocessing
+import threading
+import time
+from collections import deque
+from itertools import chain, count
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from radiomics import featureextractor, generalinfo, imageoperations
+from scipy.ndimage import find_objects
+import utils
+from feature_cache import file_digest
+from feature_table import FeatureTable
+from image_processing import extract_region_slice, slice_label_occupancy
 
+# Extractors built by get_extractor, keyed on the YAML file and the arguments; callers get copies
+_extractors = {}
 
-def get_extractor(yaml_path):
+# Extractor owned by a pool worker process, built once by _init_worker
+_worker_extractor = None
+
+# Key, start time and starting memory of the job run by a pool worker, watched by _watch_worker_job, and the
+# queue of its reports
+_worker_job = None
+_worker_reports = None
+
+# Volumes rebuilt by a pool worker from shared memory, reused by the next labels of the same patient
+_worker_volumes = {}
+_MAX_WORKER_VOLUMES = 4
+
+# Cost model of _estimate_job_costs: fixed work of a job in image voxels, and relative cost of a voxel of the
+# bounding box and of the ROI. These are relative weights that only order the jobs, not seconds; they were
+# fitted against extraction times with pyradiomics 3.0.1
+_JOB_BASE_COST = 50_000
+_BOX_VOXEL_WEIGHT = 10
+_ROI_VOXEL_WEIGHT = 10
+
+
+class SharedFilterExtractor(featureextractor.RadiomicsFeatureExtractor):
+    """
+    RadiomicsFeatureExtractor that computes the filtered images (e.g. Wavelet, LoG) of an image once for all its labels.
+
+    pyradiomics derives every enabled image type again on each execute call, so a patient with many labels
+    pays the filter cost once per label. When the same SimpleITK image is given for consecutive labels, this
+    extractor keeps the derived images of the latest image and only crops them to each label, which gives
+    the same features as RadiomicsFeatureExtractor.
+
+    The filtered images are computed again for each label, as pyradiomics does, when they depend on the
+    mask or the label: resampling, pre-cropping, resegmentation, LBP3D or voxel-based extraction.
+
+    The derived images of the latest image stay in memory until the next image, or until
+    release_filtered_images: about the size of the image times the number of derived images (e.g. 9 with
+    Original and Wavelet), in each worker process. The sequential extraction releases them after each patient.
+    Disable the share_filtered_images setting of config.ini when that does not fit in memory.
+    """
+
+    # Settings under which pyradiomics filters an image cropped or resampled around the label
+    _LABEL_DEPENDENT_SETTINGS = ("resampledPixelSpacing", "preCrop", "resegmentRange")
+
+    # Settings that select the label in the mask, given to the feature classes rather than to the filters
+    _LABEL_SETTINGS = ("label", "label_channel")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shared_key = None
+        self._shared_images = None
+
+    def release_filtered_images(self):
+        """
+        Forgets the filtered images of the latest image.
+        """
+        self._shared_key, self._shared_images = None, None
+
+    def _can_share(self):
+        return (not any(self.settings.get(name) for name in self._LABEL_DEPENDENT_SETTINGS)
+                and "LBP3D" not in self.enabledImagetypes)
+
+    def _filtered_images(self, source_image, image, mask, settings):
+        """
+        Gets the derived images of an image, computing them only for a new image or new settings.
+        """
+        key = (str({name: value for name, value in settings.items() if name not in self._LABEL_SETTINGS}),
+               str(self.enabledImagetypes))
+        if self._shared_key is None or self._shared_key[0] is not source_image or self._shared_key[1:] != key:
+            # Release the images of the previous volume before filtering the new one
+            self._shared_key, self._shared_images = None, None
+            generators = []
+            for image_type, custom_kwargs in self.enabledImagetypes.items():
+                args = settings.copy()
+                args.update(custom_kwargs)
+                generators = chain(generators, getattr(imageoperations, f"get{image_type}Image")(image, mask, **args))
+            self._shared_images = list(generators)
+            self._shared_key = (source_image, *key)
+        return self._shared_images
+
+    def execute(self, imageFilepath, maskFilepath, label=None, label_channel=None, voxelBased=False):
+        """
+        Computes the features of a label, reusing the filtered images of the previous call on the same image.
+
+        Args and return value are those of RadiomicsFeatureExtractor.execute.
+        """
+        if voxelBased or not isinstance(imageFilepath, sitk.Image) or not self._can_share():
+            return super().execute(imageFilepath, maskFilepath, label, label_channel, voxelBased)
+
+        # Same steps as RadiomicsFeatureExtractor.execute for a segment-based extraction
+        settings = self.settings.copy()
+        if label is not None:
+            settings["label"] = label
+        else:
+            label = settings.get("label", 1)
+        if label_channel is not None:
+            settings["label_channel"] = label_channel
+
+        if featureextractor.geometryTolerance != settings.get("geometryTolerance"):
+            self._setTolerance()
+
+        general_info = None
+        if settings.get("additionalInfo", False):
+            general_info = generalinfo.GeneralInfo()
+            general_info.addGeneralSettings(settings)
+            general_info.addEnabledImageTypes(self.enabledImagetypes)
+
+        feature_vector = {}
+        image, mask = self.loadImage(imageFilepath, maskFilepath, general_info, **settings)
+        bounding_box, corrected_mask = imageoperations.checkMask(image, mask, **settings)
+        if corrected_mask is not None:
+            if general_info is not None:
+                general_info.addMaskElements(image, corrected_mask, label, "corrected")
+            mask = corrected_mask
+
+        if general_info is not None:
+            feature_vector.update(general_info.getGeneralInfo())
+
+        feature_vector.update(self.computeShape(image, mask, bounding_box, **settings))
+
+        for input_image, image_type_name, input_kwargs in self._filtered_images(imageFilepath, image, mask, settings):
+            input_image, input_mask = imageoperations.cropToTumorMask(input_image, mask, bounding_box, padDistance=0)
+            # The settings stored with the shared images are those of the label they were first computed for
+            input_kwargs = {**input_kwargs, **{name: settings[name] for name in self._LABEL_SETTINGS if name in settings}}
+            feature_vector.update(self.computeFeatures(input_image, input_mask, image_type_name, **input_kwargs))
+
+        return feature_vector
+
+
+def get_extractor(yaml_path, share_filtered_images=True, settings=None):
     """
     Creates a RadiomicsFeatureExtractor with a specified configuration file.
 
+    The YAML file is parsed and validated once per process: extractors are memoized on the path, the
+    modification time and the content of the file, and on the other arguments. Each call returns its own
+    copy, which can be modified without affecting the other callers.
+
     Args:
         yaml_path (str): Path to the YAML file containing configuration parameters.
+        share_filtered_images (bool): If True, the filtered images of an image are computed once for all its
+            labels (see SharedFilterExtractor). Defaults to True.
+        settings (dict): pyradiomics settings overriding those of the YAML file, e.g. {"binWidth": 10}.
+            Defaults to None (the YAML settings).
 
     Returns:
         extractor: Configured RadiomicsFeatureExtractor object.
@@ -29,90 +181,934 @@ def get_extractor(yaml_path):
     if not os.path.isfile(yaml_path):
         raise FileNotFoundError(f"The file '{yaml_path}' does not exist.")
 
-    extractor = featureextractor.RadiomicsFeatureExtractor(yaml_path)
+    settings = settings or {}
+    key = (os.path.abspath(yaml_path), os.stat(yaml_path).st_mtime_ns, file_digest(yaml_path),
+           bool(share_filtered_images), repr(sorted(settings.items())))
+    extractor = _extractors.get(key)
+    if extractor is None:
+        if share_filtered_images:
+            extractor = SharedFilterExtractor(yaml_path, **settings)
+        else:
+            extractor = featureextractor.RadiomicsFeatureExtractor(yaml_path, **settings)
+        _extractors[key] = extractor
     # Configure logging for Pyradiomics
     logger = logging.getLogger('radiomics')  # Check log messages given by pyradiomics
     logger.setLevel(logging.ERROR)
 
-    return extractor
+    # The memoized extractor is never executed, copying it is much cheaper than parsing the YAML file again
+    return copy.deepcopy(extractor)
+
 
-def radiomic_extractor_3D(patient_dict_3D, extractor):
+def _warm_up(extractor):
     """
-    Extracts radiomic features from 3D medical images.
+    Runs an extractor once on a small phantom, so that the first job does not pay the one-time costs of
+    pyradiomics (lazy imports and initializations of the feature classes and filters).
 
     Args:
-        patient_dict_3D (dict): Dictionary containing patient 3D images and masks.
         extractor: Configured RadiomicsFeatureExtractor object.
+    """
+    mask_array = np.zeros((8, 8, 8), dtype=np.uint8)
+    mask_array[2:6, 2:6, 2:6] = 1
+    image_array = np.random.default_rng(0).normal(100, 10, mask_array.shape)
+    try:
+        extractor.execute(sitk.GetImageFromArray(image_array), sitk.GetImageFromArray(mask_array), label=1)
+    except Exception:
+        # Some configurations do not apply to the phantom (e.g. minimum ROI size), the jobs will warm up instead
+        pass
+    if isinstance(extractor, SharedFilterExtractor):
+        extractor.release_filtered_images()
+
+
+def _init_worker(yaml_path, job_timeout=None, job_memory_mb=None, reports=None, share_filtered_images=True):
+    """
+    Builds and warms up the RadiomicsFeatureExtractor of a pool worker process, before it gets any job.
+
+    Args:
+        yaml_path (str): Path to the YAML file containing configuration parameters.
+        job_timeout (float): Wall time, in seconds, after which a job kills its worker. Defaults to None.
+        job_memory_mb (float): Memory a job may add to its worker, in megabytes, above which the job kills its
+            worker. Defaults to None.
+        reports: Queue of the job starts and kills, read by _SupervisedPool. Defaults to None (no reports).
+        share_filtered_images (bool): Whether the worker computes the filtered images of an image once for all
+            its labels (see get_extractor). Defaults to True.
+    """
+    global _worker_extractor, _worker_reports
+    _worker_extractor = get_extractor(yaml_path, share_filtered_images)
+    _warm_up(_worker_extractor)
+    _worker_reports = reports
+    if job_timeout is not None or job_memory_mb is not None:
+        threading.Thread(target=_watch_worker_job, args=(job_timeout, job_memory_mb), name="job-watchdog",
+                         daemon=True).start()
+
+
+def _watch_worker_job(job_timeout, job_memory_mb, interval=0.1):
+    """
+    Kills the worker process when its job exceeds the time or memory limit, after reporting it.
+
+    The memory limit applies to the increase of the resident memory since the job started: the worker
+    already holds the pages shared with the parent process and its caches, which are not the job's.
+    pyradiomics cannot be interrupted inside execute, so the whole process is stopped; _SupervisedPool then
+    replaces the pool and quarantines the job.
+    """
+    while True:
+        time.sleep(interval)
+        current = _worker_job
+        if current is None:
+            continue
+        key, start, start_memory = current
+        seconds = time.perf_counter() - start
+        memory = None
+        if job_memory_mb is not None and start_memory is not None:
+            memory = utils.current_memory_mb() - start_memory
+        if job_timeout is not None and seconds > job_timeout:
+            reason = "timeout"
+        elif memory is not None and memory > job_memory_mb:
+            reason = "memory"
+        else:
+            continue
+        _worker_reports.put(("killed", key, os.getpid(), reason, seconds, memory))
+        os._exit(1)
+
+
+def _worker_ready():
+    """
+    Empty task submitted when a pool is created, so that its workers start and warm up while the first
+    patients are read.
+    """
+    return os.getpid()
+
+
+def _execute_job(extractor, job):
+    """
+    Runs pyradiomics on a single (patient, label) or (patient, slice, label) job.
+
+    Args:
+        extractor: Configured RadiomicsFeatureExtractor object.
+        job (dict): Job with the image, the mask and the label to extract.
+
+    Returns:
+        tuple: Features extracted by pyradiomics (None if the extraction failed), the wall time in seconds,
+            the peak increase of the resident memory of the process over the start of the job and its peak
+            resident memory in megabytes (see utils.start_peak_tracking), and its PID.
+    """
+    start, tracker = time.perf_counter(), utils.start_peak_tracking()
+    try:
+        image, mask = job["Image"], job["Mask"]
+        region = job.get("Region")
+        if region is not None:
+            # Slice of a shared volume (see image_processing.get_volume_2D), only built while it is extracted
+            image, mask = extract_region_slice(image, mask, region["RegionLabel"], job["Label"],
+                                               region["SliceIndex"], region["Box"], region["MaskDType"])
+        features = extractor.execute(image, mask, label=int(job["Label"]))
+    except Exception as e:
+        logging.error(f"[Invalid Feature] for {job['Description']}: {e}")
+        features = None
+    seconds = time.perf_counter() - start
+    memory, peak_memory = utils.stop_peak_tracking(tracker)
+    return features, seconds, memory, peak_memory, os.getpid()
+
+
+def _share_volume(image, shared_blocks):
+    """
+    Copies a SimpleITK image into a shared memory block, so that pool workers can read it without pickling.
+
+    Args:
+        image (sitk.Image): Image to share.
+        shared_blocks (list): Shared memory blocks of the patient, the new block is appended to it.
 
     Returns:
-        dict: Extracted features for each patient and label.
+        dict: Handle with the block name, the array layout and the image geometry.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+    return {
+        "SharedName": block.name,
+        "Shape": array.shape,
+        "DType": array.dtype.str,
+        "IsVector": image.GetNumberOfComponentsPerPixel() > 1,
+        "Spacing": image.GetSpacing(),
+        "Origin": image.GetOrigin(),
+        "Direction": image.GetDirection()
+    }
+
+
+def _share_job_volumes(jobs):
     """
-    all_features = {}
+    Replaces the 3D volumes used by several jobs with shared memory handles.
 
-    for pr_id, patient_data in patient_dict_3D.items():
-        patient_volume = patient_data[0]
+    The volumes of a many-lesion patient are then copied once to shared memory instead of being
+    pickled for every label.
+
+    Args:
+        jobs (list): Jobs of one patient, updated in place.
+
+    Returns:
+        list: Shared memory blocks to release once the jobs are done.
+    """
+    shared_blocks = []
+    uses = {}
+    for job in jobs:
+        for field in ("Image", "Mask"):
+            uses[id(job[field])] = uses.get(id(job[field]), 0) + 1
+
+    handles = {}
+    for job in jobs:
+        for field in ("Image", "Mask"):
+            volume = job[field]
+            # 2D slices are small enough to be pickled
+            if uses[id(volume)] > 1 and volume.GetDimension() == 3:
+                if id(volume) not in handles:
+                    handles[id(volume)] = _share_volume(volume, shared_blocks)
+                job[field] = handles[id(volume)]
+
+    return shared_blocks
+
+
+def _release_shared(shared_blocks):
+    """
+    Frees the shared memory blocks of a patient.
+    """
+    for block in shared_blocks:
+        block.close()
+        block.unlink()
+
+
+def _load_volume(volume):
+    """
+    Gets the image of a job in a pool worker, rebuilding it from shared memory when needed.
+    """
+    if isinstance(volume, sitk.Image):
+        return volume
+
+    name = volume["SharedName"]
+    if name not in _worker_volumes:
+        block = SharedMemory(name=name)
+        try:
+            array = np.ndarray(volume["Shape"], dtype=np.dtype(volume["DType"]), buffer=block.buf)
+            image = sitk.GetImageFromArray(array, isVector=volume["IsVector"])
+        finally:
+            block.close()
+        image.SetSpacing(volume["Spacing"])
+        image.SetOrigin(volume["Origin"])
+        image.SetDirection(volume["Direction"])
+
+        # Only the volumes of the latest patients are kept
+        while len(_worker_volumes) >= _MAX_WORKER_VOLUMES:
+            _worker_volumes.pop(next(iter(_worker_volumes)))
+        _worker_volumes[name] = image
+
+    return _worker_volumes[name]
+
+
+def _execute_job_in_worker(job):
+    """
+    Runs a job inside a pool worker with the extractor built by _init_worker.
+    """
+    global _worker_job
+    if _worker_reports is not None:
+        _worker_reports.put(("start", job["Key"], os.getpid()))
+    start = time.perf_counter()
+    try:
+        # The volumes rebuilt from shared memory belong to the patient, so the memory of the job is measured
+        # once they are loaded
+        job = {**job, "Image": _load_volume(job["Image"]), "Mask": _load_volume(job["Mask"])}
+        _worker_job = (job["Key"], start, utils.current_memory_mb())
+        return _execute_job(_worker_extractor, job)
+    finally:
+        _worker_job = None
+
+
+class _PoolJob:
+    """
+    Job submitted to a _SupervisedPool, with its estimated cost, its current future and, once known, its result.
+    """
+
+    __slots__ = ("job", "cost", "future", "outcome")
+
+    def __init__(self, job, cost=0, outcome=None):
+        self.job = job
+        self.cost = cost
+        self.future = None
+        self.outcome = outcome
+
+
+class _SupervisedPool:
+    """
+    Process pool that runs the most expensive jobs first and kills the workers of jobs exceeding a limit.
+
+    Jobs wait in a queue ordered by estimated cost, largest first (LPT scheduling), and only one more job
+    than there are workers is handed to the ProcessPoolExecutor, so that an expensive job read late still
+    starts before the cheap ones read earlier, and the cheap ones fill in at the end.
+
+    A killed or crashed worker breaks the whole ProcessPoolExecutor: the executor is then replaced and the
+    unfinished jobs are queued again, except the offending ones, which are quarantined. A job is
+    quarantined when it exceeds a limit, or when it was running during two worker crashes (e.g. a
+    segmentation fault): the crashed worker cannot be told apart from the ones stopped with it, so the
+    jobs running during a crash are run again one at a time.
+    """
+
+    def __init__(self, n_workers, yaml_path, job_timeout=None, job_memory_mb=None, on_quarantine=None,
+                 share_filtered_images=True):
+        """
+        Args:
+            n_workers (int): Number of worker processes.
+            yaml_path (str): Path to the YAML file each worker builds its own extractor from.
+            job_timeout (float): Maximum wall time of a job, in seconds. Defaults to None (no limit).
+            job_memory_mb (float): Maximum memory a job may add to its worker, in megabytes. Defaults to None
+                (no limit).
+            on_quarantine (callable): Called with the record of each quarantined job. Defaults to None.
+            share_filtered_images (bool): Whether the workers share the filtered images of an image between
+                its labels (see get_extractor). Defaults to True.
+        """
+        self._n_workers = n_workers
+        self._initargs = (yaml_path, job_timeout, job_memory_mb)
+        self._share_filtered_images = share_filtered_images
+        self._on_quarantine = on_quarantine
+        # Jobs without a result yet: waiting in the queue (a heap of (-cost, order, job)), or in the executor
+        self._pending = {}
+        self._queue = []
+        self._order = count()
+        self._submitted = set()
+        self._crashes = {}
+        self._suspects = deque()
+        self._suspect = None
+
+        # Reports of the workers, read on a thread so that the workers never block on a full pipe, and only
+        # looked at once that thread has stopped
+        self._running = {}
+        self._killed = {}
+
+        self._executor = self._start()
+
+    def _start(self):
+        # Each executor gets its own report queue: a worker terminated while writing to it keeps its lock
+        self._reports = multiprocessing.get_context().SimpleQueue()
+        self._stopped = threading.Event()
+        self._listener = threading.Thread(target=self._listen, args=(self._reports, self._stopped),
+                                          name="job-reports", daemon=True)
+        self._listener.start()
+
+        # Workers forked before the first shared volume would start their own resource tracker, which unlinks
+        # the shared volumes they opened when they are killed
+        resource_tracker.ensure_running()
+        executor = ProcessPoolExecutor(max_workers=self._n_workers, initializer=_init_worker,
+                                       initargs=(*self._initargs, self._reports, self._share_filtered_images))
+        # Workers are otherwise only started by the first jobs
+        for _ in range(self._n_workers):
+            executor.submit(_worker_ready)
+        return executor
+
+    def _stop(self):
+        """
+        Stops the executor and reads the last reports of its workers.
+        """
+        self._executor.shutdown(wait=True)
+        # Every worker has exited, so nothing is written to the queue anymore
+        self._stopped.set()
+        self._listener.join()
+        self._reports.close()
+
+    def _listen(self, reports, stopped):
+        # Only the workers write to the queue, so it is polled until they are stopped and it is empty
+        while True:
+            if reports.empty():
+                if stopped.wait(0.05) and reports.empty():
+                    return
+                continue
+            message = reports.get()
+            if message[0] == "start":
+                self._running[message[2]] = message[1]
+            else:
+                self._killed[message[1]] = message[3:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop()
+
+    def submit(self, job, cost=0, outcome=None):
+        """
+        Queues a job by estimated cost, or records the known result of a job (e.g. a cache hit).
+        """
+        pool_job = _PoolJob(job, cost, outcome)
+        if outcome is None:
+            self._pending[pool_job] = None
+            heapq.heappush(self._queue, (-cost, next(self._order), pool_job))
+            try:
+                self._dispatch()
+            except BrokenProcessPool:
+                # Recovered by the next call to result
+                pass
+        return pool_job
+
+    def _dispatch(self):
+        """
+        Collects the finished jobs and hands the queued ones to the executor, largest first, the suspects of
+        a crash before them and one at a time.
+
+        Raises:
+            BrokenProcessPool: If a worker was killed or crashed.
+        """
+        for pool_job in [pool_job for pool_job in self._submitted if pool_job.future.done()]:
+            self._submitted.discard(pool_job)
+            if not pool_job.future.cancelled():
+                pool_job.outcome = pool_job.future.result()
+
+        while len(self._submitted) <= self._n_workers:
+            if self._suspects and (self._suspect is None or self._suspect.future.done()):
+                pool_job = self._suspects[0]
+            elif self._queue:
+                pool_job = self._queue[0][2]
+            else:
+                return
+            # Taken off the queue once submitted, so that a broken executor does not lose it
+            pool_job.future = self._executor.submit(_execute_job_in_worker, pool_job.job)
+            if self._suspects and pool_job is self._suspects[0]:
+                self._suspect = self._suspects.popleft()
+            else:
+                heapq.heappop(self._queue)
+            self._submitted.add(pool_job)
+
+    def result(self, pool_job):
+        """
+        Waits for the result of a job, replacing the pool if a worker was killed or crashed meanwhile.
+
+        The queue is dispatched every time a job finishes, so the workers are kept busy while waiting.
+
+        Returns:
+            tuple: Result of _execute_job, with no features for a quarantined job.
+        """
+        while pool_job.outcome is None:
+            try:
+                self._dispatch()
+            except BrokenProcessPool:
+                self._recover()
+                continue
+            if pool_job.outcome is None:
+                wait([job.future for job in self._submitted], return_when=FIRST_COMPLETED)
+        self._pending.pop(pool_job, None)
+        return pool_job.outcome
+
+    def cancel(self, pool_jobs):
+        """
+        Drops the queued jobs and waits for the ones in the executor.
+        """
+        futures = [pool_job.future for pool_job in pool_jobs if pool_job.future is not None]
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        for pool_job in pool_jobs:
+            self._pending.pop(pool_job, None)
+        self._queue = [entry for entry in self._queue if entry[2] in self._pending]
+        heapq.heapify(self._queue)
+        self._suspects = deque(suspect for suspect in self._suspects if suspect in self._pending)
+
+    def _recover(self):
+        self._stop()
+        killed, running = dict(self._killed), set(self._running.values())
+        self._killed.clear()
+        self._running.clear()
+
+        self._executor = self._start()
+        self._submitted = set()
+        self._suspect = None
+        for pool_job in list(self._pending):
+            future = pool_job.future
+            # Jobs still waiting in the queue, and cancelled jobs
+            if future is None or future.cancelled():
+                continue
+            if future.done() and future.exception() is None:
+                pool_job.outcome = future.result()
+                continue
+
+            pool_job.future = None
+            key = pool_job.job["Key"]
+            if key in killed:
+                self._quarantine(pool_job, *killed[key])
+            elif not killed and key in running:
+                self._crashes[key] = self._crashes.get(key, 0) + 1
+                if self._crashes[key] >= 2:
+                    self._quarantine(pool_job, "crash", None, None)
+                else:
+                    self._suspects.append(pool_job)
+            else:
+                heapq.heappush(self._queue, (-pool_job.cost, next(self._order), pool_job))
+
+    def _quarantine(self, pool_job, reason, seconds, memory):
+        job = pool_job.job
+        pool_job.outcome = (None, None, None, None, None)
+        utils.record_stage("quarantine", seconds or 0.0, job["Metadata"]["PatientID"], job["Key"], memory=memory)
+        logging.error(f"[Quarantined Job] {job['Description']}: {reason}"
+                      + (f" after {seconds:.1f} s" if seconds is not None else "")
+                      + (f" at {memory:.0f} MB" if memory is not None else ""))
+        if self._on_quarantine is not None:
+            self._on_quarantine({"Key": job["Key"], "PatientID": job["Metadata"]["PatientID"], "Reason": reason,
+                                 "Seconds": seconds, "MemoryMB": memory, "Description": job["Description"]})
+
+
+def _collect_results(jobs, results, cache=None, cache_keys=None, costs=None):
+    """
+    Pairs each job key with its metadata and features, dropping the failed jobs.
+
+    The extraction time of every job is recorded with its estimated cost, and the features computed
+    by this run are stored in the cache under their cache key, if any.
+    """
+    all_features = FeatureTable(max(len(jobs), 1))
+    for i, (job, (features, seconds, memory, peak_memory, worker)) in enumerate(zip(jobs, results)):
+        if seconds is not None:
+            voxels = features.get("diagnostics_Mask-original_VoxelNum") if features else None
+            utils.record_stage("extraction", seconds, job["Metadata"]["PatientID"], job["Key"], voxels,
+                               memory, worker, costs[i] if costs is not None else None, peak_memory)
+        if features is None:
+            continue
+        if cache is not None and cache_keys[i] is not None:
+            cache.put(cache_keys[i], features)
+        all_features.append(job["Key"], {**job["Metadata"], **features})
+    return all_features
+
+
+def _iter_patient_results(patients, get_jobs, extractor, n_workers=1, yaml_path=None, skip_keys=None, cache=None,
+                          job_timeout=None, job_memory_mb=None, quarantine=None):
+    """
+    Runs the extraction jobs of a stream of patients, sequentially or on a process pool.
+
+    With a pool, new patients are only read while fewer than two jobs per worker are in flight,
+    so memory stays bounded by a few patients while every worker is kept busy. The jobs in flight
+    are run largest estimated cost first (see _SupervisedPool).
+
+    Args:
+        patients (iterable): (patient ID, patient data) tuples.
+        get_jobs (callable): _get_jobs_3D or _get_jobs_2D.
+        extractor: Configured RadiomicsFeatureExtractor object, used when n_workers is 1, and to estimate the
+            cost of the jobs. The workers build the same kind of extractor (see SharedFilterExtractor).
+        n_workers (int): Number of worker processes. Defaults to 1 (no pool).
+        yaml_path (str): Path to the YAML file each worker builds its own extractor from.
+        skip_keys (set): Keys of the jobs already extracted, which are not run again.
+        cache (FeatureCache): Cache of previously extracted features; only misses are extracted.
+        job_timeout (float): Maximum wall time of a job, in seconds. Jobs then run on a pool, even with one
+            worker. Defaults to None (no limit).
+        job_memory_mb (float): Maximum memory a job may add to its worker, in megabytes. Defaults to None
+            (no limit).
+        quarantine (callable): Called with the record of each job stopped by a limit (see _SupervisedPool).
+
+    Yields:
+        tuple: Patient ID and the extracted features of each of its jobs, in patient order.
+    """
+    skip_keys = skip_keys or set()
+
+    def _pending_jobs(pr_id, patient_data):
+        jobs = [job for job in get_jobs(pr_id, patient_data) if job["Key"] not in skip_keys]
+        cache_keys = [cache.job_key(job) if cache is not None else None for job in jobs]
+        cached = [cache.get(key) if key is not None else None for key in cache_keys]
+        # Only the misses have to be stored once extracted
+        cache_keys = [key if hit is None else None for key, hit in zip(cache_keys, cached)]
+        misses = [job for job, hit in zip(jobs, cached) if hit is None]
+        costs = iter(_estimate_job_costs(misses, n_images))
+        costs = [next(costs) if hit is None else None for hit in cached]
+        return jobs, cache_keys, cached, costs
+
+    n_images = _count_derived_images(extractor)
+
+    if n_workers == 1 and job_timeout is None and job_memory_mb is None:
+        for pr_id, patient_data in patients:
+            jobs, cache_keys, cached, costs = _pending_jobs(pr_id, patient_data)
+            results = [(hit, None, None, None, None) if hit is not None else _execute_job(extractor, job)
+                       for job, hit in zip(jobs, cached)]
+            # No later job uses the filtered images of this patient, only hold them while its labels run
+            if isinstance(extractor, SharedFilterExtractor):
+                extractor.release_filtered_images()
+            yield pr_id, _collect_results(jobs, results, cache, cache_keys, costs)
+        return
+
+    with _SupervisedPool(n_workers, yaml_path, job_timeout, job_memory_mb, quarantine,
+                         isinstance(extractor, SharedFilterExtractor)) as pool:
+        in_flight = deque()
+        n_in_flight = 0
+        try:
+            for pr_id, patient_data in patients:
+                jobs, cache_keys, cached, costs = _pending_jobs(pr_id, patient_data)
+                # The labels of a volume run concurrently on the workers, all reading the same shared copy
+                shared_blocks = _share_job_volumes([job for job, hit in zip(jobs, cached) if hit is None])
+                pool_jobs = [pool.submit(job, cost, None if hit is None else (hit, None, None, None, None))
+                             for job, hit, cost in zip(jobs, cached, costs)]
+                in_flight.append((pr_id, jobs, cache_keys, costs, pool_jobs, shared_blocks))
+                n_in_flight += len(jobs)
+                # Results are yielded in patient order, so the output matches the sequential path
+                while in_flight and n_in_flight - len(in_flight[0][1]) >= 2 * n_workers:
+                    done_id, done_jobs, done_keys, done_costs, pool_jobs, done_blocks = in_flight.popleft()
+                    n_in_flight -= len(done_jobs)
+                    results = [pool.result(pool_job) for pool_job in pool_jobs]
+                    _release_shared(done_blocks)
+                    yield done_id, _collect_results(done_jobs, results, cache, done_keys, done_costs)
+            while in_flight:
+                done_id, done_jobs, done_keys, done_costs, pool_jobs, done_blocks = in_flight.popleft()
+                results = [pool.result(pool_job) for pool_job in pool_jobs]
+                _release_shared(done_blocks)
+                yield done_id, _collect_results(done_jobs, results, cache, done_keys, done_costs)
+        finally:
+            # Interrupted run: cancel the queued jobs and wait for the running ones before freeing their memory
+            for _, _, _, _, pool_jobs, shared_blocks in in_flight:
+                pool.cancel(pool_jobs)
+                _release_shared(shared_blocks)
+
+
+def _check_workers(n_workers, yaml_path, job_timeout=None, job_memory_mb=None):
+    """
+    Validates the process pool settings.
+
+    Raises:
+        TypeError: If n_workers is not an integer.
+        ValueError: If n_workers is lower than 1, if a job limit is not positive or if yaml_path is
+            missing for a pool.
+    """
+    if not isinstance(n_workers, int) or isinstance(n_workers, bool):
+        raise TypeError("n_workers must be an integer.")
+    if n_workers < 1:
+        raise ValueError("n_workers must be at least 1.")
+    for name, limit in [("job_timeout", job_timeout), ("job_memory_mb", job_memory_mb)]:
+        if limit is not None and not limit > 0:
+            raise ValueError(f"{name} must be positive.")
+    if n_workers > 1 and not yaml_path:
+        raise ValueError("yaml_path is required when n_workers is greater than 1.")
+    if (job_timeout is not None or job_memory_mb is not None) and not yaml_path:
+        raise ValueError("yaml_path is required when a job limit is set.")
+
+
+def _get_jobs_3D(pr_id, patient_data):
+    """
+    Builds one extraction job per label of a patient 3D volume.
+
+    Args:
+        pr_id: Patient ID.
+        patient_data (list): Volume dictionaries of the patient: either the whole volume, whose labels
+            are read from the mask, or one volume cropped around each label.
+
+    Returns:
+        list: Jobs in label order.
+    """
+    jobs = []
+
+    for patient_volume in patient_data:
         img = patient_volume["ImageVolume"]
         mask = patient_volume["MaskVolume"]
-        # Convert SimpleITK Image to NumPy array for processing
-        mask_array = sitk.GetArrayFromImage(mask)
 
-        # Get unique labels, excluding 0 (background label)
-        labels = np.unique(mask_array)[1:]
-        # labels = np.unique(mask)[1:]
+        if "Label" in patient_volume:
+            labels = [patient_volume["Label"]]
+        else:
+            # Convert SimpleITK Image to NumPy array for processing
+            mask_array = sitk.GetArrayFromImage(mask)
 
-        if len(labels) == 0:
-            raise ValueError(f"No labels found in mask for patient {pr_id}")
+            # Get unique labels, excluding 0 (background label)
+            labels = np.unique(mask_array)
+            labels = labels[labels != 0]
 
         for lbl in labels:
-            try:
-                features = extractor.execute(img, mask, label=int(lbl))
-                features = {"MaskLabel": lbl, "PatientID": pr_id, **features}
-                all_features[f"PR{pr_id} - {lbl:d}"] = features
-            except Exception as e:
-                logging.error(f"[Invalid Feature] for patient PR{pr_id}, label {lbl}: {e}")
+            # Labels of a float mask of whole numbers (see image_processing.check_image_mask_headers)
+            if isinstance(lbl, (float, np.floating)):
+                lbl = int(lbl)
+            jobs.append({
+                "Key": f"PR{pr_id} - {lbl:d}",
+                "Description": f"patient PR{pr_id}, label {lbl}",
+                "Metadata": {"MaskLabel": lbl, "PatientID": pr_id},
+                "Source": {"ImagePath": patient_volume.get("ImagePath"), "MaskPath": patient_volume.get("MaskPath"),
+                           "Mode": "3D", "SliceIndex": None, "CropPadding": patient_volume.get("CropPadding")},
+                "Image": img,
+                "Mask": mask,
+                "Label": lbl
+            })
 
-    return all_features
+    if len(jobs) == 0:
+        raise ValueError(f"No labels found in mask for patient {pr_id}")
 
+    return jobs
 
 
-def radiomic_extractor_2D(patient_dict_2D, extractor):
+def _get_jobs_2D(patient_id, patient_slices):
     """
-    Extracts radiomic features from 2D medical image slices.
+    Builds one extraction job per slice and label of a patient.
+
+    Args:
+        patient_id: Patient ID.
+        patient_slices (list): Slice dictionaries of the patient.
+
+    Returns:
+        list: Jobs in slice order.
+    """
+    jobs = []
+
+    for slice_data in patient_slices:
+        if "SliceRegions" in slice_data:
+            jobs.extend(_get_volume_jobs_2D(patient_id, slice_data))
+            continue
+
+        lbl = slice_data["Label"]
+        index = slice_data["SliceIndex"]
+
+        if lbl == 0:
+            raise ValueError(f"No labels found in mask for patient {patient_id}")
+
+        jobs.append({
+            "Key": f"{patient_id}-{index}-{lbl}",
+            "Description": f"patient {patient_id}, Slice {index}, Label {lbl}",
+            "Metadata": {"MaskLabel": lbl, "SliceIndex": index, "PatientID": patient_id},
+            "Source": {"ImagePath": slice_data.get("ImagePath"), "MaskPath": slice_data.get("MaskPath"),
+                       "Mode": "2D", "SliceIndex": index, "CropPadding": slice_data.get("CropPadding")},
+            "Image": slice_data["ImageSlice"],
+            "Mask": slice_data["MaskSlice"],
+            "Label": lbl
+        })
+
+    return jobs
+
+
+def _get_volume_jobs_2D(patient_id, volume_data):
+    """
+    Builds one extraction job per slice and label of a volume prepared by image_processing.get_volume_2D.
+
+    Every job refers to the same image and region volumes, its slice being extracted by _execute_job.
+
+    Args:
+        patient_id: Patient ID.
+        volume_data (dict): Volume dictionary with the image, the region volume and the slice regions.
+
+    Returns:
+        list: Jobs in slice order, with the same keys as the jobs of _get_jobs_2D.
+    """
+    jobs = []
+    first_slice = volume_data.get("FirstSlice", 0)
+
+    for region_label, slice_idx, lbl, box in volume_data["SliceRegions"]:
+        index = first_slice + slice_idx
+        jobs.append({
+            "Key": f"{patient_id}-{index}-{lbl}",
+            "Description": f"patient {patient_id}, Slice {index}, Label {lbl}",
+            "Metadata": {"MaskLabel": lbl, "SliceIndex": index, "PatientID": patient_id},
+            "Source": {"ImagePath": volume_data.get("ImagePath"), "MaskPath": volume_data.get("MaskPath"),
+                       "Mode": "2D", "SliceIndex": index, "CropPadding": volume_data.get("CropPadding")},
+            "Image": volume_data["ImageVolume"],
+            "Mask": volume_data["RegionVolume"],
+            "Label": lbl,
+            "Region": {"RegionLabel": region_label, "SliceIndex": slice_idx, "Box": box,
+                       "MaskDType": volume_data["MaskDType"]}
+        })
+
+    return jobs
+
+
+def _count_derived_images(extractor):
+    """
+    Counts the images pyradiomics derives from each job with the enabled image types.
 
     Args:
-        patient_dict_2D (dict): Dictionary containing patient 2D slices.
         extractor: Configured RadiomicsFeatureExtractor object.
 
     Returns:
-        dict: Extracted features for each patient slice and label.
+        int: Number of derived images, e.g. 10 for Original, Wavelet and LoG with one sigma.
+    """
+    image_types = getattr(extractor, "enabledImagetypes", None)
+    # Extractors without pyradiomics image types only compute the original image
+    if not isinstance(image_types, dict):
+        return 1
+
+    n_images = 0
+    for image_type, custom_kwargs in image_types.items():
+        if image_type == "Wavelet":
+            n_images += 8
+        elif image_type == "LoG":
+            n_images += len(custom_kwargs.get("sigma", extractor.settings.get("sigma", [])))
+        else:
+            n_images += 1
+    return n_images
+
+
+def _label_statistics(mask_array):
+    """
+    Counts the voxels and the bounding box voxels of every label of a mask array, in one pass.
+
+    Returns:
+        dict: (voxels, bounding box voxels) tuple of each non-zero label.
+    """
+    labels, counts = np.unique(mask_array, return_counts=True)
+    boxes = find_objects(mask_array) if np.issubdtype(mask_array.dtype, np.integer) and labels[0] >= 0 else []
+
+    statistics = {}
+    for label, voxels in zip(labels.tolist(), counts.tolist()):
+        if label == 0:
+            continue
+        box = boxes[int(label) - 1] if 0 < label <= len(boxes) else None
+        box_voxels = int(np.prod([s.stop - s.start for s in box])) if box is not None else mask_array.size
+        statistics[int(label)] = (voxels, box_voxels)
+    return statistics
+
+
+def _estimate_job_costs(jobs, n_images):
+    """
+    Estimates the cost of jobs before they run, so that the most expensive ones are scheduled first.
+
+    For each derived image, pyradiomics checks the mask and computes the diagnostics over the whole
+    image, then the features over the bounding box of the ROI, where the texture matrices and the shape
+    cost about ten times more per voxel. A job then costs about _JOB_BASE_COST + n_images * (image voxels
+    + _BOX_VOXEL_WEIGHT * bounding box voxels + _ROI_VOXEL_WEIGHT * ROI voxels), in image voxels. The run
+    report compares these estimates with the extraction times (see utils.summarize_cost_estimates).
+
+    Args:
+        jobs (list): Jobs of a patient, before their volumes are shared.
+        n_images (int): Number of derived images, from _count_derived_images.
+
+    Returns:
+        list: Estimated cost of each job.
     """
-    all_features_2D = {}
+    statistics = {}
+    costs = []
+    for job in jobs:
+        region = job.get("Region")
+        if region is not None:
+            # Slice of a region volume, cropped to its box by _execute_job
+            box = sitk.GetArrayViewFromImage(job["Mask"])[region["SliceIndex"]][region["Box"]]
+            image_voxels = box_voxels = box.size
+            voxels = int(np.count_nonzero(box == region["RegionLabel"]))
+        else:
+            # The labels of a volume are counted together
+            mask = job["Mask"]
+            if id(mask) not in statistics:
+                statistics[id(mask)] = _label_statistics(sitk.GetArrayViewFromImage(mask))
+            image_voxels = mask.GetNumberOfPixels()
+            voxels, box_voxels = statistics[id(mask)].get(int(job["Label"]), (0, 0))
+        costs.append(_job_cost(n_images, image_voxels, box_voxels, voxels))
+    return costs
 
-    for patient_id, patient_slices in patient_dict_2D.items():
-        for slice_data in patient_slices:
-            lbl = slice_data["Label"]
-            index = slice_data["SliceIndex"]
 
-            if lbl == 0:
-                raise ValueError(f"No labels found in mask for patient {patient_id}")
+def _job_cost(n_images, image_voxels, box_voxels, voxels):
+    """
+    Cost of one job in image voxels, see _estimate_job_costs.
+    """
+    return _JOB_BASE_COST + n_images * (image_voxels + _BOX_VOXEL_WEIGHT * box_voxels + _ROI_VOXEL_WEIGHT * voxels)
+
+
+def estimate_patient_costs(masks_path, patient_ids, extractor, mode="3D"):
+    """
+    Estimates the cost of every patient from its mask alone, before any image is read.
+
+    The jobs are only known once a patient is read, and they are scheduled largest first among the few patients
+    in flight (see _iter_patient_results). This cheap pass over the masks gives the cost of every patient up
+    front, so that prioritize_patients can move a large lesion of a late patient ahead. The costs follow
+    _estimate_job_costs, except that in 2D the whole label of a slice stands for its largest region, and in 3D
+    the image is the whole mask even when it is cropped.
 
+    Args:
+        masks_path (list): Paths of the masks, in patient order.
+        patient_ids (list): Patient IDs, in the same order.
+        extractor: Configured RadiomicsFeatureExtractor object, whose derived images multiply the costs.
+        mode (str): Processing mode, either "2D" or "3D". Defaults to "3D".
+
+    Returns:
+        dict: (total cost, cost of the largest job) tuple of each patient ID. Patients whose mask cannot be
+            read are left out.
+    """
+    n_images = _count_derived_images(extractor)
+    costs = {}
+    with utils.timed_stage("cost_estimate"):
+        for pr_id, mask_path in zip(patient_ids, masks_path):
             try:
-                img_slice = slice_data["ImageSlice"]
-                mask_slice = slice_data["MaskSlice"]
-
-                features = extractor.execute(img_slice, mask_slice, label=int(lbl))
-
-                features = {"MaskLabel": lbl, "SliceIndex": index, "PatientID": patient_id, **features}
-                key = f"{patient_id}-{index}-{lbl}"
-                all_features_2D[key] = features
-                # Debug log to check if the key is being added
-                logging.debug(f"Added features for {key}: {features}")
-            except Exception as e:
-                logging.error(f"[Invalid Feature] for patient {patient_id}, Slice {index}, Label {lbl}: {e}")
+                mask_array = sitk.GetArrayFromImage(sitk.ReadImage(mask_path))
+            except RuntimeError:
+                # Reported by the validation or by the extraction, the patient keeps its turn
+                continue
+            if mode == "3D":
+                job_costs = [_job_cost(n_images, mask_array.size, box_voxels, voxels)
+                             for voxels, box_voxels in _label_statistics(mask_array).values()]
+            else:
+                job_costs = []
+                for _, _, voxels, (rows, cols) in slice_label_occupancy(mask_array):
+                    box_voxels = (rows.stop - rows.start) * (cols.stop - cols.start)
+                    job_costs.append(_job_cost(n_images, box_voxels, box_voxels, voxels))
+            costs[pr_id] = (sum(job_costs), max(job_costs, default=0))
+    return costs
+
+
+def prioritize_patients(patient_ids, patient_costs, n_workers):
+    """
+    Picks the patients to extract ahead of their turn, so that their largest job does not run alone at the end.
+
+    In patient order, a job starts once about the cost of the patients before it is extracted, spread over
+    n_workers, while the whole cohort could end at its total cost over n_workers. A patient is moved ahead when
+    its largest job would otherwise end after that, which never happens with a single worker, and when a patient
+    that is not moved comes before it.
+
+    Args:
+        patient_ids (list): Patient IDs, in patient order.
+        patient_costs (dict): (total cost, cost of the largest job) tuple of each patient ID, from
+            estimate_patient_costs. Patients without an estimate keep their turn.
+        n_workers (int): Number of worker processes.
+
+    Returns:
+        list: IDs of the patients to extract first, largest job first.
+    """
+    total_cost = sum(cost for cost, _ in patient_costs.values())
+    previous_cost = promoted_cost = 0
+    promoted = []
+    for pr_id in patient_ids:
+        cost, largest_cost = patient_costs.get(pr_id, (0, 0))
+        if previous_cost + n_workers * largest_cost > total_cost and previous_cost > promoted_cost:
+            promoted.append(pr_id)
+            promoted_cost += cost
+        previous_cost += cost
+    return sorted(promoted, key=lambda pr_id: patient_costs[pr_id][1], reverse=True)
+
+
+def radiomic_extractor_3D(patient_dict_3D, extractor, n_workers=1, yaml_path=None, cache=None):
+    """
+    Extracts radiomic features from 3D medical images.
+
+    Args:
+        patient_dict_3D (dict): Dictionary containing patient 3D images and masks.
+        extractor: Configured RadiomicsFeatureExtractor object.
+        n_workers (int): Number of worker processes extracting (patient, label) jobs. Defaults to 1.
+        yaml_path (str): Path to the YAML file used by the workers when n_workers is greater than 1.
+        cache (FeatureCache): Cache of previously extracted features. Defaults to None (no cache).
+
+    Returns:
+        FeatureTable: Extracted features of each patient and label, a mapping from each row key (e.g.
+            'PR1 - 2') to its features that can be used as the dictionary of rows.
+    """
+    _check_workers(n_workers, yaml_path)
+    all_features = FeatureTable()
+    patient_results = _iter_patient_results(patient_dict_3D.items(), _get_jobs_3D, extractor, n_workers, yaml_path,
+                                            cache=cache)
+    for _, features in patient_results:
+        all_features.extend(features)
+    return all_features
+
+
+def radiomic_extractor_2D(patient_dict_2D, extractor, n_workers=1, yaml_path=None, cache=None):
+    """
+    Extracts radiomic features from 2D medical image slices.
+
+    Args:
+        patient_dict_2D (dict): Dictionary containing patient 2D slices.
+        extractor: Configured RadiomicsFeatureExtractor object.
+        n_workers (int): Number of worker processes extracting (patient, slice, label) jobs. Defaults to 1.
+        yaml_path (str): Path to the YAML file used by the workers when n_workers is greater than 1.
+        cache (FeatureCache): Cache of previously extracted features. Defaults to None (no cache).
+
+    Returns:
+        FeatureTable: Extracted features of each patient slice and label, a mapping from each row key (e.g.
+            '1-3-2' for patient 1, slice 3, label 2) to its features that can be used as the dictionary of rows.
+    """
+    _check_workers(n_workers, yaml_path)
+    all_features_2D = FeatureTable()
+    patient_results = _iter_patient_results(patient_dict_2D.items(), _get_jobs_2D, extractor, n_workers, yaml_path,
+                                            cache=cache)
+    for _, features in patient_results:
+        all_features_2D.extend(features)
     return all_features_2D
 
 
-def extract_radiomic_features(patient_dict, extractor, mode="3D"):
+def extract_radiomic_features(patient_dict, extractor, mode="3D", n_workers=1, yaml_path=None, cache=None):
     """
     Extracts radiomic features from medical images in either 2D or 3D mode.
 
@@ -120,13 +1116,19 @@ def extract_radiomic_features(patient_dict, extractor, mode="3D"):
         patient_dict (dict): Dictionary containing patient data.
         extractor: Configured RadiomicsFeatureExtractor object.
         mode (str): Processing mode, either "2D" or "3D". Defaults to "3D".
+        n_workers (int): Number of worker processes. Defaults to 1 (sequential extraction).
+        yaml_path (str): Path to the YAML file each worker builds its own extractor from,
+            required when n_workers is greater than 1.
+        cache (FeatureCache): Cache of previously extracted features; extractor.execute is only
+            called on cache misses. Defaults to None (no cache).
 
     Returns:
-        dict: Extracted radiomic features.
+        FeatureTable: Extracted radiomic features, a mapping from each row key to its features.
 
     Raises:
-        ValueError: If mode is not "2D" or "3D" or if the extractor is not configured.
-        TypeError: If patient_dict is not a dictionary.
+        ValueError: If mode is not "2D" or "3D", if the extractor is not configured
+            or if the worker settings are invalid.
+        TypeError: If patient_dict is not a dictionary or n_workers is not an integer.
     """
     if not isinstance(patient_dict, dict):
         raise TypeError("patient_dict must be a dictionary.")
@@ -136,8 +1138,72 @@ def extract_radiomic_features(patient_dict, extractor, mode="3D"):
         raise ValueError("Extractor is not configured properly. Ensure it has the necessary methods.")
 
     if mode == "3D":
-        return radiomic_extractor_3D(patient_dict, extractor)
+        return radiomic_extractor_3D(patient_dict, extractor, n_workers, yaml_path, cache)
     else:
-        return radiomic_extractor_2D(patient_dict, extractor)
+        return radiomic_extractor_2D(patient_dict, extractor, n_workers, yaml_path, cache)
 
 
+def iter_radiomic_features(patients, extractor, mode="3D", n_workers=1, yaml_path=None, skip_keys=None, cache=None,
+                           job_timeout=None, job_memory_mb=None, quarantine=None, patient_order=None):
+    """
+    Extracts radiomic features from a stream of patients, one patient at a time.
+
+    Unlike extract_radiomic_features, the patients are consumed lazily (e.g. from
+    image_processing.iter_patient_image_mask), so only the patients being extracted are in memory.
+
+    Args:
+        patients (iterable): (patient ID, patient data) tuples.
+        extractor: Configured RadiomicsFeatureExtractor object.
+        mode (str): Processing mode, either "2D" or "3D". Defaults to "3D".
+        n_workers (int): Number of worker processes. Defaults to 1 (sequential extraction).
+        yaml_path (str): Path to the YAML file each worker builds its own extractor from,
+            required when n_workers is greater than 1.
+        skip_keys (set): Row keys already extracted by a previous run, which are skipped.
+        cache (FeatureCache): Cache of previously extracted features; extractor.execute is only
+            called on cache misses. Defaults to None (no cache).
+        job_timeout (float): Wall time, in seconds, after which a job is stopped and quarantined.
+            Defaults to None (no limit).
+        job_memory_mb (float): Memory a job may add to the resident memory of its worker, in megabytes,
+            above which it is stopped and quarantined (Linux only). Defaults to None (no limit).
+        quarantine (callable): Called with a dictionary describing each quarantined job (Key, PatientID,
+            Reason, Seconds, MemoryMB and Description). Quarantined jobs have no row in the output.
+        patient_order (list): IDs of all the patients in the order of the output, when they are read in
+            another order (see prioritize_patients). The features of a patient read ahead of its turn are held
+            until the patients before it are yielded. Defaults to None (the reading order).
+
+    Returns:
+        generator: (patient ID, FeatureTable of the features of the patient) tuples, in patient order.
+
+    Raises:
+        ValueError: If mode is not "2D" or "3D", if the extractor is not configured
+            or if the worker settings are invalid.
+        TypeError: If n_workers is not an integer.
+    """
+    if mode not in ["2D", "3D"]:
+        raise ValueError("Invalid mode. Choose either '2D' or '3D'.")
+    if not hasattr(extractor, 'execute'):
+        raise ValueError("Extractor is not configured properly. Ensure it has the necessary methods.")
+    _check_workers(n_workers, yaml_path, job_timeout, job_memory_mb)
+
+    get_jobs = _get_jobs_3D if mode == "3D" else _get_jobs_2D
+    results = _iter_patient_results(patients, get_jobs, extractor, n_workers, yaml_path, skip_keys, cache,
+                                    job_timeout, job_memory_mb, quarantine)
+    return results if patient_order is None else _in_patient_order(results, patient_order)
+
+
+def _in_patient_order(results, patient_order):
+    """
+    Yields the (patient ID, features) tuples of results in the order of patient_order, holding the patients
+    that arrive ahead of their turn. Patients missing from patient_order are yielded last.
+    """
+    positions = {pr_id: position for position, pr_id in enumerate(patient_order)}
+    held = {}
+    next_position = 0
+    for pr_id, features in results:
+        held[pr_id] = features
+        while next_position < len(patient_order) and patient_order[next_position] in held:
+            next_pr_id = patient_order[next_position]
+            yield next_pr_id, held.pop(next_pr_id)
+            next_position += 1
+    for pr_id in sorted(held, key=lambda held_id: positions.get(held_id, len(patient_order))):
+        yield pr_id, held[pr_id]
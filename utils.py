@@ -1,7 +1,30 @@
+import csv
 import glob
+import json
 import os
 import re
-import SimpleITK as sitk
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak memory is then not reported
+    resource = None
+
+# Timing records of the current run, one per stage execution
+_stage_records = []
+
+# Peak trackers of the stages running in this process, and peak resident memory of the process, both kept
+# across the resets of the kernel high-water mark (see start_peak_tracking)
+_memory_lock = threading.Lock()
+_peak_trackers = []
+_process_peak_mb = 0.0
+
+# Format of the cohort manifest written by discover_cohort
+_MANIFEST_VERSION = 1
 
 # Extract file and mask path
 def get_path_images_masks(path):
@@ -16,7 +39,8 @@ def get_path_images_masks(path):
     if not isinstance(path, str):
         raise TypeError("Path must be a string")
 
-    files = glob.glob(os.path.join(path, '*.nii'))
+    with timed_stage("discovery"):
+        files = glob.glob(os.path.join(path, '*.nii'))
 
     if not files:
         raise ValueError("The directory is empty or contains no .nii files")
@@ -111,6 +135,463 @@ def assign_patient_ids(images_path):
     return patient_ids
 
 
+def _scan_directory(path):
+    """
+    List the .nii files and the subdirectories of a directory.
+
+    :param path: Path to the directory.
+    :return: Manifest entry of the directory, with its mtime, its files (name -> [size, mtime]) and its subdirectories.
+    """
+    files, subdirs = {}, []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.endswith(".nii") and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+    return {"mtime_ns": os.stat(path).st_mtime_ns, "files": files, "subdirs": sorted(subdirs)}
+
+
+def _pair_images_masks(directory, names):
+    """
+    Pair the images and masks of a directory: 'PRn.nii' with 'PRn_seg.nii'.
+
+    Files are matched on their stem; if a single image and a single mask are left unmatched, as in
+    'Patient_n/' folders with differently named files, they are paired together.
+
+    :param directory: Path to the directory.
+    :param names: Names of the .nii files of the directory.
+    :return: List of (image path, mask path) tuples.
+    """
+    images = {name[:-len(".nii")]: name for name in sorted(names) if not name.endswith("seg.nii")}
+    masks = {name[:-len("seg.nii")].rstrip("_-"): name for name in sorted(names) if name.endswith("seg.nii")}
+
+    pairs = [(images.pop(stem), masks.pop(stem)) for stem in sorted(images.keys() & masks.keys())]
+    if len(images) == 1 and len(masks) == 1:
+        pairs.append((images.popitem()[1], masks.popitem()[1]))
+
+    for name in sorted([*images.values(), *masks.values()]):
+        print(f"No matching image or mask for '{os.path.join(directory, name)}', the file is skipped.")
+
+    return [(os.path.join(directory, img), os.path.join(directory, mask)) for img, mask in pairs]
+
+
+def _read_manifest(manifest_path):
+    """
+    Read the manifest of a previous discovery.
+
+    :param manifest_path: Path to the JSON manifest, or None.
+    :return: Manifest entries of the directories, empty if there is no usable manifest.
+    """
+    if manifest_path is None:
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != _MANIFEST_VERSION:
+        return {}
+    return manifest.get("directories", {})
+
+
+def discover_cohort(data_path, manifest_path=None):
+    """
+    Find the image and mask files of the cohort and assign a patient ID to each pair.
+
+    The data directory is walked recursively (e.g. 'data/Patient_*/'), and images are paired with their
+    masks by file stem within each directory. With a manifest, directories whose modification time did not
+    change since the previous run are not listed again, only new or modified directories are scanned.
+
+    Patients are returned sorted by ID, so the pairing and the order are the same on every run. IDs are taken
+    from the 'PR<number>' image file names; files without one, or with an ID already used, get the first
+    free ID.
+
+    :param data_path: Path to the data directory, or a glob pattern of directories (e.g. './data/*').
+    :param manifest_path: Path to the JSON manifest read and updated by the discovery. Defaults to None
+                          (no manifest).
+    :return: A tuple with the list of image paths, the list of mask paths and the list of patient IDs,
+             in the same order.
+    :raises TypeError: If data_path is not a string.
+    :raises ValueError: If no directory matches data_path or no image and mask pair is found.
+    """
+    if not isinstance(data_path, str):
+        raise TypeError("Path must be a string")
+
+    with timed_stage("discovery"):
+        if any(c in data_path for c in "*?["):
+            roots = sorted(p for p in glob.glob(data_path) if os.path.isdir(p))
+        else:
+            roots = [data_path] if os.path.isdir(data_path) else []
+        if not roots:
+            raise ValueError(f"No directory found for the data path '{data_path}'")
+
+        known = _read_manifest(manifest_path)
+        directories = {}
+        pairs = []
+        stack = list(reversed(roots))
+        while stack:
+            directory = stack.pop()
+            if directory in directories:
+                continue
+            entry = known.get(directory)
+            # Adding, removing or renaming a file or a subdirectory changes the directory mtime. A file rewritten
+            # in place does not: its size and mtime stay those of the last scan, the feature cache checks them again
+            if entry is None or entry["mtime_ns"] != os.stat(directory).st_mtime_ns:
+                entry = _scan_directory(directory)
+            directories[directory] = entry
+
+            pairs.extend(_pair_images_masks(directory, entry["files"]))
+            stack.extend(os.path.join(directory, name) for name in reversed(entry["subdirs"]))
+
+        if not pairs:
+            raise ValueError("The directory is empty or contains no .nii image and mask pairs")
+
+        # Explicit IDs are reserved before new ones are assigned, so a new ID never takes an existing one
+        extracted = [extract_id(img) for img, _ in pairs]
+        used = {pr_id for pr_id in extracted if pr_id is not None}
+        taken = set()
+        patients = []
+        for (img, mask), pr_id in zip(pairs, extracted):
+            if pr_id in taken:
+                print(f"Patient ID {pr_id} of {img} is already used by another image, a new ID will be assigned.")
+                pr_id = None
+            if pr_id is None:
+                pr_id = new_patient_id(used)
+                used.add(pr_id)
+            taken.add(pr_id)
+            patients.append((pr_id, img, mask))
+        patients.sort()
+
+        if manifest_path is not None:
+            manifest = {"version": _MANIFEST_VERSION, "data_path": data_path, "directories": directories,
+                        "patients": [{"PatientID": pr_id, "ImagePath": img, "MaskPath": mask}
+                                     for pr_id, img, mask in patients]}
+            tmp_path = f"{manifest_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+
+    patient_ids = [pr_id for pr_id, _, _ in patients]
+    images_path = [img for _, img, _ in patients]
+    masks_path = [mask for _, _, mask in patients]
+    return images_path, masks_path, patient_ids
+
+
+def parse_shard(spec):
+    """
+    Parse a shard specification such as '2/4' (second shard out of four).
+
+    :param spec: Shard specification 'i/N', with 1 <= i <= N.
+    :return: Tuple (i, N).
+    :raises TypeError: If spec is not a string.
+    :raises ValueError: If spec is not of the form 'i/N' or i is not between 1 and N.
+    """
+    if not isinstance(spec, str):
+        raise TypeError("The shard must be a string")
+
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec)
+    if match is None:
+        raise ValueError(f"Invalid shard '{spec}', expected 'i/N', e.g. '1/4'")
+
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{spec}', i must be between 1 and N")
+    return index, count
+
+
+def shard_of(patient_id, count):
+    """
+    Get the shard a patient is assigned to.
+
+    The assignment only depends on the patient ID, so every machine of a sharded run agrees on it
+    without any coordination.
+
+    :param patient_id: Patient ID.
+    :param count: Number of shards.
+    :return: Shard index, between 1 and count.
+    """
+    return zlib.crc32(str(patient_id).encode()) % count + 1
+
+
+def select_shard(images_path, masks_path, patient_ids, index, count):
+    """
+    Keep only the patients of a shard.
+
+    :param images_path: List of image file paths.
+    :param masks_path: List of mask file paths.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param index: Shard index, between 1 and count.
+    :param count: Number of shards.
+    :return: A tuple with the image paths, the mask paths and the patient IDs of the shard, in the same order.
+    """
+    selected = [(img, mask, pr_id) for img, mask, pr_id in zip(images_path, masks_path, patient_ids)
+                if shard_of(pr_id, count) == index]
+    return [img for img, _, _ in selected], [mask for _, mask, _ in selected], [pr_id for _, _, pr_id in selected]
+
+
+def peak_memory_mb():
+    """
+    Get the peak resident memory of the current process.
+
+    :return: Peak memory in megabytes, or None if it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    # ru_maxrss is reset with the high-water mark by the peak trackers
+    with _memory_lock:
+        _fold_high_water_mark()
+        return max(peak, _process_peak_mb)
 
 
+def current_memory_mb():
+    """
+    Get the resident memory of the current process.
 
+    :return: Resident memory in megabytes, or None if it cannot be measured on this platform (only Linux is
+             supported).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _fold_high_water_mark():
+    """
+    Add the peak resident memory since the last reset to the running trackers, then reset it.
+
+    The kernel high-water mark (VmHWM) is process-wide, so it is read and reset whenever a tracker starts or
+    stops: every tracker running since the last reset then gets the exact peak of its own interval. Must be
+    called with _memory_lock held.
+    """
+    global _process_peak_mb
+    try:
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    except (OSError, ValueError, IndexError, StopIteration):
+        peak = current_memory_mb()
+        if peak is None:
+            return
+    for tracker in _peak_trackers:
+        tracker["Peak"] = max(tracker["Peak"], peak)
+    _process_peak_mb = max(_process_peak_mb, peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        # The high-water mark cannot be reset: the trackers only see the memory at their start and end
+        pass
+
+
+def start_peak_tracking():
+    """
+    Start measuring the peak resident memory of the current process, e.g. during a pipeline stage.
+
+    The peak is the one of the whole process: memory allocated by other threads meanwhile (e.g. the
+    patients prefetched while a patient is extracted) is counted as well.
+
+    :return: Tracker to give to stop_peak_tracking, or None if the memory cannot be measured on this platform.
+    """
+    start = current_memory_mb()
+    if start is None:
+        return None
+    tracker = {"Start": start, "Peak": start}
+    with _memory_lock:
+        _fold_high_water_mark()
+        _peak_trackers.append(tracker)
+    return tracker
+
+
+def stop_peak_tracking(tracker):
+    """
+    Stop a tracker started by start_peak_tracking.
+
+    :param tracker: Tracker returned by start_peak_tracking.
+    :return: Tuple with the peak increase of the resident memory over the start and the peak resident memory,
+             in megabytes, or (None, None) if the memory cannot be measured.
+    """
+    if tracker is None:
+        return None, None
+    with _memory_lock:
+        _fold_high_water_mark()
+        # Trackers of other threads can hold the same values, so they are told apart by identity
+        _peak_trackers[:] = [running for running in _peak_trackers if running is not tracker]
+    peak = max(tracker["Peak"], current_memory_mb() or 0.0)
+    return peak - tracker["Start"], peak
+
+
+def record_stage(stage, seconds, patient_id=None, key=None, voxels=None, memory=None, worker=None,
+                 estimated_cost=None, peak_memory=None):
+    """
+    Record the execution of a pipeline stage.
+
+    :param stage: Name of the stage (e.g. 'read', 'preprocess', 'extraction').
+    :param seconds: Wall time of the stage.
+    :param patient_id: Patient the stage ran for, None for cohort-level stages.
+    :param key: Row key of the extraction job, if any.
+    :param voxels: Number of voxels processed by the stage, if known.
+    :param memory: Peak increase of the resident memory of the process that ran the stage over its start, in
+                   megabytes.
+    :param worker: PID of the process that ran the stage. Defaults to the current process.
+    :param estimated_cost: Cost of the job estimated before it ran, used to schedule it (see
+                           radiomics_2d_3d_extractors._estimate_job_costs).
+    :param peak_memory: Peak resident memory of the process that ran the stage during the stage, in megabytes.
+    """
+    _stage_records.append({
+        "Stage": stage,
+        "PatientID": patient_id,
+        "Key": key,
+        "Seconds": seconds,
+        "Voxels": voxels,
+        "MemoryMB": memory,
+        "PeakMemoryMB": peak_memory,
+        "Worker": worker if worker is not None else os.getpid(),
+        "EstimatedCost": estimated_cost
+    })
+
+
+@contextmanager
+def timed_stage(stage, patient_id=None, key=None):
+    """
+    Time a pipeline stage and record it, even if the stage fails.
+
+    The context yields a dictionary whose 'Voxels' entry can be set to the number of voxels processed. The
+    peak resident memory of the process during the stage is recorded, with its increase over the start of the
+    stage (see start_peak_tracking): when patients are prefetched, it includes the memory of the loader thread.
+
+    :param stage: Name of the stage.
+    :param patient_id: Patient the stage runs for, None for cohort-level stages.
+    :param key: Row key of the extraction job, if any.
+    """
+    info = {"Voxels": None}
+    start, tracker = time.perf_counter(), start_peak_tracking()
+    try:
+        yield info
+    finally:
+        memory, peak = stop_peak_tracking(tracker)
+        record_stage(stage, time.perf_counter() - start, patient_id, key, info["Voxels"], memory,
+                     peak_memory=peak)
+
+
+def get_stage_records():
+    """
+    Get the timing records of the current run.
+
+    :return: List of record dictionaries, in execution order.
+    """
+    return list(_stage_records)
+
+
+def reset_stage_records():
+    """
+    Forget the timing records, e.g. before a new run in the same process.
+    """
+    _stage_records.clear()
+
+
+def summarize_stage_records(records):
+    """
+    Aggregate timing records per stage and per patient.
+
+    :param records: List of records from get_stage_records.
+    :return: Dictionary with the per-stage totals, the largest peak memory increase and peak memory of a stage,
+             the per-patient stage times and the peak memory over every process that ran a stage.
+    """
+    stages = {}
+    patients = {}
+    for record in records:
+        stage = stages.setdefault(record["Stage"], {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                                    "voxels": 0, "max_memory_mb": None, "peak_memory_mb": None})
+        stage["count"] += 1
+        stage["total_seconds"] += record["Seconds"]
+        stage["max_seconds"] = max(stage["max_seconds"], record["Seconds"])
+        stage["voxels"] += record["Voxels"] or 0
+        if record["MemoryMB"] is not None:
+            stage["max_memory_mb"] = max(stage["max_memory_mb"] or 0.0, record["MemoryMB"])
+        if record["PeakMemoryMB"] is not None:
+            stage["peak_memory_mb"] = max(stage["peak_memory_mb"] or 0.0, record["PeakMemoryMB"])
+
+        if record["PatientID"] is not None:
+            patient = patients.setdefault(str(record["PatientID"]), {})
+            patient[record["Stage"]] = patient.get(record["Stage"], 0.0) + record["Seconds"]
+
+    for stage in stages.values():
+        stage["mean_seconds"] = stage["total_seconds"] / stage["count"]
+
+    peaks = [stage["peak_memory_mb"] for stage in stages.values() if stage["peak_memory_mb"] is not None]
+    return {"stages": stages, "patients": patients, "peak_memory_mb": max(peaks) if peaks else None,
+            "cost_model": summarize_cost_estimates(records)}
+
+
+def summarize_cost_estimates(records):
+    """
+    Compare the estimated cost of the jobs with their actual extraction time, to calibrate the cost model.
+
+    :param records: List of records from get_stage_records.
+    :return: Dictionary with the number of jobs, the seconds per cost unit fitted by least squares and the
+             correlation between estimated cost and seconds (None when the costs or the times are all
+             equal), or None if no job has an estimated cost.
+    """
+    pairs = [(record["EstimatedCost"], record["Seconds"]) for record in records
+             if record["EstimatedCost"] is not None]
+    if not pairs:
+        return None
+
+    n = len(pairs)
+    mean_cost = sum(cost for cost, _ in pairs) / n
+    mean_seconds = sum(seconds for _, seconds in pairs) / n
+    covariance = sum((cost - mean_cost) * (seconds - mean_seconds) for cost, seconds in pairs)
+    cost_spread = sum((cost - mean_cost) ** 2 for cost, _ in pairs)
+    seconds_spread = sum((seconds - mean_seconds) ** 2 for _, seconds in pairs)
+    squares = sum(cost * cost for cost, _ in pairs)
+
+    seconds_per_unit = sum(cost * seconds for cost, seconds in pairs) / squares if squares else None
+    correlation = None
+    if cost_spread and seconds_spread:
+        correlation = covariance / (cost_spread * seconds_spread) ** 0.5
+    return {"jobs": n, "seconds_per_unit": seconds_per_unit, "correlation": correlation}
+
+
+def write_run_report(output_path, mode, total_seconds, suffix="", invalid_patients=None):
+    """
+    Write the timing report of the run next to the features file.
+
+    Two files are written: '{mode}_Run_Report.json' with the per-stage and per-patient summary and the peak
+    memory of the run (the largest of the current process and of the workers' jobs), and
+    '{mode}_Run_Report.csv' with one row per recorded stage execution.
+
+    :param output_path: Directory of the features file.
+    :param mode: Extraction mode, '2D' or '3D'.
+    :param total_seconds: Wall time of the whole run.
+    :param suffix: Suffix of the report names, e.g. the shard of a sharded run.
+    :param invalid_patients: Dictionary mapping the ID of each patient skipped by the validation to its problems.
+    :return: Tuple with the paths of the JSON and CSV reports.
+    """
+    records = get_stage_records()
+    summary = {"mode": mode, "total_seconds": total_seconds, **summarize_stage_records(records),
+               "invalid_patients": {str(pr_id): problems for pr_id, problems in (invalid_patients or {}).items()}}
+    peaks = [peak for peak in (summary["peak_memory_mb"], peak_memory_mb()) if peak is not None]
+    summary["peak_memory_mb"] = max(peaks) if peaks else None
+
+    json_path = os.path.join(output_path, f"{mode}_Run_Report{suffix}.json")
+    with open(json_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    csv_path = os.path.join(output_path, f"{mode}_Run_Report{suffix}.csv")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["Stage", "PatientID", "Key", "Seconds", "Voxels", "MemoryMB",
+                                               "PeakMemoryMB", "Worker", "EstimatedCost"])
+        writer.writeheader()
+        writer.writerows(records)
+
+    return json_path, csv_path